@@ -0,0 +1,94 @@
+"""Consultas históricas sobre las imágenes de alerta ("VER N", "VER <etiqueta>", rangos).
+
+Lee las tablas de `alert_index.db`: `alerts` (carpeta plana, la mantiene
+`AlertIndex`) y `archive` (imágenes movidas a AAAA/MM/DD por la retención), con
+la etiqueta y la confianza del EXIF ya guardadas. Con los índices por
+(carpeta, mtime) y (carpeta, etiqueta, mtime) cada consulta lee sólo las filas que
+devuelve, así responde en milisegundos aunque haya cientos de miles de imágenes.
+"""
+import sqlite3
+import threading
+from typing import List, NamedTuple, Optional
+
+import alert_index
+import retention
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS alerts_label_mtime ON alerts (folder, label COLLATE NOCASE, mtime);
+CREATE INDEX IF NOT EXISTS archive_label_mtime ON archive (folder, label COLLATE NOCASE, mtime);
+"""
+
+# Las dos tablas con las mismas columnas; la ruta es relativa a la carpeta de alertas
+_UNION = """
+SELECT * FROM (
+    SELECT name, name AS relpath, mtime, size, label, confidence FROM alerts
+    WHERE folder = ? {where} ORDER BY mtime {order} LIMIT ?
+)
+UNION ALL
+SELECT * FROM (
+    SELECT name, relpath, mtime, size, label, confidence FROM archive
+    WHERE folder = ? {where} ORDER BY mtime {order} LIMIT ?
+)
+ORDER BY mtime {order} LIMIT ?
+"""
+
+
+class CatalogEntry(NamedTuple):
+    name: str
+    relpath: str
+    mtime: float
+    size: int
+    label: Optional[str]
+    confidence: Optional[str]
+
+
+class AlertCatalog:
+    """Consultas de sólo lectura sobre el índice y el archivo, seguras entre hilos."""
+
+    def __init__(self, db_path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(alert_index.SCHEMA + retention.SCHEMA + INDEXES)
+
+    def _query(self, folder: str, where: str, params: list, order: str, limit: int) -> List[CatalogEntry]:
+        # En SQLite un LIMIT negativo significa "sin límite"
+        if limit <= 0:
+            raise ValueError(f"limit debe ser positivo: {limit}")
+        sql = _UNION.format(where=where, order=order)
+        args = [folder, *params, limit, folder, *params, limit, limit]
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        return [CatalogEntry(*row) for row in rows]
+
+    def last(self, folder: str, n: int, label: Optional[str] = None) -> List[CatalogEntry]:
+        """Las últimas `n` imágenes (de la más reciente a la más antigua), opcionalmente de una etiqueta."""
+        if n <= 0:
+            return []
+        if label is None:
+            return self._query(folder, "", [], "DESC", n)
+        return self._query(folder, "AND label = ? COLLATE NOCASE", [label], "DESC", n)
+
+    def between(
+        self,
+        folder: str,
+        start: float,
+        end: float,
+        label: Optional[str] = None,
+        min_confidence: Optional[float] = None,
+        limit: int = 500,
+    ) -> List[CatalogEntry]:
+        """Imágenes con `start <= mtime < end`, en orden cronológico.
+
+        La confianza se guarda como texto ("87%"); el filtro se evalúa sobre las
+        filas del rango que ya seleccionó el índice.
+        """
+        where = "AND mtime >= ? AND mtime < ?"
+        params: list = [start, end]
+        if label is not None:
+            where = "AND label = ? COLLATE NOCASE " + where
+            params.insert(0, label)
+        if min_confidence is not None:
+            where += " AND CAST(RTRIM(confidence, '%') AS REAL) >= ?"
+            params.append(min_confidence)
+        return self._query(folder, where, params, "ASC", limit)
@@ -0,0 +1,410 @@
+"""Índice incremental de las imágenes de alerta.
+
+Mantiene en memoria la lista de `.jpg` de una carpeta ordenada por mtime, de modo
+que "la más reciente" es O(1) y "las últimas N" o "rango de fechas" son O(log n),
+sin recorrer ni hacer `stat()` de toda la carpeta en cada consulta. El índice se
+persiste en SQLite junto con la marca de agua (mtime del directorio) para
+reconstruirse al reiniciar sin volver a leer cada archivo.
+"""
+import bisect
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from metrics import FOLDER_SCAN_SECONDS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS alerts (
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    label TEXT,
+    confidence TEXT,
+    phash INTEGER,
+    duplicate INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (folder, name)
+);
+CREATE INDEX IF NOT EXISTS alerts_mtime ON alerts (folder, mtime);
+CREATE TABLE IF NOT EXISTS watermarks (
+    folder TEXT PRIMARY KEY,
+    dir_mtime_ns INTEGER NOT NULL
+);
+"""
+
+# Columnas agregadas después de la primera versión de la tabla
+COLUMNS_ADDED = (
+    ("phash", "INTEGER"),
+    ("duplicate", "INTEGER NOT NULL DEFAULT 0"),
+)
+
+# Los hashes son de 64 bits sin signo; SQLite guarda enteros con signo
+_HASH_MASK = (1 << 64) - 1
+
+
+def _hash_to_db(value: Optional[int]) -> Optional[int]:
+    return value - (1 << 64) if value is not None and value >= 1 << 63 else value
+
+
+def _hash_from_db(value: Optional[int]) -> Optional[int]:
+    return value & _HASH_MASK if value is not None else None
+
+
+class AlertEntry(NamedTuple):
+    name: str
+    mtime: float
+    size: int
+    label: Optional[str] = None
+    confidence: Optional[str] = None
+    phash: Optional[int] = None
+    # No se envió por ser casi igual a una imagen anterior (ver frame_hash.py)
+    duplicate: bool = False
+
+
+def is_alert_image(name: str) -> bool:
+    return name.lower().endswith(".jpg")
+
+
+class AlertIndex:
+    """Índice de una carpeta de alertas, seguro para usar desde varios hilos.
+
+    `extractor(path) -> (label, confidence)` se llama de forma perezosa, sólo la
+    primera vez que se necesita la etiqueta de una imagen; el resultado queda
+    guardado en el índice.
+    """
+
+    def __init__(self, folder: str, db_path: str, extractor: Callable[[str], Tuple[str, str]]):
+        self.folder = folder
+        self.extractor = extractor
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(alerts)")}
+        for name, decl in COLUMNS_ADDED:
+            if name not in columns:
+                self._db.execute(f"ALTER TABLE alerts ADD COLUMN {name} {decl}")
+
+        self._entries = {}
+        # Nombres cuya etiqueta todavía no se leyó
+        self._unlabeled = set()
+        self._keys: List[Tuple[float, str]] = []
+        self._dir_mtime_ns = None
+        self._load()
+
+    # -------------------- Persistencia --------------------
+    def _load(self):
+        rows = self._db.execute(
+            "SELECT name, mtime, size, label, confidence, phash, duplicate FROM alerts WHERE folder = ? "
+            "ORDER BY mtime, name",
+            (self.folder,),
+        ).fetchall()
+        self._entries = {row[0]: AlertEntry(*row[:5], _hash_from_db(row[5]), bool(row[6])) for row in rows}
+        self._unlabeled = {row[0] for row in rows if row[3] is None}
+        self._keys = [(row[1], row[0]) for row in rows]
+        row = self._db.execute("SELECT dir_mtime_ns FROM watermarks WHERE folder = ?", (self.folder,)).fetchone()
+        self._dir_mtime_ns = row[0] if row else None
+
+    def _store(self, entries):
+        # La base la comparten el envío de alertas y el webhook: si la fila ya existe
+        # con el mismo mtime (la agregó el otro proceso) se conserva lo que ése ya leyó
+        self._db.executemany(
+            "INSERT INTO alerts (folder, name, mtime, size, label, confidence, phash, duplicate) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (folder, name) DO UPDATE SET "
+            "label = CASE WHEN alerts.mtime = excluded.mtime "
+            "THEN COALESCE(excluded.label, alerts.label) ELSE excluded.label END, "
+            "confidence = CASE WHEN alerts.mtime = excluded.mtime "
+            "THEN COALESCE(excluded.confidence, alerts.confidence) ELSE excluded.confidence END, "
+            "phash = CASE WHEN alerts.mtime = excluded.mtime "
+            "THEN COALESCE(excluded.phash, alerts.phash) ELSE excluded.phash END, "
+            "duplicate = CASE WHEN alerts.mtime = excluded.mtime "
+            "THEN MAX(excluded.duplicate, alerts.duplicate) ELSE excluded.duplicate END, "
+            "mtime = excluded.mtime, size = excluded.size",
+            [(self.folder, *e[:5], _hash_to_db(e.phash), int(e.duplicate)) for e in entries],
+        )
+
+    def _adopt_stored(self, entries: List[AlertEntry]):
+        """Completa en memoria las imágenes recién agregadas con lo que la base ya tenía."""
+        for i in range(0, len(entries), 500):
+            chunk = [e.name for e in entries[i:i + 500]]
+            rows = self._db.execute(
+                "SELECT name, mtime, label, confidence, phash, duplicate FROM alerts "
+                "WHERE folder = ? AND (label IS NOT NULL OR phash IS NOT NULL OR duplicate = 1) "
+                f"AND name IN ({','.join('?' * len(chunk))})",
+                (self.folder, *chunk),
+            ).fetchall()
+            for name, mtime, label, confidence, phash, duplicate in rows:
+                current = self._entries.get(name)
+                if current is not None and current.mtime == mtime:
+                    self._entries[name] = current._replace(
+                        label=label, confidence=confidence, phash=_hash_from_db(phash), duplicate=bool(duplicate)
+                    )
+                    if label is not None:
+                        self._unlabeled.discard(name)
+
+    # -------------------- Mantenimiento --------------------
+    def path(self, entry: AlertEntry) -> str:
+        return os.path.join(self.folder, entry.name)
+
+    def _insert(self, entry: AlertEntry):
+        old = self._entries.get(entry.name)
+        if old is not None:
+            self._keys.pop(bisect.bisect_left(self._keys, (old.mtime, old.name)))
+        self._entries[entry.name] = entry
+        if entry.label is None:
+            self._unlabeled.add(entry.name)
+        else:
+            self._unlabeled.discard(entry.name)
+        bisect.insort(self._keys, (entry.mtime, entry.name))
+
+    def _insert_many(self, entries: List[AlertEntry]):
+        """Agrega imágenes que no estaban en el índice con un único ordenamiento.
+
+        Insertarlas de a una cuesta O(n) cada una (corrimiento de la lista); al
+        reconstruir el índice o tras un lote grande eso sería O(n²).
+        """
+        if not entries:
+            return
+        for entry in entries:
+            self._entries[entry.name] = entry
+            if entry.label is None:
+                self._unlabeled.add(entry.name)
+        # Timsort aprovecha que `_keys` ya está ordenada: cuesta O(n + k log k)
+        self._keys.extend((entry.mtime, entry.name) for entry in entries)
+        self._keys.sort()
+
+    def _remove_many(self, names: Iterable[str]):
+        """Quita varias imágenes recorriendo `_keys` una sola vez."""
+        gone = set()
+        for name in names:
+            self._unlabeled.discard(name)
+            old = self._entries.pop(name, None)
+            if old is not None:
+                gone.add((old.mtime, old.name))
+        if len(gone) == 1:
+            self._keys.pop(bisect.bisect_left(self._keys, gone.pop()))
+        elif gone:
+            self._keys = [key for key in self._keys if key not in gone]
+
+    def add(self, path: str) -> Optional[AlertEntry]:
+        """Agrega o actualiza una imagen a partir de un evento del observador (O(log n))."""
+        name = os.path.basename(path)
+        if not is_alert_image(name):
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            old = self._entries.get(name)
+            if old is not None and old.mtime == st.st_mtime and old.size == st.st_size:
+                return old
+            entry = AlertEntry(name, st.st_mtime, st.st_size)
+            self._insert(entry)
+            self._store([entry])
+            self._adopt_stored([entry])
+            return self._entries[name]
+
+    def refresh(self) -> bool:
+        """Sincroniza el índice con la carpeta si ésta cambió desde la última vez.
+
+        Cuesta un único `stat()` cuando no hay cambios. Si el mtime del directorio
+        cambió, se recorre la carpeta pero sólo se hace `stat()` de los nombres nuevos.
+        Retorna True si hubo que recorrer la carpeta.
+        """
+        try:
+            dir_mtime_ns = os.stat(self.folder).st_mtime_ns
+        except OSError:
+            return False
+        with self._lock:
+            if dir_mtime_ns == self._dir_mtime_ns:
+                return False
+
+            start = time.perf_counter()
+            names = set()
+            added = []
+            with os.scandir(self.folder) as it:
+                for e in it:
+                    if not is_alert_image(e.name):
+                        continue
+                    names.add(e.name)
+                    if e.name in self._entries:
+                        continue
+                    try:
+                        if not e.is_file():
+                            continue
+                        st = e.stat()
+                    except OSError:
+                        continue
+                    added.append(AlertEntry(e.name, st.st_mtime, st.st_size))
+            self._insert_many(added)
+            removed = [name for name in self._entries if name not in names]
+            self._remove_many(removed)
+
+            self._db.execute("BEGIN")
+            try:
+                self._store(added)
+                self._adopt_stored(added)
+                self._db.executemany(
+                    "DELETE FROM alerts WHERE folder = ? AND name = ?", [(self.folder, n) for n in removed]
+                )
+                # La marca de agua se toma antes del recorrido: si llega un archivo durante
+                # el scandir, el próximo refresh lo detectará.
+                self._db.execute(
+                    "INSERT OR REPLACE INTO watermarks (folder, dir_mtime_ns) VALUES (?, ?)",
+                    (self.folder, dir_mtime_ns),
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._dir_mtime_ns = dir_mtime_ns
+            FOLDER_SCAN_SECONDS.observe(time.perf_counter() - start)
+            return True
+
+    def discard(self, names: List[str]):
+        """Quita del índice imágenes que se movieron o borraron (ej. al archivarlas)."""
+        with self._lock:
+            self._remove_many(names)
+            self._db.executemany(
+                "DELETE FROM alerts WHERE folder = ? AND name = ?", [(self.folder, n) for n in names]
+            )
+
+    def describe(self, entry: AlertEntry) -> AlertEntry:
+        """Completa etiqueta y confianza de la entrada (sólo lee el EXIF la primera vez)."""
+        if entry.label is not None:
+            return entry
+        # Otro proceso pudo haberla leído ya (la base es compartida)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT label, confidence FROM alerts WHERE folder = ? AND name = ? AND mtime = ?",
+                (self.folder, entry.name, entry.mtime),
+            ).fetchone()
+        if row is not None and row[0] is not None:
+            label, confidence = row
+        else:
+            label, confidence = self.extractor(self.path(entry))
+        with self._lock:
+            current = self._entries.get(entry.name)
+            described = entry._replace(label=label, confidence=confidence)
+            if current is not None and current.mtime == entry.mtime:
+                described = current._replace(label=label, confidence=confidence)
+                self._entries[entry.name] = described
+                self._unlabeled.discard(entry.name)
+                self._db.execute(
+                    "UPDATE alerts SET label = ?, confidence = ? WHERE folder = ? AND name = ?",
+                    (label, confidence, self.folder, entry.name),
+                )
+        return described
+
+    def fingerprint(self, entry: AlertEntry, hasher: Callable[[str], Optional[int]]) -> AlertEntry:
+        """Completa el hash perceptual de la entrada (sólo decodifica la imagen la primera vez)."""
+        if entry.phash is not None:
+            return entry
+        with self._lock:
+            current = self._entries.get(entry.name)
+            if current is not None and current.mtime == entry.mtime and current.phash is not None:
+                return current
+            # Otro proceso pudo haberlo calculado ya (la base es compartida)
+            row = self._db.execute(
+                "SELECT phash FROM alerts WHERE folder = ? AND name = ? AND mtime = ?",
+                (self.folder, entry.name, entry.mtime),
+            ).fetchone()
+        phash = _hash_from_db(row[0]) if row is not None and row[0] is not None else hasher(self.path(entry))
+        if phash is None:
+            return entry
+        with self._lock:
+            current = self._entries.get(entry.name)
+            hashed = entry._replace(phash=phash)
+            if current is not None and current.mtime == entry.mtime:
+                hashed = current._replace(phash=phash)
+                self._entries[entry.name] = hashed
+                self._db.execute(
+                    "UPDATE alerts SET phash = ? WHERE folder = ? AND name = ?",
+                    (_hash_to_db(phash), self.folder, entry.name),
+                )
+        return hashed
+
+    def unlabeled(self) -> List[AlertEntry]:
+        """Entradas cuya etiqueta todavía no se leyó."""
+        with self._lock:
+            return [self._entries[name] for name in self._unlabeled]
+
+    def label_pending(self, batch: int = 500) -> int:
+        """Lee y guarda la etiqueta de todas las imágenes pendientes, las más recientes primero.
+
+        Deja el índice listo para las consultas por etiqueta; cuesta sólo las imágenes
+        nuevas desde la última vez. Guarda de a `batch` imágenes, así las consultas ven
+        el avance sin esperar al final. Retorna la cantidad etiquetada.
+        """
+        with self._lock:
+            pending = sorted((self._entries[name] for name in self._unlabeled), key=lambda e: e.mtime, reverse=True)
+        for i in range(0, len(pending), batch):
+            self.set_labels({e.name: self.extractor(self.path(e)) for e in pending[i:i + batch]})
+        return len(pending)
+
+    def set_labels(self, labels: Dict[str, Tuple[str, str]]):
+        """Guarda en una transacción etiquetas ya extraídas (ej. en lote), por nombre de archivo."""
+        with self._lock:
+            rows = []
+            for name, (label, confidence) in labels.items():
+                entry = self._entries.get(name)
+                if entry is None:
+                    continue
+                self._entries[name] = entry._replace(label=label, confidence=confidence)
+                self._unlabeled.discard(name)
+                rows.append((label, confidence, self.folder, name))
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "UPDATE alerts SET label = ?, confidence = ? WHERE folder = ? AND name = ?", rows
+            )
+            self._db.execute("COMMIT")
+
+    # -------------------- Consultas --------------------
+    def __len__(self):
+        return len(self._keys)
+
+    def newest(self) -> Optional[AlertEntry]:
+        """La imagen más reciente (O(1))."""
+        with self._lock:
+            if not self._keys:
+                return None
+            return self._entries[self._keys[-1][1]]
+
+    def last(self, n: int) -> List[AlertEntry]:
+        """Las últimas `n` imágenes, de la más reciente a la más antigua."""
+        with self._lock:
+            return [self._entries[name] for _, name in reversed(self._keys[-n:])] if n > 0 else []
+
+    def oldest(self, before: float, limit: int) -> List[AlertEntry]:
+        """Hasta `limit` imágenes con mtime anterior a `before`, de la más antigua a la más nueva."""
+        with self._lock:
+            hi = min(bisect.bisect_left(self._keys, (before, "")), limit)
+            return [self._entries[name] for _, name in self._keys[:hi]]
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(e.size for e in self._entries.values())
+
+    def mark_duplicate(self, entry: AlertEntry) -> AlertEntry:
+        """Registra que la imagen no se envió por ser casi igual a otra anterior."""
+        with self._lock:
+            current = self._entries.get(entry.name)
+            marked = entry._replace(duplicate=True)
+            if current is not None and current.mtime == entry.mtime:
+                marked = current._replace(duplicate=True)
+                self._entries[entry.name] = marked
+                self._db.execute(
+                    "UPDATE alerts SET duplicate = 1 WHERE folder = ? AND name = ?", (self.folder, entry.name)
+                )
+        return marked
+
+    def between(self, start: float, end: float) -> List[AlertEntry]:
+        """Imágenes con `start <= mtime < end` (timestamps epoch), en orden cronológico."""
+        with self._lock:
+            lo = bisect.bisect_left(self._keys, (start, ""))
+            hi = bisect.bisect_left(self._keys, (end, ""))
+            return [self._entries[name] for _, name in self._keys[lo:hi]]
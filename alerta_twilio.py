@@ -1,139 +1,88 @@
 import os
 import json
+import argparse
+import hashlib
+import queue
+import signal
+import sys
+import threading
+import time
+from typing import List, Optional
 import requests
 from datetime import datetime, timedelta, timezone
-from PIL import Image, ExifTags
-from twilio.rest import Client
 import urllib3
 
+import config
+from alert_index import AlertEntry, AlertIndex
+from coalescer import SEND, Coalescer, Frame, best_frame
+from exif_reader import extract_label_confidence
+from folder_watcher import FolderWatcher
+from frame_hash import find_near_duplicate
+from media_variants import cache_from_settings, prepared_media_url, variant_from_settings
+from metrics import MESSAGES_TOTAL, NEAR_DUPLICATES_TOTAL, REGISTRY
+from outbox import Outbox, OutboxWorker, SharedTokenBucket, alert_delivery_recorder, alert_key
+from retention import ArchiveCatalog, RetentionWorker, policy_from_settings
+from sites import PerSite, Site
+from state_store import StateStore, clear_expired_pause
+from twilio_client import build_client
+
 urllib3.disable_warnings()  # Desactivar advertencias SSL
 
 # -------------------- Configuración --------------------
 BASE_DIR = os.path.dirname(__file__)
 LOCAL_TZ = timezone(timedelta(hours=-3))  # UTC-3
 
-# Cargar ajustes desde Settings.json (mismos que usa el código anterior)
-settings_path = os.path.join(BASE_DIR, "Settings.json")
-if not os.path.exists(settings_path):
-    raise FileNotFoundError(f"No se encontró el archivo de configuración: {settings_path}")
-
-with open(settings_path, "r", encoding="utf-8") as f:
-    settings = json.load(f)
-
-INSTANCE_NAME = settings.get("instance_name", "Nombre por defecto")
-INSTANCE_ID = settings.get("instance_id", "ID por defecto")
-IMAGE_FOLDER = settings.get("alerts_folder", "./alerts")
-ALERTS_BASE_URL = settings.get("alerts_base_url")  # URL pública donde se sirven las imágenes
+# Settings.json validado y con los sitios ya armados (ver config.py). `settings` es
+# la versión al arrancar, para lo que no cambia sin reiniciar (cliente, pools, cachés);
+# los datos de cada sitio y los ajustes por alerta se leen de `CONFIG.current()`.
+CONFIG = config.source()
+settings = CONFIG.current().settings
 
-# Credenciales de Twilio y destinatarios (definidos en Settings.json)
+# Credenciales de Twilio (una sola cuenta para todos los sitios)
 ACCOUNT_SID = settings["twilio_account_sid"]
 AUTH_TOKEN = settings["twilio_auth_token"]
-CONTENT_SID = settings["twilio_content_sid"]  # Plantilla con botón Quick Reply
-FROM_WHATSAPP = settings["twilio_from_whatsapp"]
-RECIPIENTS = settings.get("recipients", [])
 
-client = Client(ACCOUNT_SID, AUTH_TOKEN)
-
-# Fichero que mantiene el estado por usuario
-STATE_FILE = os.path.join(BASE_DIR, "user_state.json")
-
-def load_state() -> dict:
-    """Carga el estado persistente de los usuarios."""
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            pass
-    return {}
+# Cliente con pool de conexiones keep-alive, timeouts y reintentos (ver twilio_client.py)
+client = build_client(settings)
 
-def save_state(state: dict):
-    """Guarda el estado persistente."""
-    try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(state, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"[WARN] No se pudo guardar el estado: {e}")
-
-# -------------------- Utilidades --------------------
-TRANSLATIONS = {
-    "person": "Persona",
-    "vehicle": "Vehículo",
-    "fire": "Fuego",
-    "smoke": "Humo",
-    "unknown": "Desconocido",
-    "nothing found": "No se detectaron objetos",
-    "no objects detected": "No se detectaron objetos",
-}
-
-def translate_label(label: str) -> str:
-    return TRANSLATIONS.get(label.lower(), label)
-
-def extract_label_confidence(image_path: str):
-    """Extrae la etiqueta del EXIF (ImageDescription)."""
-    try:
-        with Image.open(image_path) as img:
-            exif_data = img.getexif()
-            if not exif_data:
-                return "No se detectaron objetos", ""
-            description = None
-            for tag_id, val in exif_data.items():
-                if ExifTags.TAGS.get(tag_id) == "ImageDescription":
-                    description = val.decode("utf-8") if isinstance(val, bytes) else str(val)
-                    break
-            if not description:
-                return "No se detectaron objetos", ""
-            if ":" in description:
-                label, confidence = description.split(":", 1)
-                return label.strip(), confidence.strip()
-            return description.strip(), "0%"
-    except Exception as e:
-        return f"Error: {e}", ""
+# Estado por usuario de cada sitio (compartido con el webhook); en modo de un solo
+# sitio importa user_state.json si existe
+STATE_STORES = PerSite(lambda site: StateStore(site.state_db, legacy_json=site.legacy_state_json))
 
 # -------------------- Detección de la imagen más reciente --------------------
-print(f"[DEBUG] Carpeta de alertas configurada: {IMAGE_FOLDER}")
-if not os.path.isdir(IMAGE_FOLDER):
-    raise NotADirectoryError(f"El directorio de alertas no existe: {IMAGE_FOLDER}")
-
-jpg_files = [e for e in os.scandir(IMAGE_FOLDER) if e.is_file() and e.name.lower().endswith(".jpg")]
-print(f"[DEBUG] Imágenes encontradas: {len(jpg_files)}")
-if not jpg_files:
-    raise FileNotFoundError(f"No se encontraron imágenes .jpg en {IMAGE_FOLDER}")
-
-# Ordenar por fecha de modificación descendente
-jpg_files.sort(key=lambda x: x.stat().st_mtime, reverse=True)
-newest_entry = jpg_files[0]
-image_path = os.path.join(IMAGE_FOLDER, newest_entry.name)
-print(f"[DEBUG] Imagen seleccionada: {image_path}")
+# Índice persistente de cada carpeta (una sola base para todos los sitios): evita
+# recorrer y ordenar todas las imágenes
+INDEX_DB = os.path.join(BASE_DIR, "alert_index.db")
+ALERT_INDEXES = PerSite(lambda site: AlertIndex(site.folder, INDEX_DB, extract_label_confidence))
 
-label, confidence = extract_label_confidence(image_path)
-print(f"[DEBUG] Etiqueta detectada: {label} (confianza {confidence})")
-label = translate_label(label)
+def find_newest_image(site: Site) -> AlertEntry:
+    """Retorna la entrada del índice de la imagen .jpg más reciente de la carpeta del sitio."""
+    print(f"[DEBUG] Carpeta de alertas de {site.id}: {site.folder}")
+    if not os.path.isdir(site.folder):
+        raise NotADirectoryError(f"El directorio de alertas no existe: {site.folder}")
 
-# Timestamp del evento
-event_ts = datetime.fromtimestamp(newest_entry.stat().st_mtime, tz=timezone.utc)
-event_ts_local = event_ts.astimezone(LOCAL_TZ)
+    index = ALERT_INDEXES(site)
+    index.refresh()
+    print(f"[DEBUG] Imágenes indexadas: {len(index)}")
+    newest_entry = index.newest()
+    if newest_entry is None:
+        raise FileNotFoundError(f"No se encontraron imágenes .jpg en {site.folder}")
+    return newest_entry
 
 # -------------------- Lógica de envío --------------------
-STATE = load_state()
-now = datetime.now(timezone.utc)
-
-TEMPLATE_COOLDOWN = timedelta(hours=settings.get("template_cooldown_hours", 1))
-SESSION_DURATION = timedelta(hours=settings.get("session_duration_hours", 24))
-
-def should_send_template(user_state: dict) -> bool:
-    """Determina si debemos enviar la plantilla basándonos en la configuración."""
+def should_send_template(site: Site, user_state: dict, now_utc: datetime) -> bool:
+    """Determina si debemos enviar la plantilla según el intervalo mínimo del sitio."""
     last_template_str = user_state.get("last_template_sent")
     if not last_template_str:
         return True
     last_template = datetime.fromisoformat(last_template_str)
-    return now - last_template >= TEMPLATE_COOLDOWN
+    return now_utc - last_template >= site.template_cooldown
 
-def session_active(user_state: dict) -> bool:
+def session_active(user_state: dict, now_utc: datetime) -> bool:
     session_until_str = user_state.get("session_until")
     if not session_until_str:
         return False
-    return datetime.fromisoformat(session_until_str) > now
+    return datetime.fromisoformat(session_until_str) > now_utc
 
 def is_paused(user_state: dict, now_utc: datetime) -> bool:
     """Retorna True si el usuario tiene pausa vigente. Limpia pausas expiradas."""
@@ -151,87 +100,438 @@ def is_paused(user_state: dict, now_utc: datetime) -> bool:
             pass
     return bool(user_state.get("paused"))
 
-# Contadores para logging
-sent_template = 0
-sent_session = 0
-skipped = 0
+# Variante reducida de la imagen para WhatsApp (opcional, ver 'media_variant')
+MEDIA_VARIANT = variant_from_settings(settings)
+VARIANT_CACHE = cache_from_settings(settings, BASE_DIR) if MEDIA_VARIANT else None
 
-for dest in RECIPIENTS:
-    user_state = STATE.get(dest, {})
-    # Auto-despausar si la pausa expiró
-    paused_until_str = user_state.get("paused_until")
-    if paused_until_str:
-        try:
-            if datetime.fromisoformat(paused_until_str) <= now:
-                user_state.pop("paused", None)
-                user_state.pop("paused_until", None)
-                STATE[dest] = user_state
-        except Exception:
-            pass
+def build_media_param(site: Site, image_path: str) -> dict:
+    """Parámetro `media_url` para Twilio, o `{}` si no hay URL base configurada."""
+    if not site.base_url:
+        return {}
+    return {"media_url": [prepared_media_url(site.base_url, image_path, MEDIA_VARIANT, VARIANT_CACHE)]}
 
-    # Si el destinatario tiene pausa vigente, no enviar nada
-    if is_paused(user_state, now):
-        skipped += 1
-        print(f"[SKIP] {dest} tiene alertas pausadas. No se envía mensaje.")
-        continue
-    if session_active(user_state):
-        # Enviar mensaje de sesión (económico)
-        body = (
-            f"🔔 Alerta de movimiento en {INSTANCE_NAME}\n"
-            f"🗓 Fecha y Hora: {event_ts_local.strftime('%Y-%m-%d %H:%M')} UTC-3\n"
-            f"🔍 Objetos detectados: {label}"
-        )
-        media_param = {}
-        if ALERTS_BASE_URL:
-            filename = os.path.basename(image_path)
-            media_url = f"{ALERTS_BASE_URL.rstrip('/')}/{filename}"
-            media_param = {"media_url": [media_url]}
-            print(f"[DEBUG] media_url asignado: {media_url}")
-        else:
-            print("[WARN] No se definió 'alerts_base_url' en Settings.json; el mensaje se enviará sin imagen.")
-        try:
-            print(f"[DEBUG] Enviando mensaje de sesión a {dest}")
-            client.messages.create(
-                from_=FROM_WHATSAPP,
-                body=body,
-                to=dest,
-                **media_param,
+# Cola persistente de envíos (compartida con el webhook), vaciada por un pool de
+# hilos concurrente que respeta el límite de mensajes/segundo del remitente
+# (compartido con el webhook a través de outbox.db)
+OUTBOX = Outbox(
+    os.path.join(BASE_DIR, "outbox.db"),
+    max_attempts=settings.get("outbox_max_attempts", 5),
+)
+
+def _send_params(params: dict) -> object:
+    return client.messages.create(**params)
+
+OUTBOX_WORKER = OutboxWorker(
+    OUTBOX,
+    _send_params,
+    concurrency=settings.get("send_concurrency", 8),
+    limiter=SharedTokenBucket(OUTBOX, settings.get("twilio_messages_per_second", 10)),
+    # La plantilla o el mensaje de sesión quedan en el estado al entregarse, no al encolarse
+    on_sent=alert_delivery_recorder(
+        lambda site_id: STATE_STORES(CONFIG.current().sites_by_id[site_id])
+        if site_id in CONFIG.current().sites_by_id else None
+    ),
+)
+
+def send_alert(site: Site, entries: List[AlertEntry]) -> dict:
+    """Encola una alerta por las imágenes `entries` para todos los destinatarios del sitio.
+
+    Con varias imágenes (ráfaga agrupada) se informan todas las etiquetas y se
+    adjunta la de mayor confianza. Actualiza el estado de los destinatarios y
+    retorna los contadores del resumen; el envío lo hace `OUTBOX_WORKER`.
+    """
+    best = best_frame(entries)
+    image_path = ALERT_INDEXES(site).path(best)
+
+    labels = []
+    for e in entries:
+        translated = config.translate_label(e.label)
+        if translated not in labels:
+            labels.append(translated)
+    label = ", ".join(labels)
+    if len(entries) > 1:
+        if best.confidence:
+            label = f"{label} (máx. {best.confidence})"
+        print(f"[INFO] Envío agrupado de {len(entries)} imágenes; imagen elegida: {image_path}")
+
+    # Timestamp del evento
+    event_ts = datetime.fromtimestamp(best.mtime, tz=timezone.utc)
+    event_ts_local = event_ts.astimezone(LOCAL_TZ)
+
+    now = datetime.now(timezone.utc)
+
+    # Mensajes a enviar: (destinatario, tipo, parámetros de messages.create)
+    jobs = []
+    skipped = 0
+    state_store = STATE_STORES(site)
+    state = state_store.get_many(site.recipients)
+    expired = set()
+
+    media_param = None
+
+    for dest in site.recipients:
+        user_state = state[dest]
+        # Auto-despausar si la pausa expiró
+        paused_until_str = user_state.get("paused_until")
+        if paused_until_str:
+            try:
+                if datetime.fromisoformat(paused_until_str) <= now:
+                    user_state.pop("paused", None)
+                    user_state.pop("paused_until", None)
+                    expired.add(dest)
+            except Exception:
+                pass
+
+        kind = "session" if session_active(user_state, now) else "template"
+        # Si el destinatario tiene pausa vigente, no enviar nada
+        if is_paused(user_state, now):
+            skipped += 1
+            MESSAGES_TOTAL.inc(kind, "paused")
+            print(f"[SKIP] {dest} tiene alertas pausadas. No se envía mensaje.")
+            continue
+        if kind == "session":
+            # Enviar mensaje de sesión (económico)
+            body = (
+                f"🔔 Alerta de movimiento en {site.name}\n"
+                f"🗓 Fecha y Hora: {event_ts_local.strftime('%Y-%m-%d %H:%M')} UTC-3\n"
+                f"🔍 Objetos detectados: {label}"
             )
-            sent_session += 1
-            # Actualizar estado
-            user_state["last_event_sent"] = now.isoformat()
-            STATE[dest] = user_state
-            print(f"[OK] Mensaje de sesión enviado a {dest}")
-        except Exception as e:
-            print(f"[ERR] Falló envío de sesión a {dest}: {e}")
-    else:
-        if should_send_template(user_state):
+            if len(entries) > 1:
+                body += f"\n📸 Imágenes en la ráfaga: {len(entries)}"
+            if media_param is None:
+                media_param = build_media_param(site, image_path)
+            if media_param:
+                print(f"[DEBUG] media_url asignado: {media_param['media_url'][0]}")
+            else:
+                print("[WARN] No se definió 'alerts_base_url' en Settings.json; el mensaje se enviará sin imagen.")
+            print(f"[DEBUG] Enviando mensaje de sesión a {dest}")
+            jobs.append((dest, "session", dict(from_=site.from_whatsapp, body=body, to=dest, **media_param)))
+        elif not should_send_template(site, user_state, now):
+            skipped += 1
+            MESSAGES_TOTAL.inc(kind, "skipped")
+            print(f"[SKIP] Se omitió envío a {dest}: plantilla enviada hace menos de {site.template_cooldown} h y sin sesión activa.")
+        elif OUTBOX.in_flight(site.id, dest, "template"):
+            # Una plantilla anterior todavía en la cola cuenta como enviada
+            skipped += 1
+            MESSAGES_TOTAL.inc(kind, "skipped")
+            print(f"[SKIP] Se omitió envío a {dest}: la plantilla anterior de {site.name} todavía está en la cola.")
+        else:
             variables = {
-                "1": INSTANCE_NAME,
+                "1": site.name,
                 "2": f"{event_ts_local.strftime('%Y-%m-%d %H:%M')} UTC-3",
                 "3": label,
             }
-            try:
-                client.messages.create(
-                    from_=FROM_WHATSAPP,
-                    content_sid=CONTENT_SID,
+            jobs.append((
+                dest,
+                "template",
+                dict(
+                    from_=site.from_whatsapp,
+                    content_sid=site.content_sid,
                     content_variables=json.dumps(variables),
                     to=dest,
-                )
-                sent_template += 1
-                # Guardar timestamp de la plantilla
-                user_state["last_template_sent"] = now.isoformat()
-                STATE[dest] = user_state
-                print(f"[OK] Plantilla enviada a {dest}")
-            except Exception as e:
-                print(f"[ERR] Falló envío de plantilla a {dest}: {e}")
-        else:
+                ),
+            ))
+
+    # Encolar los envíos. La clave de idempotencia identifica la alerta y el
+    # destinatario, así una misma alerta despachada dos veces no se reenvía.
+    if len(entries) == 1:
+        alert_id = f"{best.name}@{best.mtime}"
+    else:
+        alert_id = hashlib.sha1("|".join(sorted(e.name for e in entries)).encode("utf-8")).hexdigest()
+    sent_template = 0
+    sent_session = 0
+    # Para la demora de punta a punta cuenta la primera imagen de la ráfaga
+    event_at = min(e.mtime for e in entries)
+    for dest, kind, params in jobs:
+        if not OUTBOX.enqueue(alert_key(site.id, alert_id, dest), params, kind=kind, event_at=event_at):
             skipped += 1
-            print(f"[SKIP] Se omitió envío a {dest}: plantilla enviada hace menos de {TEMPLATE_COOLDOWN} h y sin sesión activa.")
+            MESSAGES_TOTAL.inc(kind, "skipped")
+            print(f"[SKIP] La alerta para {dest} ya estaba encolada; no se duplica.")
+            continue
+        if kind == "session":
+            sent_session += 1
+            print(f"[OK] Mensaje de sesión encolado para {dest}")
+        else:
+            sent_template += 1
+            print(f"[OK] Plantilla encolada para {dest}")
+    OUTBOX_WORKER.notify()
+
+    # Guardar las pausas vencidas en una transacción; lo enviado lo registra el outbox
+    # al entregarse (ver `alert_delivery_recorder`)
+    if expired:
+        state_store.update_many({dest: clear_expired_pause(now) for dest in expired})
+
+    print(
+        f"Resumen {site.id} -> Plantillas encoladas: {sent_template}, Sesión encolados: {sent_session}, "
+        f"Omitidos: {skipped}"
+    )
+    return {"template": sent_template, "session": sent_session, "skipped": skipped}
+
+# -------------------- Agrupación de ráfagas --------------------
+# Las imágenes que llegan dentro de la ventana se envían juntas ('coalesce_seconds'
+# de cada sitio, 0 = desactivado). Las ventanas se guardan en la base de estado del sitio.
+COALESCERS = PerSite(
+    lambda site: Coalescer(site.state_db, site.coalesce_seconds),
+    key=lambda site: (site.id, site.coalesce_seconds),
+)
+
+def coalescer_for(site: Site) -> Optional[Coalescer]:
+    return COALESCERS(site) if site.coalesce_seconds > 0 else None
+
+def dispatch_alert(site: Site, entry: AlertEntry) -> Optional[dict]:
+    """Procesa una imagen nueva del sitio: la envía a todos sus destinatarios o la agrupa.
+
+    Es el punto de entrada común del modo de una sola ejecución y del modo daemon.
+    Retorna los contadores del resumen, o None si la imagen quedó acumulada en la
+    ventana de agrupación vigente (se enviará con `flush_coalesced()`).
+    """
+    index = ALERT_INDEXES(site)
+    print(f"[DEBUG] Imagen seleccionada: {index.path(entry)}")
+
+    # La etiqueta se lee del EXIF una sola vez y queda guardada en el índice
+    entry = index.describe(entry)
+    print(f"[DEBUG] Etiqueta detectada: {entry.label} (confianza {entry.confidence})")
+
+    # Cuadros casi idénticos: una imagen con la misma etiqueta y casi igual (hash
+    # perceptual a 'near_duplicate_distance' bits o menos) que la última enviada del
+    # sitio en 'near_duplicate_seconds' no se envía. Sin esa clave no se compara.
+    cfg = CONFIG.current()
+    if cfg.get("near_duplicate_distance") is not None:
+        duplicate = find_near_duplicate(
+            index,
+            entry,
+            int(cfg.get("near_duplicate_distance")),
+            int(cfg.get("near_duplicate_window", 20)),
+            float(cfg.get("near_duplicate_seconds", 600)),
+        )
+        if duplicate is not None:
+            index.mark_duplicate(entry)
+            NEAR_DUPLICATES_TOTAL.inc()
+            print(f"[SKIP] {entry.name} es casi igual a {duplicate.name} ({entry.label}); no se envía.")
+            return {"template": 0, "session": 0, "skipped": 0}
+
+    coalescer = coalescer_for(site)
+    if coalescer is None:
+        return send_alert(site, [entry])
+
+    # Enviar antes cualquier grupo de una ventana ya vencida
+    flush_coalesced(site)
+    frame = Frame(entry.name, entry.mtime, entry.size, entry.label, entry.confidence)
+    if coalescer.offer(site.id, frame, time.time()) == SEND:
+        return send_alert(site, [entry])
+    print(f"[INFO] Imagen agrupada con la ráfaga en curso; se enviará al cerrar la ventana de {site.coalesce_seconds:g} s.")
+    return None
+
+def flush_coalesced(site: Site) -> Optional[dict]:
+    """Envía las imágenes acumuladas si su ventana ya cerró y nadie más las reclamó."""
+    coalescer = coalescer_for(site)
+    if coalescer is None:
+        return None
+    frames = coalescer.take_due(site.id, time.time())
+    if not frames:
+        return None
+    return send_alert(site, [AlertEntry(*f) for f in frames])
+
+def next_window_close(sites: List[Site]) -> Optional[float]:
+    """Cierre más próximo entre las ventanas con imágenes pendientes, o None."""
+    closes = []
+    for site in sites:
+        coalescer = coalescer_for(site)
+        closes_at = coalescer.closes_at(site.id) if coalescer is not None else None
+        if closes_at is not None:
+            closes.append(closes_at)
+    return min(closes) if closes else None
+
+# -------------------- Métricas --------------------
+# Archivo para el textfile collector de node_exporter y/o Pushgateway (opcionales)
+METRICS_TEXTFILE = settings.get("metrics_textfile")
+METRICS_PUSHGATEWAY_URL = settings.get("metrics_pushgateway_url")
+METRICS_INTERVAL = float(settings.get("metrics_interval", 15))  # Segundos entre publicaciones en modo daemon
+
+def export_metrics():
+    """Publica las métricas de esta ejecución en los destinos configurados."""
+    if METRICS_TEXTFILE:
+        try:
+            REGISTRY.write_textfile(METRICS_TEXTFILE)
+        except Exception as e:
+            print(f"[WARN] No se pudieron escribir las métricas en {METRICS_TEXTFILE}: {e}")
+    if METRICS_PUSHGATEWAY_URL:
+        try:
+            REGISTRY.push(METRICS_PUSHGATEWAY_URL, "alerta_twilio", settings.get("instance_id"))
+        except Exception as e:
+            print(f"[WARN] No se pudieron enviar las métricas al Pushgateway: {e}")
 
-# Guardar estado actualizado
-save_state(STATE)
+# -------------------- Retención --------------------
+# Archivo por fecha y presupuestos de la carpeta de alertas (opcional, ver retention.py)
+RETENTION_POLICY = policy_from_settings(settings)
+
+# -------------------- Modos de ejecución --------------------
+def select_sites(site_ids: Optional[List[str]]) -> List[Site]:
+    known = CONFIG.current().sites_by_id
+    if not site_ids:
+        return list(known.values())
+    missing = [i for i in site_ids if i not in known]
+    if missing:
+        raise ValueError(f"Sitios desconocidos: {', '.join(missing)}")
+    return [known[i] for i in site_ids]
+
+def refresh_sites(sites: List[Site]) -> List[Site]:
+    """Los mismos sitios con los datos de la configuración vigente.
+
+    Carpeta y base de estado quedan las del arranque (el observador y los índices
+    ya están abiertos); un sitio que se quitó de Settings.json sigue como estaba.
+    """
+    known = CONFIG.current().sites_by_id
+    return [
+        known[site.id]._replace(folder=site.folder, state_db=site.state_db) if site.id in known else site
+        for site in sites
+    ]
+
+def label_backlog(sites: List[Site]):
+    """Guarda la etiqueta de las imágenes que entraron al índice sin despacharse.
+
+    Las que se despachan ya quedan etiquetadas; éstas son las que llegaron con el
+    proceso detenido o entre ejecuciones. Así el webhook responde "VER <objeto>" y
+    el historial sin leer EXIF en la consulta.
+    """
+    for site in sites:
+        try:
+            labeled = ALERT_INDEXES(site).label_pending()
+        except Exception as e:
+            print(f"[ERR] No se pudieron etiquetar las imágenes de {site.id}: {e}")
+            continue
+        if labeled:
+            print(f"[INFO] {labeled} imagen(es) de {site.id} etiquetadas")
+
+def run_once(sites: List[Site] = None):
+    """Envía la imagen más reciente de la carpeta de cada sitio y termina (modo clásico)."""
+    sites = sites or select_sites(None)
+    try:
+        held = []
+        for site in sites:
+            try:
+                if dispatch_alert(site, find_newest_image(site)) is None:
+                    held.append(site)
+            except Exception as e:
+                if len(sites) == 1:
+                    raise
+                print(f"[ERR] No se pudo procesar el sitio {site.id}: {e}")
+        # Enviar ya lo encolado (también lo que haya quedado de ejecuciones anteriores)
+        OUTBOX_WORKER.drain()
+        if held:
+            # Imágenes agrupadas: esperar el cierre de las ventanas y enviar los grupos,
+            # salvo que otra ejecución ya los haya reclamado.
+            closes_at = max((COALESCERS(site).closes_at(site.id) or 0) for site in held)
+            time.sleep(max(0.0, closes_at - time.time()))
+            flushed = [flush_coalesced(site) for site in held]
+            if any(result is not None for result in flushed):
+                OUTBOX_WORKER.drain()
+        label_backlog(sites)
+    finally:
+        export_metrics()
+
+def run_daemon(sites: List[Site] = None, poll_interval: float = None, use_events: bool = True):
+    """Queda escuchando las carpetas de los sitios y despacha cada imagen nueva al llegar.
+
+    El cliente de Twilio, la configuración y los índices se mantienen en memoria; un
+    único observador y un único pool de envío atienden a todos los sitios.
+    """
+    sites = sites or select_sites(None)
+    if poll_interval is None:
+        poll_interval = float(settings.get("watch_poll_interval", 0.5))
+
+    # systemd, contenedores y supervisores detienen con SIGTERM: salir con SystemExit
+    # para pasar por el `finally` (detener el observador y el pool, publicar métricas)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    OUTBOX_WORKER.start()
+    by_folder = {os.path.normpath(site.folder): site.id for site in sites}
+    pending = queue.Queue()
+    watcher = FolderWatcher(list(by_folder), pending.put, poll_interval=poll_interval, use_events=use_events)
+    watcher.start()
+    for site in sites:
+        ALERT_INDEXES(site)
+        print(f"[INFO] Modo daemon: escuchando {site.folder} ({site.id}, {watcher.mode})")
+
+    # La retención corre en su propio hilo, por lotes, sobre los mismos índices
+    retention = None
+    if RETENTION_POLICY is not None:
+        retention = RetentionWorker(RETENTION_POLICY, ArchiveCatalog(INDEX_DB), [ALERT_INDEXES(s) for s in sites])
+        retention.start()
+    # Lo acumulado con el daemon detenido se etiqueta sin demorar las alertas nuevas
+    threading.Thread(target=label_backlog, args=(sites,), name="etiquetas", daemon=True).start()
+
+    exporting = bool(METRICS_TEXTFILE or METRICS_PUSHGATEWAY_URL)
+    next_export = time.time()
+    try:
+        while True:
+            if exporting and time.time() >= next_export:
+                export_metrics()
+                next_export = time.time() + METRICS_INTERVAL
+            # Esperar la próxima imagen, el cierre de una ventana de agrupación o
+            # la próxima publicación de métricas
+            timeout = None
+            # Destinatarios, plantilla, tiempos, etc. pueden haber cambiado en Settings.json
+            sites = refresh_sites(sites)
+            closes_at = next_window_close(sites)
+            if closes_at is not None:
+                timeout = max(0.0, closes_at - time.time())
+            if exporting:
+                until_export = max(0.0, next_export - time.time())
+                timeout = until_export if timeout is None else min(timeout, until_export)
+            try:
+                image_path = pending.get(timeout=timeout)
+            except queue.Empty:
+                for site in sites:
+                    try:
+                        flush_coalesced(site)
+                    except Exception as e:
+                        print(f"[ERR] No se pudo enviar el grupo de imágenes de {site.id}: {e}")
+                continue
+            site_id = by_folder.get(os.path.dirname(os.path.normpath(image_path)))
+            site = next((s for s in sites if s.id == site_id), None)
+            if site is None:
+                continue
+            entry = ALERT_INDEXES(site).add(image_path)
+            if entry is None:
+                continue
+            try:
+                dispatch_alert(site, entry)
+            except Exception as e:
+                print(f"[ERR] No se pudo despachar {image_path}: {e}")
+    except KeyboardInterrupt:
+        print("[INFO] Deteniendo modo daemon…")
+    finally:
+        watcher.stop()
+        if retention is not None:
+            retention.stop()
+        OUTBOX_WORKER.stop()
+        export_metrics()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Envía alertas de WhatsApp con la imagen más reciente.")
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Queda escuchando la carpeta de alertas y envía cada imagen nueva al llegar.",
+    )
+    parser.add_argument(
+        "--poll",
+        action="store_true",
+        help="En modo daemon, fuerza el sondeo de la carpeta en lugar de eventos del sistema.",
+    )
+    parser.add_argument(
+        "--site",
+        action="append",
+        metavar="ID",
+        help="Atender sólo este sitio ('instance_id'); puede repetirse. Por defecto, todos.",
+    )
+    args = parser.parse_args(argv)
+
+    sites = select_sites(args.site)
+    if args.daemon:
+        run_daemon(sites, use_events=not args.poll)
+    else:
+        run_once(sites)
 
-print(
-    f"Resumen -> Plantillas: {sent_template}, Sesión: {sent_session}, Omitidos: {skipped}"
-) 
\ No newline at end of file
+if __name__ == "__main__":
+    main()
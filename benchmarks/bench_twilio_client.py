@@ -0,0 +1,72 @@
+"""Compara mensajes/segundo del cliente de Twilio sin y con pool de conexiones.
+
+Levanta el stub local de `fake_twilio.py` y envía N mensajes con la concurrencia
+indicada usando:
+
+- `sin_pool`: una conexión nueva por mensaje (como cada ejecución suelta del script),
+- `con_pool`: el cliente de `twilio_client.build_client` (sesión y pool keep-alive).
+
+    python benchmarks/bench_twilio_client.py --messages 500 --concurrency 8 --latency 0.02
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twilio.rest import Client  # noqa: E402
+
+from fake_twilio import start_in_background  # noqa: E402
+from twilio_client import PooledHttpClient  # noqa: E402
+
+ACCOUNT_SID = "AC" + "0" * 32
+
+
+def run(client: Client, messages: int, concurrency: int) -> float:
+    def send(i):
+        client.messages.create(from_="whatsapp:+10000000000", to=f"whatsapp:+1{i:010d}", body="bench")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, range(messages)))
+    return time.perf_counter() - start
+
+
+def bench(messages: int, concurrency: int, latency: float) -> dict:
+    server = start_in_background(latency=latency)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    modes = {
+        "sin_pool": PooledHttpClient(base_url=base_url, pool_connections=False, max_retries=0),
+        "con_pool": PooledHttpClient(base_url=base_url, pool_size=concurrency),
+    }
+    results = {}
+    try:
+        for name, http_client in modes.items():
+            client = Client(ACCOUNT_SID, "token", http_client=http_client)
+            conns_before = server.stats["connections"]
+            elapsed = run(client, messages, concurrency)
+            results[name] = {
+                "messages": messages,
+                "seconds": round(elapsed, 4),
+                "messages_per_second": round(messages / elapsed, 1),
+                "tcp_connections": server.stats["connections"] - conns_before,
+            }
+    finally:
+        server.shutdown()
+    return {"concurrency": concurrency, "latency": latency, "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del transporte HTTP del cliente de Twilio.")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.0, help="Latencia artificial del stub (s).")
+    args = parser.parse_args()
+    print(json.dumps(bench(args.messages, args.concurrency, args.latency), indent=2))
+
+
+if __name__ == "__main__":
+    main()
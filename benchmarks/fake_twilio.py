@@ -0,0 +1,117 @@
+"""Stub local de la API de mensajes de Twilio para benchmarks.
+
+Responde `POST /2010-04-01/Accounts/<sid>/Messages.json` con un mensaje en cola,
+con una latencia artificial configurable, y rechaza una fracción de los pedidos
+con 429 (límite de tasa) para ejercitar los reintentos. Mantiene las conexiones
+abiertas (HTTP/1.1) y cuenta conexiones TCP, mensajes aceptados y 429 enviados.
+
+    python benchmarks/fake_twilio.py --port 8990 --latency 0.05 --error-rate 0.1
+"""
+import argparse
+import http.server
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+
+
+class FakeTwilioHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Sin Nagle: cabeceras y cuerpo van en dos escrituras y, con keep-alive, el
+    # ACK diferido del cliente agregaría ~40 ms a cada respuesta.
+    disable_nagle_algorithm = True
+
+    # Se configuran en make_server()
+    latency = 0.0
+    error_rate = 0.0
+    stats = None
+
+    def setup(self):
+        super().setup()
+        with self.stats["lock"]:
+            self.stats["connections"] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        if self.latency:
+            time.sleep(self.latency)
+        if not self.path.endswith("/Messages.json"):
+            self._reply(404, {"code": 20404, "message": "Not found", "status": 404})
+            return
+        with self.stats["lock"]:
+            throttled = self.error_rate > 0 and self.stats["random"].random() < self.error_rate
+            self.stats["throttled" if throttled else "messages"] += 1
+        if throttled:
+            self._reply(429, {"code": 20429, "message": "Too Many Requests", "status": 429}, {"Retry-After": "1"})
+            return
+        sid = f"SM{next(self.stats['ids']):032x}"
+        self._reply(201, {"sid": sid, "status": "queued"})
+
+
+class FakeTwilioServer(http.server.ThreadingHTTPServer):
+    request_queue_size = 128
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clientes que cortan la conexión (ej. el webhook al terminar) no son errores del stub
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def make_server(
+    port: int = 0, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0
+) -> FakeTwilioServer:
+    """Crea el stub (puerto 0 = libre); `server.stats` acumula conexiones, mensajes y 429."""
+    stats = {
+        "lock": threading.Lock(),
+        "connections": 0,
+        "messages": 0,
+        "throttled": 0,
+        "ids": itertools.count(1),
+        "random": random.Random(seed),
+    }
+    handler = type(
+        "ConfiguredFakeTwilioHandler",
+        (FakeTwilioHandler,),
+        {"latency": latency, "error_rate": error_rate, "stats": stats},
+    )
+    server = FakeTwilioServer(("127.0.0.1", port), handler)
+    server.stats = stats
+    return server
+
+
+def start_in_background(port: int = 0, latency: float = 0.0, error_rate: float = 0.0) -> FakeTwilioServer:
+    server = make_server(port, latency, error_rate)
+    threading.Thread(target=server.serve_forever, name="fake-twilio", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub local de la API de mensajes de Twilio.")
+    parser.add_argument("--port", type=int, default=8990)
+    parser.add_argument("--latency", type=float, default=0.0, help="Segundos de demora por respuesta.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracción de pedidos rechazados con 429.")
+    args = parser.parse_args()
+    server = make_server(args.port, args.latency, args.error_rate)
+    print(f"Stub de Twilio en http://127.0.0.1:{server.server_address[1]}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Prueba de carga del webhook reproduciendo pedidos de Twilio.
+
+Reproduce los formularios grabados con 'webhook_record_file' (una línea JSON por
+pedido) o, si no se indica archivo, genera respuestas rápidas de plantilla como
+las que llegan tras un envío masivo. Informa latencias p50/p90/p99 y pedidos por
+segundo en JSON.
+
+    python benchmarks/load_webhook.py --url http://127.0.0.1:5004/webhook --requests 2000 --concurrency 200
+    python benchmarks/load_webhook.py --file webhook_posts.jsonl --concurrency 100
+
+Cada pedido reproducido recibe un MessageSid nuevo (salvo con --keep-sid), para
+que el webhook no los trate como reintentos del mismo mensaje; con --keep-sid se
+mide justamente el camino de los reintentos (respuesta desde la caché). Para no enviar
+mensajes reales, levantar el webhook con TWILIO_API_BASE_URL apuntando a
+`benchmarks/fake_twilio.py`.
+"""
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import requests
+
+QUICK_REPLIES = ["MOSTRAR ALERTAS (24 HS)", "ALERTAS", "VER", "PARAR", "MENU"]
+
+
+def load_posts(path: str) -> List[dict]:
+    posts = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                posts.append(json.loads(line)["form"])
+    return posts
+
+
+def synthetic_posts(senders: List[str], count: int) -> List[dict]:
+    """Respuestas rápidas de varios usuarios, como tras una plantilla enviada a todos."""
+    posts = []
+    for i, sender in zip(range(count), itertools.cycle(senders)):
+        body = QUICK_REPLIES[i % len(QUICK_REPLIES)]
+        posts.append({
+            "From": sender,
+            "To": "whatsapp:+10000000000",
+            "Body": body,
+            "ButtonText": body,
+            "NumMedia": "0",
+        })
+    return posts
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run(url: str, posts: List[dict], total: int, concurrency: int, keep_sid: bool) -> dict:
+    local = threading.local()
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def send(i):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        form = dict(posts[i % len(posts)])
+        if not keep_sid or "MessageSid" not in form:
+            form["MessageSid"] = "SM" + uuid.uuid4().hex
+        start = time.perf_counter()
+        try:
+            status = session.post(url, data=form, timeout=30).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            statuses[str(status)] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, range(total)))
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "url": url,
+        "requests": total,
+        "concurrency": concurrency,
+        "seconds": round(wall, 3),
+        "requests_per_second": round(total / wall, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p90": round(percentile(latencies, 90) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        },
+        "status": dict(statuses),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga del webhook de WhatsApp.")
+    parser.add_argument("--url", default="http://127.0.0.1:5000/webhook")
+    parser.add_argument("--file", help="Pedidos grabados con 'webhook_record_file' (JSON por línea).")
+    parser.add_argument("--requests", type=int, default=None, help="Total de pedidos (por defecto, los del archivo o 1000).")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--senders", nargs="*", help="Remitentes para los pedidos sintéticos (por defecto, 'recipients').")
+    parser.add_argument("--keep-sid", action="store_true", help="Reproducir el MessageSid grabado tal cual.")
+    args = parser.parse_args()
+
+    if args.file:
+        posts = load_posts(args.file)
+        total = args.requests or len(posts)
+    else:
+        senders = args.senders
+        if not senders:
+            settings_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Settings.json")
+            with open(settings_path, "r", encoding="utf-8") as f:
+                senders = [r for r in json.load(f).get("recipients", []) if r]
+        if not senders:
+            parser.error("Indicar --senders o completar 'recipients' en Settings.json.")
+        total = args.requests or 1000
+        posts = synthetic_posts(senders, total)
+    if not posts:
+        parser.error("No hay pedidos para reproducir.")
+
+    print(json.dumps(run(args.url, posts, total, args.concurrency, args.keep_sid), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,438 @@
+"""Suite de benchmarks de punta a punta.
+
+Genera carpetas de alertas sintéticas (JPEG con etiqueta EXIF ImageDescription),
+levanta el stub de Twilio de `fake_twilio.py` (con latencia y 429 configurables) y
+mide cada etapa del camino caliente:
+
+- `scan`: recorrido de la carpeta con el índice de `alerta_twilio.py` (frío, sin
+  cambios, con una imagen nueva y recarga desde SQLite), frente a un `listdir`.
+- `exif`: `extract_label_confidence` por imagen (sin caché y memoizado) y el
+  lector de PIL como referencia.
+- `state`: lectura y escritura del estado de los destinatarios.
+- `fanout`: una alerta repartida a todos los destinatarios por el outbox.
+- `webhook`: pedidos de respuesta rápida contra `twilio_webhook.py` en un proceso aparte.
+- `static`: descargas desde `carpeta_server.py`.
+
+Los resultados se escriben en JSON para comparar entre versiones:
+
+    python benchmarks/run_benchmarks.py --sizes 1000 10000 100000 --output actual.json
+    python benchmarks/run_benchmarks.py --output nuevo.json --compare actual.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from importlib.util import find_spec
+from typing import Dict, List
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import requests  # noqa: E402
+from PIL import Image  # noqa: E402
+from twilio.rest import Client  # noqa: E402
+
+import carpeta_server  # noqa: E402
+import exif_reader  # noqa: E402
+from alert_index import AlertIndex  # noqa: E402
+from fake_twilio import start_in_background  # noqa: E402
+from fanout import TokenBucket  # noqa: E402
+from load_webhook import percentile, run as run_load, synthetic_posts  # noqa: E402
+from outbox import Outbox, OutboxWorker  # noqa: E402
+from state_store import CachedStateStore, StateStore  # noqa: E402
+from twilio_client import PooledHttpClient  # noqa: E402
+
+STAGES = ["scan", "exif", "state", "fanout", "webhook", "static"]
+LABELS = ["person", "vehicle", "fire", "smoke", "nothing found"]
+ACCOUNT_SID = "AC" + "0" * 32
+FROM_WHATSAPP = "whatsapp:+10000000000"
+
+
+# -------------------- Utilidades --------------------
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def latency_ms(samples: List[float]) -> dict:
+    samples = sorted(samples)
+    return {
+        "p50": round(percentile(samples, 50) * 1000, 3),
+        "p99": round(percentile(samples, 99) * 1000, 3),
+        "max": round(samples[-1] * 1000, 3) if samples else 0.0,
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silencia los [OK]/[DEBUG] de los módulos mientras se mide."""
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def recipients(count: int) -> List[str]:
+    return [f"whatsapp:+5491100{i:06d}" for i in range(count)]
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return "desconocida"
+
+
+# -------------------- Carpetas sintéticas --------------------
+def jpeg_templates() -> List[bytes]:
+    """JPEG pequeños con distintas etiquetas EXIF; se copian para generar miles de archivos."""
+    templates = []
+    for i, label in enumerate(LABELS):
+        for confidence in (55, 72, 87, 96):
+            img = Image.new("RGB", (320, 240), (40 * i, confidence, 255 - confidence))
+            exif = Image.Exif()
+            exif[0x010E] = f"{label}: {confidence}%"
+            buf = io.BytesIO()
+            img.save(buf, format="JPEG", quality=70, exif=exif)
+            templates.append(buf.getvalue())
+    return templates
+
+
+def generate_alerts(folder: str, count: int) -> str:
+    """Crea (o reutiliza) una carpeta con `count` imágenes de alerta con mtimes crecientes."""
+    marker = os.path.join(folder, ".generado")
+    if os.path.exists(marker):
+        with open(marker, "r", encoding="utf-8") as f:
+            if f.read().strip() == str(count):
+                return folder
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    templates = jpeg_templates()
+    base = time.time() - count
+    for i in range(count):
+        path = os.path.join(folder, f"alerta_{i:06d}.jpg")
+        with open(path, "wb") as f:
+            f.write(templates[i % len(templates)])
+        os.utime(path, (base + i, base + i))
+    with open(marker, "w", encoding="utf-8") as f:
+        f.write(str(count))
+    return folder
+
+
+# -------------------- Etapas --------------------
+def bench_scan(folder: str, workdir: str) -> dict:
+    db_path = os.path.join(workdir, "scan_index.db")
+    for suffix in ("", "-wal", "-shm"):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(db_path + suffix)
+
+    naive, _ = timed(lambda: max(
+        (os.path.join(folder, n) for n in os.listdir(folder) if n.lower().endswith(".jpg")),
+        key=os.path.getmtime,
+    ))
+    index = AlertIndex(folder, db_path, exif_reader.extract_label_confidence)
+    cold, _ = timed(index.refresh)
+    warm, _ = timed(index.refresh)
+    newest, _ = timed(lambda: [index.newest() for _ in range(1000)])
+
+    new_file = os.path.join(folder, "alerta_nueva.jpg")
+    shutil.copyfile(os.path.join(folder, index.newest().name), new_file)
+    try:
+        incremental, _ = timed(index.refresh)
+    finally:
+        os.remove(new_file)
+    index.refresh()
+    reload, _ = timed(AlertIndex, folder, db_path, exif_reader.extract_label_confidence)
+    return {
+        "files": len(index),
+        "naive_listdir_seconds": round(naive, 4),
+        "index_cold_seconds": round(cold, 4),
+        "index_unchanged_seconds": round(warm, 6),
+        "index_new_file_seconds": round(incremental, 4),
+        "index_reload_seconds": round(reload, 4),
+        "newest_us": round(newest / 1000 * 1e6, 3),
+    }
+
+
+def bench_exif(folder: str, sample: int) -> dict:
+    names = sorted(n for n in os.listdir(folder) if n.endswith(".jpg"))[:sample]
+    paths = [os.path.join(folder, n) for n in names]
+    exif_reader._cached.cache_clear()
+    cold, _ = timed(lambda: [exif_reader.extract_label_confidence(p) for p in paths])
+    cached, _ = timed(lambda: [exif_reader.extract_label_confidence(p) for p in paths])
+    pil_paths = paths[:200]
+    pil, _ = timed(lambda: [exif_reader._read_description_pil(p) for p in pil_paths])
+    return {
+        "images": len(paths),
+        "extract_us": round(cold / len(paths) * 1e6, 2),
+        "extract_cached_us": round(cached / len(paths) * 1e6, 2),
+        "pil_reference_us": round(pil / len(pil_paths) * 1e6, 2),
+    }
+
+
+def bench_state(workdir: str, count: int) -> dict:
+    db_path = os.path.join(workdir, "bench_state.db")
+    for suffix in ("", "-wal", "-shm"):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(db_path + suffix)
+    dests = recipients(count)
+    store = StateStore(db_path)
+
+    def touch(user_state: dict):
+        user_state["last_template_sent"] = datetime.now(timezone.utc).isoformat()
+
+    batch_save, _ = timed(store.update_many, {d: touch for d in dests})
+    load, _ = timed(lambda: [store.get_many(dests) for _ in range(20)])
+    single_save, _ = timed(lambda: [store.update(d, touch) for d in dests])
+
+    cached = CachedStateStore(db_path, flush_interval=3600)
+    cached_update, _ = timed(lambda: [cached.update(d, touch) for d in dests])
+    flush, _ = timed(cached.flush)
+    cached.close()
+    return {
+        "recipients": count,
+        "load_all_seconds": round(load / 20, 6),
+        "save_batch_seconds": round(batch_save, 6),
+        "save_per_recipient_us": round(single_save / count * 1e6, 2),
+        "cached_update_us": round(cached_update / count * 1e6, 2),
+        "cached_flush_seconds": round(flush, 6),
+    }
+
+
+def bench_fanout(workdir: str, count: int, fake_url: str, fake_server, concurrency: int, mps: float) -> dict:
+    db_path = os.path.join(workdir, "bench_outbox.db")
+    for suffix in ("", "-wal", "-shm"):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(db_path + suffix)
+    client = Client(ACCOUNT_SID, "token", http_client=PooledHttpClient(base_url=fake_url, pool_size=concurrency))
+    outbox = Outbox(db_path, max_attempts=10, base_delay=0.05, max_delay=1.0)
+    worker = OutboxWorker(outbox, lambda params: client.messages.create(**params), concurrency, TokenBucket(mps))
+    throttled_before = fake_server.stats["throttled"]
+
+    start = time.perf_counter()
+    enqueue, _ = timed(lambda: [
+        outbox.enqueue(f"bench:{d}", {"from_": FROM_WHATSAPP, "to": d, "body": "Alerta de prueba"})
+        for d in recipients(count)
+    ])
+    with quiet():
+        while True:
+            worker.drain()
+            wait = outbox.next_due_in()
+            if wait is None:
+                break
+            time.sleep(wait)
+    total = time.perf_counter() - start
+
+    with sqlite3.connect(db_path) as db:
+        statuses = dict(db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+    return {
+        "recipients": count,
+        "concurrency": concurrency,
+        "enqueue_seconds": round(enqueue, 4),
+        "total_seconds": round(total, 4),
+        "messages_per_second": round(count / total, 1),
+        "throttled_429": fake_server.stats["throttled"] - throttled_before,
+        "statuses": statuses,
+    }
+
+
+def bench_static(folder: str, count: int, concurrency: int) -> dict:
+    names = sorted(n for n in os.listdir(folder) if n.endswith(".jpg"))[-200:]
+    server = carpeta_server.make_server(folder, 0, cache_bytes=32 * 1024 * 1024)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}/"
+    local = threading.local()
+    samples = []
+    lock = threading.Lock()
+
+    def fetch(i, conditional=False):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        url = base + names[i % len(names)]
+        headers = {}
+        if conditional:
+            headers["If-None-Match"] = session.head(url).headers.get("ETag", "")
+        start = time.perf_counter()
+        r = session.get(url, headers=headers)
+        elapsed = time.perf_counter() - start
+        r.content
+        with lock:
+            samples.append(elapsed)
+
+    results = {}
+    try:
+        with quiet():
+            for name, conditional in (("get", False), ("conditional_304", True)):
+                samples.clear()
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                    list(pool.map(lambda i: fetch(i, conditional), range(count)))
+                wall = time.perf_counter() - start
+                results[name] = {
+                    "requests": count,
+                    "requests_per_second": round(count / wall, 1),
+                    "latency_ms": latency_ms(samples),
+                }
+    finally:
+        server.shutdown()
+    return results
+
+
+def bench_webhook(folder: str, workdir: str, fake_url: str, count: int, concurrency: int, senders: int) -> dict:
+    """Levanta twilio_webhook.py en un directorio de trabajo con su propio Settings.json."""
+    app_dir = os.path.join(workdir, "webhook_app")
+    shutil.rmtree(app_dir, ignore_errors=True)
+    os.makedirs(app_dir)
+    for name in os.listdir(REPO_DIR):
+        if name.endswith(".py"):
+            shutil.copy(os.path.join(REPO_DIR, name), app_dir)
+    port = free_port()
+    dests = recipients(senders)
+    settings = {
+        "alerts_folder": folder,
+        "alerts_base_url": "http://127.0.0.1:8000",
+        "twilio_account_sid": ACCOUNT_SID,
+        "twilio_auth_token": "token",
+        "twilio_from_whatsapp": FROM_WHATSAPP,
+        "twilio_content_sid": "HX" + "0" * 32,
+        "recipients": dests,
+        "webhook_port": port,
+        "twilio_messages_per_second": 1000,
+    }
+    with open(os.path.join(app_dir, "Settings.json"), "w", encoding="utf-8") as f:
+        json.dump(settings, f)
+
+    env = dict(os.environ, TWILIO_API_BASE_URL=fake_url)
+    proc = subprocess.Popen(
+        [sys.executable, "twilio_webhook.py"], cwd=app_dir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.time() + 60
+        while True:
+            with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=1):
+                break
+            if proc.poll() is not None or time.time() > deadline:
+                raise RuntimeError("El webhook no arrancó")
+            time.sleep(0.1)
+        url = f"http://127.0.0.1:{port}/webhook"
+        result = run_load(url, synthetic_posts(dests, count), count, concurrency, False)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    result.pop("url", None)
+    result["server"] = "waitress" if find_spec("waitress") else "flask"
+    return result
+
+
+# -------------------- Comparación --------------------
+def flatten(data, prefix="") -> Dict[str, float]:
+    flat = {}
+    for key, value in data.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare(old: dict, new: dict):
+    """Imprime las métricas comunes a dos corridas con su cociente nuevo/anterior."""
+    old_flat, new_flat = flatten(old.get("results", {})), flatten(new.get("results", {}))
+    print(f"{'métrica':60} {'anterior':>12} {'nuevo':>12} {'cociente':>9}")
+    for key in sorted(old_flat.keys() & new_flat.keys()):
+        before, after = old_flat[key], new_flat[key]
+        ratio = f"{after / before:.2f}" if before else "-"
+        print(f"{key:60} {before:>12} {after:>12} {ratio:>9}")
+
+
+# -------------------- Principal --------------------
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de punta a punta de las alertas.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="Imágenes por carpeta sintética.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--recipients", type=int, default=200, help="Destinatarios para estado y reparto.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Envíos simultáneos del outbox.")
+    parser.add_argument("--messages-per-second", type=float, default=1000, help="Límite del token bucket en el reparto.")
+    parser.add_argument("--latency", type=float, default=0.02, help="Latencia del stub de Twilio (s).")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="Fracción de 429 del stub de Twilio.")
+    parser.add_argument("--exif-sample", type=int, default=2000, help="Imágenes leídas en la etapa exif.")
+    parser.add_argument("--requests", type=int, default=1000, help="Pedidos HTTP en webhook y static.")
+    parser.add_argument("--http-concurrency", type=int, default=50, help="Clientes simultáneos en webhook y static.")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "twilio_alerts_bench"),
+                        help="Carpeta de trabajo (las carpetas sintéticas se reutilizan entre corridas).")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="Resultados anteriores para comparar.")
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    fake = start_in_background(latency=args.latency, error_rate=args.error_rate)
+    fake_url = f"http://127.0.0.1:{fake.server_address[1]}"
+
+    results = {}
+    for size in args.sizes:
+        print(f"[INFO] Carpeta sintética de {size} imágenes...")
+        elapsed, folder = timed(generate_alerts, os.path.join(args.workdir, f"alerts_{size}"), size)
+        per_size = results[f"alerts_{size}"] = {"generate_seconds": round(elapsed, 2)}
+        if "scan" in args.stages:
+            per_size["scan"] = bench_scan(folder, args.workdir)
+        if "exif" in args.stages:
+            per_size["exif"] = bench_exif(folder, args.exif_sample)
+        if "static" in args.stages:
+            per_size["static"] = bench_static(folder, args.requests, args.http_concurrency)
+        if "webhook" in args.stages:
+            print(f"[INFO] Webhook con {size} imágenes...")
+            per_size["webhook"] = bench_webhook(
+                folder, args.workdir, fake_url, args.requests, args.http_concurrency, args.recipients
+            )
+    if "state" in args.stages:
+        results["state"] = bench_state(args.workdir, args.recipients)
+    if "fanout" in args.stages:
+        print("[INFO] Reparto por el outbox...")
+        results["fanout"] = bench_fanout(
+            args.workdir, args.recipients, fake_url, fake, args.concurrency, args.messages_per_second
+        )
+    fake.shutdown()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"[OK] Resultados en {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
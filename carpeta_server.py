@@ -1,24 +1,304 @@
-import http.server
-import socketserver
-import os
-import json
-
-# Ruta completa de la carpeta que querés exponer
-with open('Settings.json', 'r', encoding='utf-8') as f:
-    settings = json.load(f)
-directorio = settings.get('alerts_folder', r"D:\Alerts")
-
-# Puerto en el que se expondrá el servidor
-puerto = settings.get('static_server_port', 8880)
-
-# Cambiamos el directorio actual al que querés exponer
-os.chdir(directorio)
-
-# Usamos el manejador HTTP simple de Python
-handler = http.server.SimpleHTTPRequestHandler
-
-# Iniciamos el servidor
-with socketserver.TCPServer(("", puerto), handler) as httpd:
-    print(f"✅ Servidor activo en http://localhost:{puerto}/")
-    print(f"📂 Sirviendo archivos desde: {directorio}")
-    httpd.serve_forever()
\ No newline at end of file
+import http.server
+import os
+import mimetypes
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Optional, Tuple, Union
+from urllib.parse import unquote, urlsplit
+
+import config
+from media_variants import VARIANT_PREFIX, cache_from_settings, variant_from_settings
+from retention import ArchiveCatalog, policy_from_settings
+
+BASE_DIR = os.path.dirname(__file__)
+
+# Las imágenes de alerta no cambian una vez escritas: se pueden cachear un año
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class LRUCache:
+    """Caché LRU en memoria del contenido de los archivos más pedidos, acotada en bytes."""
+
+    def __init__(self, max_bytes: int, max_item_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[bytes]:
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, key, data: bytes):
+        if len(data) > self.max_item_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes and self._items:
+                _, old = self._items.popitem(last=False)
+                self._size -= len(old)
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Interpreta un encabezado `Range: bytes=...` de un solo rango.
+
+    Retorna (inicio, fin) inclusivos, o None si el rango no es satisfacible.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_s, _, end_s = spec.strip().partition("-")
+    try:
+        if not start_s:
+            # bytes=-N: los últimos N bytes
+            length = int(end_s)
+            if length <= 0:
+                return None
+            return max(0, size - length), size - 1
+        start = int(start_s)
+        end = int(end_s) if end_s else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+class AlertsHandler(http.server.BaseHTTPRequestHandler):
+    """Sirve los archivos de la carpeta de alertas (o de las carpetas de varios sitios).
+
+    Con varios sitios cada carpeta se publica bajo `/<instance_id>/`. Soporta
+    keep-alive, respuestas condicionales (ETag / Last-Modified → 304), rangos (206)
+    y envía el contenido con `sendfile` (copia cero). No genera listados de
+    directorios.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Sin Nagle: con keep-alive, cabeceras y cuerpo en escrituras separadas esperarían
+    # el ACK diferido del cliente (~40 ms por pedido)
+    disable_nagle_algorithm = True
+    server_version = "AlertsServer/1.0"
+
+    # Se configuran en make_server(). Prefijo de URL → carpeta ("" = un único sitio en la raíz)
+    directories: Dict[str, str] = {"": "."}
+    cache: Optional[LRUCache] = None
+    variants = {}
+    variant_cache = None
+    archive: Optional[ArchiveCatalog] = None
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def _safe_join(self, directory: str, rel: str) -> Optional[str]:
+        if not rel:
+            return None
+        root = os.path.realpath(directory)
+        path = os.path.realpath(os.path.join(root, rel))
+        if os.path.commonpath([root, path]) != root:
+            return None
+        return path
+
+    def _find(self, directory: str, rel: str) -> Optional[str]:
+        """Como `_safe_join`, pero una imagen ya archivada en AAAA/MM/DD se sigue encontrando por su nombre."""
+        path = self._safe_join(directory, rel)
+        if path is None or self.archive is None or "/" in rel or os.path.isfile(path):
+            return path
+        relpath = self.archive.lookup(directory, rel)
+        return self._safe_join(directory, relpath) if relpath else path
+
+    def _resolve(self) -> Optional[str]:
+        """Traduce la URL a una ruta dentro de la carpeta, o None si no es válida.
+
+        `/v/<variante>/<archivo>` se resuelve a la variante reducida de la caché,
+        generándola si hace falta; sólo se aceptan las variantes configuradas.
+        """
+        rel = unquote(urlsplit(self.path).path).lstrip("/")
+        parts = rel.split("/")
+        directory = self.directories.get("")
+        if directory is None:
+            directory = self.directories.get(parts[0])
+            if directory is None:
+                return None
+            parts = parts[1:]
+            rel = "/".join(parts)
+        if len(parts) == 3 and parts[0] == VARIANT_PREFIX and self.variant_cache is not None:
+            spec = self.variants.get(parts[1])
+            source = self._find(directory, parts[2]) if spec is not None else None
+            if source is None or not os.path.isfile(source):
+                return None
+            try:
+                return self.variant_cache.get(source, spec)
+            except Exception as e:
+                self.log_error("No se pudo generar la variante de %s: %s", source, e)
+                return None
+        return self._find(directory, rel)
+
+    def _serve(self, send_body: bool):
+        path = self._resolve()
+        try:
+            st = os.stat(path) if path else None
+        except OSError:
+            st = None
+        # Sin listados: los directorios (incluida la raíz) se responden como inexistentes
+        if st is None or not os.path.isfile(path):
+            self.send_error(404, "Archivo no encontrado")
+            return
+
+        size = st.st_size
+        etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+
+        if self._not_modified(etag, st.st_mtime):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("Cache-Control", CACHE_CONTROL)
+            self.end_headers()
+            return
+
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        if range_header and size > 0 and self.headers.get("If-Range", etag) in (etag, last_modified):
+            byte_range = parse_range(range_header, size)
+            if byte_range is None:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start, end = byte_range
+            status = 206
+        length = end - start + 1 if size else 0
+
+        self.send_response(status)
+        self.send_header("Content-Type", mimetypes.guess_type(path)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Cache-Control", CACHE_CONTROL)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+
+        if send_body and length:
+            self._send_content(path, (path, st.st_mtime_ns, size), start, length)
+
+    def _not_modified(self, etag: str, mtime: float) -> bool:
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _send_content(self, path: str, key, start: int, length: int):
+        cache = self.cache
+        data = cache.get(key) if cache is not None else None
+        if data is not None:
+            self.wfile.write(data[start:start + length])
+            return
+        with open(path, "rb") as f:
+            if cache is not None and key[2] <= cache.max_item_bytes:
+                data = f.read()
+                cache.put(key, data)
+                self.wfile.write(data[start:start + length])
+                return
+            self.wfile.flush()
+            self.connection.sendfile(f, start, length)
+
+
+class AlertsServer(http.server.ThreadingHTTPServer):
+    # Con la cola de 5 conexiones pendientes por defecto, una ráfaga de descargas
+    # (Twilio pide la imagen una vez por destinatario) pierde conexiones y cada una
+    # espera ~1 s a que el cliente reintente.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def make_server(
+    directories: Union[str, Dict[str, str]],
+    port: int,
+    cache_bytes: int = 0,
+    cache_item_bytes: int = 1024 * 1024,
+    variants=(),
+    variant_cache=None,
+    archive: Optional[ArchiveCatalog] = None,
+):
+    """Crea el servidor con hilos; `cache_bytes=0` desactiva la caché LRU.
+
+    `directories` es una carpeta, o un dict prefijo de URL → carpeta para varios sitios.
+    """
+    handler = type(
+        "ConfiguredAlertsHandler",
+        (AlertsHandler,),
+        {
+            "directories": {"": directories} if isinstance(directories, str) else dict(directories),
+            "cache": LRUCache(cache_bytes, cache_item_bytes) if cache_bytes > 0 else None,
+            "variants": {spec.name: spec for spec in variants},
+            "variant_cache": variant_cache,
+            "archive": archive,
+        },
+    )
+    return AlertsServer(("", port), handler)
+
+
+def main():
+    # Sólo carpetas y sitios: un equipo que sirve imágenes no necesita las credenciales de Twilio
+    cfg = config.load_config(twilio=False)
+    settings = cfg.settings
+    # Con varios sitios, cada carpeta se publica bajo /<instance_id>/
+    if cfg.multi_site:
+        directorios = {site.id: site.folder for site in cfg.sites}
+    else:
+        directorios = settings.get('alerts_folder', r"D:\Alerts")
+
+    # Puerto en el que se expondrá el servidor
+    puerto = settings.get('static_server_port', 8880)
+
+    # Caché en memoria de las imágenes recientes más pedidas (MB, 0 = desactivada)
+    cache_mb = settings.get('static_cache_mb', 32)
+
+    # Variante reducida para WhatsApp (ej. 1280 px, calidad 75), servida en /v/<variante>/<archivo>
+    variant = variant_from_settings(settings)
+    variant_cache = cache_from_settings(settings, BASE_DIR) if variant else None
+
+    # Con retención, las imágenes archivadas se buscan en el registro de alert_index.db
+    archive = ArchiveCatalog(os.path.join(BASE_DIR, 'alert_index.db')) if policy_from_settings(settings) else None
+
+    # Iniciamos el servidor
+    with make_server(
+        directorios,
+        puerto,
+        cache_bytes=int(cache_mb * 1024 * 1024),
+        variants=[variant] if variant else [],
+        variant_cache=variant_cache,
+        archive=archive,
+    ) as httpd:
+        print(f"✅ Servidor activo en http://localhost:{puerto}/")
+        if isinstance(directorios, str):
+            print(f"📂 Sirviendo archivos desde: {directorios}")
+        else:
+            for prefijo, carpeta in directorios.items():
+                print(f"📂 /{prefijo}/ → {carpeta}")
+        httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
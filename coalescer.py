@@ -0,0 +1,125 @@
+"""Agrupación de ráfagas de imágenes en una sola alerta.
+
+Un mismo movimiento suele generar muchas imágenes en pocos segundos. La primera
+imagen de un período tranquilo se envía de inmediato y abre una ventana de
+`coalesce_seconds`; las imágenes que llegan dentro de la ventana se acumulan y,
+al cerrarse, se envían juntas en un único mensaje por destinatario. Si la
+ráfaga continúa, cada envío agrupado abre la ventana siguiente.
+
+El estado de las ventanas se guarda en SQLite, así sobrevive a reinicios y lo
+comparten las ejecuciones sueltas de `alerta_twilio.py`.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+from typing import List, NamedTuple, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS coalesce_windows (
+    key TEXT PRIMARY KEY,
+    closes_at REAL NOT NULL,
+    frames TEXT NOT NULL
+);
+"""
+
+# Resultado de offer()
+SEND = "send"
+HELD = "held"
+
+
+class Frame(NamedTuple):
+    name: str
+    mtime: float
+    size: int
+    label: str
+    confidence: str
+
+
+def confidence_value(confidence: str) -> float:
+    """Convierte '87%' o '0.87' en un número comparable; 0 si no se puede leer."""
+    match = re.search(r"\d+(?:[.,]\d+)?", confidence or "")
+    if not match:
+        return 0.0
+    value = float(match.group(0).replace(",", "."))
+    return value * 100 if "%" not in confidence and value <= 1 else value
+
+
+def best_frame(frames: List[Frame]) -> Frame:
+    """La imagen de mayor confianza (la más reciente en caso de empate)."""
+    return max(frames, key=lambda f: (confidence_value(f.confidence), f.mtime))
+
+
+class Coalescer:
+    """Ventanas de agrupación persistentes, una por clave (instancia)."""
+
+    def __init__(self, db_path: str, window_seconds: float):
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    def _transaction(self, fn):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._db)
+                self._db.execute("COMMIT")
+                return result
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def offer(self, key: str, frame: Frame, now: float) -> str:
+        """Registra una imagen nueva.
+
+        Retorna SEND si abre una ventana (hay que enviarla ya) o HELD si quedó
+        acumulada para el envío agrupado al cierre de la ventana vigente.
+        """
+        def apply(db):
+            row = db.execute("SELECT closes_at, frames FROM coalesce_windows WHERE key = ?", (key,)).fetchone()
+            # Ventana abierta, o vencida con imágenes todavía sin enviar (ej. el proceso
+            # se cortó): la imagen se suma al envío agrupado.
+            if row is not None and (now < row[0] or row[1] != "[]"):
+                frames = json.loads(row[1])
+                frames.append(list(frame))
+                db.execute("UPDATE coalesce_windows SET frames = ? WHERE key = ?", (json.dumps(frames), key))
+                return HELD
+            db.execute(
+                "INSERT OR REPLACE INTO coalesce_windows (key, closes_at, frames) VALUES (?, ?, '[]')",
+                (key, now + self.window_seconds),
+            )
+            return SEND
+
+        return self._transaction(apply)
+
+    def closes_at(self, key: str) -> Optional[float]:
+        """Momento de cierre de la ventana con imágenes pendientes, o None si no hay."""
+        with self._lock:
+            row = self._db.execute("SELECT closes_at, frames FROM coalesce_windows WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] == "[]":
+            return None
+        return row[0]
+
+    def take_due(self, key: str, now: float) -> List[Frame]:
+        """Reclama las imágenes acumuladas de una ventana ya cerrada.
+
+        Es atómico entre procesos: sólo quien las reclama las envía. Al reclamarlas
+        se abre la ventana siguiente, para que una ráfaga que continúa siga agrupada.
+        """
+        def apply(db):
+            row = db.execute("SELECT closes_at, frames FROM coalesce_windows WHERE key = ?", (key,)).fetchone()
+            if row is None or now < row[0]:
+                return []
+            frames = [Frame(*f) for f in json.loads(row[1])]
+            if frames:
+                db.execute(
+                    "UPDATE coalesce_windows SET closes_at = ?, frames = '[]' WHERE key = ?",
+                    (now + self.window_seconds, key),
+                )
+            return frames
+
+        return self._transaction(apply)
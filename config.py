@@ -0,0 +1,254 @@
+"""Configuración compartida (Settings.json) con recarga en caliente.
+
+Settings.json se lee y valida una sola vez por versión del archivo y se convierte en
+una instantánea inmutable (`Config`) con todo lo derivado ya calculado: sitios,
+remitentes permitidos, tiempos como `timedelta`, URLs normalizadas y tablas de
+etiquetas. `ConfigSource.current()` revisa el mtime del archivo como mucho una
+vez por segundo; si cambió, arma una instantánea nueva y la reemplaza de forma
+atómica. Si la nueva versión no es válida se sigue usando la anterior.
+
+Se aplican sin reiniciar los datos de cada sitio (destinatarios, nombre,
+plantilla, número, tiempos, URL), las traducciones y los ajustes que se leen en
+cada envío o pedido. Credenciales, puertos, carpetas, la lista de sitios del
+daemon y los tamaños de pools y cachés se toman al arrancar.
+"""
+import json
+import os
+import threading
+import time
+import unicodedata
+from types import MappingProxyType
+from typing import Any, FrozenSet, Mapping, NamedTuple, Optional, Tuple
+
+from sites import Site, is_multi_site, load_sites, sites_by_recipient
+
+BASE_DIR = os.path.dirname(__file__)
+SETTINGS_PATH = os.path.join(BASE_DIR, "Settings.json")
+
+# Segundos entre revisiones del mtime de Settings.json
+CHECK_INTERVAL = 1.0
+
+# Etiquetas del detector (EXIF) -> texto de los mensajes; 'label_translations' agrega o reemplaza
+TRANSLATIONS = {
+    "person": "Persona",
+    "vehicle": "Vehículo",
+    "fire": "Fuego",
+    "smoke": "Humo",
+    "unknown": "Desconocido",
+    "nothing found": "No se detectaron objetos",
+    "no objects detected": "No se detectaron objetos",
+}
+
+REQUIRED_KEYS = ("twilio_account_sid", "twilio_auth_token")
+NUMERIC_KEYS = (
+    "template_cooldown_hours",
+    "session_duration_hours",
+    "coalesce_seconds",
+    "send_concurrency",
+    "twilio_messages_per_second",
+    "outbox_max_attempts",
+    "webhook_workers",
+    "webhook_threads",
+    "webhook_connection_limit",
+    "ver_max_images",
+    "near_duplicate_distance",
+    "near_duplicate_window",
+    "near_duplicate_seconds",
+    "archive_after_hours",
+    "retention_max_age_days",
+    "retention_max_mb",
+    "metrics_interval",
+    "watch_poll_interval",
+    "state_flush_interval",
+)
+# Con 0 el proceso se traba o queda en un bucle sin espera
+POSITIVE_KEYS = (
+    "send_concurrency",
+    "twilio_messages_per_second",
+    "webhook_workers",
+    "webhook_threads",
+    "webhook_connection_limit",
+    "metrics_interval",
+    "watch_poll_interval",
+    "state_flush_interval",
+)
+
+
+class ConfigError(ValueError):
+    """Settings.json no es válido."""
+
+
+def fold(text: str) -> str:
+    """Minúsculas y sin acentos, para comparar lo que escribe el usuario."""
+    return "".join(c for c in unicodedata.normalize("NFD", text.lower()) if not unicodedata.combining(c))
+
+
+class Config(NamedTuple):
+    """Instantánea inmutable de la configuración."""
+
+    settings: Mapping[str, Any]
+    sites: Tuple[Site, ...]
+    sites_by_id: Mapping[str, Site]
+    recipient_sites: Mapping[str, Tuple[Site, ...]]
+    allowed_senders: FrozenSet[str]
+    from_whatsapp: Optional[str]
+    multi_site: bool
+    translations: Mapping[str, str]
+    label_aliases: Mapping[str, str]
+    history_api_allowed: FrozenSet[str]
+    version: Tuple[int, int]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.settings.get(key, default)
+
+    def translate_label(self, label: str) -> str:
+        return self.translations.get(label.lower(), label)
+
+    def resolve_label(self, text: str) -> str:
+        """Nombre escrito por el usuario (en español o inglés, con o sin acentos) -> etiqueta del EXIF."""
+        text = text.strip()
+        return self.label_aliases.get(fold(text), text.lower())
+
+
+def _validate(settings: dict, twilio: bool) -> list:
+    problems = []
+    for key in REQUIRED_KEYS if twilio else ():
+        if not isinstance(settings.get(key), str) or not settings[key].strip():
+            problems.append(f"falta '{key}'")
+    scopes = [("", settings)] + [
+        (f"sites[{i}].", entry) for i, entry in enumerate(settings.get("sites") or [])
+        if isinstance(entry, dict)
+    ]
+    if not isinstance(settings.get("sites") or [], list) or any(
+        not isinstance(e, dict) for e in settings.get("sites") or []
+    ):
+        problems.append("'sites' debe ser una lista de objetos")
+    for prefix, scope in scopes:
+        for key in NUMERIC_KEYS:
+            value = scope.get(key)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+                problems.append(f"'{prefix}{key}' debe ser un número >= 0")
+            elif value == 0 and key in POSITIVE_KEYS:
+                problems.append(f"'{prefix}{key}' debe ser mayor que 0")
+        recipients = scope.get("recipients")
+        if recipients is not None and (
+            not isinstance(recipients, list) or not all(isinstance(r, str) for r in recipients)
+        ):
+            problems.append(f"'{prefix}recipients' debe ser una lista de textos")
+    if settings.get("label_translations") is not None and not isinstance(settings["label_translations"], dict):
+        problems.append("'label_translations' debe ser un objeto")
+    return problems
+
+
+def build_config(
+    settings: dict, base_dir: str = BASE_DIR, version: Tuple[int, int] = (0, 0), twilio: bool = True
+) -> Config:
+    """Valida `settings` y calcula las estructuras derivadas. Lanza ConfigError si no es válido.
+
+    Con `twilio=False` no se exigen credenciales, plantilla ni número (servidor de
+    archivos y herramientas que sólo usan carpetas y sitios).
+    """
+    problems = _validate(settings, twilio)
+    if problems:
+        raise ConfigError("Settings.json inválido: " + "; ".join(problems))
+    sites = tuple(load_sites(settings, base_dir))
+    for site in sites if twilio else ():
+        if not site.content_sid or not site.from_whatsapp:
+            raise ConfigError(f"Falta 'twilio_content_sid' o 'twilio_from_whatsapp' para el sitio {site.id}")
+
+    translations = dict(TRANSLATIONS)
+    translations.update({k.lower(): v for k, v in (settings.get("label_translations") or {}).items()})
+    aliases = {fold(raw): raw for raw in translations}
+    aliases.update({fold(text): raw for raw, text in translations.items()})
+
+    routes = sites_by_recipient(sites)
+    return Config(
+        settings=MappingProxyType(dict(settings)),
+        sites=sites,
+        sites_by_id=MappingProxyType({site.id: site for site in sites}),
+        recipient_sites=MappingProxyType({r: tuple(s) for r, s in routes.items()}),
+        allowed_senders=frozenset(routes),
+        from_whatsapp=settings.get("twilio_from_whatsapp") or sites[0].from_whatsapp,
+        multi_site=is_multi_site(settings),
+        translations=MappingProxyType(translations),
+        label_aliases=MappingProxyType(aliases),
+        history_api_allowed=frozenset({"127.0.0.1", "::1", *settings.get("history_api_allowed_ips", [])}),
+        version=version,
+    )
+
+
+def _file_version(path: str) -> Tuple[int, int]:
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def load_config(path: str = SETTINGS_PATH, base_dir: str = BASE_DIR, twilio: bool = True) -> Config:
+    """Lee y valida Settings.json una vez (para herramientas que no necesitan recarga)."""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No se encontró el archivo de configuración: {path}")
+    version = _file_version(path)
+    with open(path, "r", encoding="utf-8") as f:
+        settings = json.load(f)
+    return build_config(settings, base_dir, version, twilio)
+
+
+class ConfigSource:
+    """Entrega la instantánea vigente y la recarga cuando Settings.json cambia."""
+
+    def __init__(self, path: str = SETTINGS_PATH, base_dir: str = BASE_DIR, check_interval: float = CHECK_INTERVAL):
+        self.path = path
+        self.base_dir = base_dir
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._config = load_config(path, base_dir)
+        self._failed_version = None
+        self._next_check = time.monotonic() + check_interval
+
+    def current(self) -> Config:
+        if time.monotonic() >= self._next_check:
+            self._reload_if_changed()
+        return self._config
+
+    def _reload_if_changed(self):
+        with self._lock:
+            if time.monotonic() < self._next_check:
+                return
+            self._next_check = time.monotonic() + self.check_interval
+            try:
+                version = _file_version(self.path)
+            except OSError:
+                return
+            if version in (self._config.version, self._failed_version):
+                return
+            try:
+                config = load_config(self.path, self.base_dir)
+            except (OSError, ValueError) as e:  # JSONDecodeError y ConfigError son ValueError
+                self._failed_version = version
+                print(f"[ERR] No se aplicaron los cambios de {self.path}; se mantiene la configuración anterior: {e}")
+                return
+            # Reemplazo atómico: los pedidos en curso terminan con la instantánea que ya tenían
+            self._config = config
+            self._failed_version = None
+            print(f"[INFO] Configuración recargada desde {self.path}.")
+
+
+_source: Optional[ConfigSource] = None
+_source_lock = threading.Lock()
+
+
+def source() -> ConfigSource:
+    """Fuente compartida de Settings.json (se crea al primer uso)."""
+    global _source
+    if _source is None:
+        with _source_lock:
+            if _source is None:
+                _source = ConfigSource()
+    return _source
+
+
+def current() -> Config:
+    return source().current()
+
+
+def translate_label(label: str) -> str:
+    return current().translate_label(label)
@@ -0,0 +1,174 @@
+"""Lectura rápida de la etiqueta de detección (EXIF ImageDescription).
+
+En lugar de decodificar el EXIF completo con PIL, se leen los primeros KB del
+JPEG, se ubica el segmento APP1/Exif y se busca el tag ImageDescription (0x010E)
+en el IFD0 de la estructura TIFF. Si el archivo no tiene la forma esperada se
+recurre a PIL. Los resultados se memorizan por (ruta, mtime, tamaño).
+
+Uso por lotes (etiqueta las imágenes pendientes del índice con varios procesos):
+
+    python exif_reader.py [carpeta] [--workers N]
+"""
+import argparse
+import os
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Tuple
+
+from metrics import EXIF_PARSE_SECONDS
+
+# APP1 ocupa como máximo 64 KB y suele ser el primer segmento del archivo
+HEAD_BYTES = 64 * 1024
+IMAGE_DESCRIPTION = 0x010E
+NO_OBJECTS = "No se detectaron objetos"
+
+
+class _NotParsed(Exception):
+    """El archivo no tiene la estructura esperada; se usa PIL."""
+
+
+def _read_description(head: bytes) -> Optional[str]:
+    """Busca ImageDescription en el IFD0 del segmento APP1/Exif de `head`.
+
+    Retorna None si la imagen no tiene EXIF o el tag no está presente.
+    """
+    if head[:2] != b"\xff\xd8":
+        raise _NotParsed("no es un JPEG")
+    pos = 2
+    while pos + 4 <= len(head):
+        if head[pos] != 0xFF:
+            raise _NotParsed("marcador inválido")
+        marker = head[pos + 1]
+        if marker == 0xFF:  # relleno
+            pos += 1
+            continue
+        if marker in (0xDA, 0xD9):  # inicio de datos / fin de imagen: no hay EXIF
+            return None
+        (length,) = struct.unpack(">H", head[pos + 2:pos + 4])
+        segment = head[pos + 4:pos + 2 + length]
+        if marker == 0xE1 and segment[:6] == b"Exif\x00\x00":
+            if len(segment) < length - 2:
+                raise _NotParsed("segmento APP1 incompleto")
+            return _ifd0_description(segment[6:])
+        pos += 2 + length
+    raise _NotParsed("EXIF fuera de la cabecera leída")
+
+
+def _ifd0_description(tiff: bytes) -> Optional[str]:
+    order = tiff[:2]
+    if order == b"II":
+        endian = "<"
+    elif order == b"MM":
+        endian = ">"
+    else:
+        raise _NotParsed("cabecera TIFF inválida")
+    magic, ifd_offset = struct.unpack(endian + "HI", tiff[2:8])
+    if magic != 42:
+        raise _NotParsed("cabecera TIFF inválida")
+    (count,) = struct.unpack(endian + "H", tiff[ifd_offset:ifd_offset + 2])
+    for i in range(count):
+        entry = ifd_offset + 2 + i * 12
+        tag, typ, n = struct.unpack(endian + "HHI", tiff[entry:entry + 8])
+        if tag != IMAGE_DESCRIPTION:
+            continue
+        if typ not in (1, 2, 7):  # BYTE, ASCII, UNDEFINED
+            raise _NotParsed("tipo inesperado para ImageDescription")
+        if n <= 4:
+            raw = tiff[entry + 8:entry + 8 + n]
+        else:
+            (offset,) = struct.unpack(endian + "I", tiff[entry + 8:entry + 12])
+            raw = tiff[offset:offset + n]
+            if len(raw) < n:
+                raise _NotParsed("valor fuera del segmento")
+        return raw.split(b"\x00", 1)[0].decode("utf-8", errors="replace")
+    return None
+
+
+def _read_description_pil(image_path: str) -> Optional[str]:
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        val = img.getexif().get(IMAGE_DESCRIPTION)
+    if val is None:
+        return None
+    return val.decode("utf-8") if isinstance(val, bytes) else str(val)
+
+
+def _parse_description(description: Optional[str]) -> Tuple[str, str]:
+    if not description:
+        return NO_OBJECTS, ""
+    if ":" in description:
+        label, confidence = description.split(":", 1)
+        return label.strip(), confidence.strip()
+    return description.strip(), "0%"
+
+
+def read_label_confidence(image_path: str) -> Tuple[str, str]:
+    """Extrae etiqueta y confianza sin memorizar el resultado."""
+    start = time.perf_counter()
+    try:
+        with open(image_path, "rb") as f:
+            head = f.read(HEAD_BYTES)
+        try:
+            description = _read_description(head)
+        except (_NotParsed, struct.error, UnicodeDecodeError):
+            description = _read_description_pil(image_path)
+        return _parse_description(description)
+    except Exception as e:
+        return f"Error: {e}", ""
+    finally:
+        EXIF_PARSE_SECONDS.observe(time.perf_counter() - start)
+
+
+@lru_cache(maxsize=4096)
+def _cached(image_path: str, mtime_ns: int, size: int) -> Tuple[str, str]:
+    return read_label_confidence(image_path)
+
+
+def extract_label_confidence(image_path: str) -> Tuple[str, str]:
+    """Extrae la etiqueta y confianza del EXIF ImageDescription.
+
+    Memorizado por (ruta, mtime, tamaño): si el archivo cambia se vuelve a leer.
+    """
+    try:
+        st = os.stat(image_path)
+    except OSError as e:
+        return f"Error: {e}", ""
+    return _cached(image_path, st.st_mtime_ns, st.st_size)
+
+
+def extract_many(paths: Iterable[str], workers: Optional[int] = None) -> Dict[str, Tuple[str, str]]:
+    """Extrae etiquetas de muchas imágenes en paralelo con un pool de procesos."""
+    paths = list(paths)
+    if not paths:
+        return {}
+    chunksize = max(1, min(256, len(paths) // ((workers or os.cpu_count() or 1) * 4)))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(paths, pool.map(read_label_confidence, paths, chunksize=chunksize)))
+
+
+def main(argv=None):
+    import config
+    from alert_index import AlertIndex
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    settings = config.load_config(twilio=False).settings
+
+    parser = argparse.ArgumentParser(description="Etiqueta en lote las imágenes pendientes del índice de alertas.")
+    parser.add_argument("folder", nargs="?", default=settings.get("alerts_folder", "./alerts"))
+    parser.add_argument("--workers", type=int, default=None, help="Procesos a usar (por defecto, uno por CPU).")
+    args = parser.parse_args(argv)
+
+    index = AlertIndex(args.folder, os.path.join(base_dir, "alert_index.db"), extract_label_confidence)
+    index.refresh()
+    pending = index.unlabeled()
+    print(f"[INFO] Imágenes sin etiquetar: {len(pending)} de {len(index)}")
+    labels = extract_many((index.path(e) for e in pending), workers=args.workers)
+    index.set_labels({os.path.basename(path): result for path, result in labels.items()})
+    print(f"[OK] Etiquetas guardadas: {len(labels)}")
+
+
+if __name__ == "__main__":
+    main()
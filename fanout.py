@@ -0,0 +1,45 @@
+"""Herramientas de concurrencia para los envíos a Twilio.
+
+- `CoalescingExecutor`: pool acotado que colapsa las tareas pendientes repetidas.
+
+El límite de mensajes por segundo lo aplica `outbox.SharedTokenBucket`, compartido
+entre procesos.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Tuple
+
+
+class CoalescingExecutor:
+    """Pool de hilos acotado con a lo sumo una tarea pendiente por clave.
+
+    Si llega una tarea para una clave que todavía espera turno, reemplaza a la
+    anterior (gana la última): diez pedidos iguales seguidos se ejecutan una sola
+    vez. Como la cola tiene como máximo una entrada por clave, su tamaño queda
+    acotado por la cantidad de claves distintas.
+    """
+
+    def __init__(self, max_workers: int = 4, name: str = "tareas"):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(max_workers)), thread_name_prefix=name)
+        self._pending: Dict[Hashable, Tuple[Callable, tuple, dict]] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: Hashable, fn: Callable, *args, **kwargs) -> bool:
+        """Programa `fn(*args, **kwargs)`. Retorna False si se colapsó con una pendiente."""
+        with self._lock:
+            collapsed = key in self._pending
+            self._pending[key] = (fn, args, kwargs)
+        if not collapsed:
+            self._executor.submit(self._run, key)
+        return not collapsed
+
+    def _run(self, key: Hashable):
+        with self._lock:
+            fn, args, kwargs = self._pending.pop(key)
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            print(f"[ERR] Falló la tarea {key}: {e}")
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
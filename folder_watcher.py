@@ -0,0 +1,206 @@
+"""Observador de las carpetas de alertas para el modo daemon.
+
+Usa watchdog (inotify en Linux, ReadDirectoryChangesW en Windows) si está
+instalado; si no, recurre a un sondeo liviano basado en el mtime del directorio.
+Un mismo observador (y un único hilo de fondo) vigila todas las carpetas.
+"""
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional, Tuple, Union
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # watchdog es opcional
+    FileSystemEventHandler = object
+    Observer = None
+
+from alert_index import is_alert_image
+
+
+class _EventHandler(FileSystemEventHandler):
+    """Traduce los eventos de watchdog a llamadas del observador."""
+
+    def __init__(self, watcher: "FolderWatcher"):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_closed(self, event):
+        # IN_CLOSE_WRITE: el archivo terminó de escribirse, se despacha sin espera.
+        if not event.is_directory:
+            self.watcher.emit(event.src_path)
+
+    def on_moved(self, event):
+        # Un rename es atómico: el archivo destino ya está completo.
+        if not event.is_directory:
+            self.watcher.emit(event.dest_path)
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.watcher.track(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.watcher.track(event.src_path)
+
+
+class FolderWatcher:
+    """Detecta imágenes nuevas en una o varias carpetas y llama a `on_new_file(path)` una vez por archivo.
+
+    Los archivos sin evento de cierre (Windows o modo sondeo) se despachan cuando su
+    tamaño se mantiene estable durante `settle_seconds`. Cada `prune_interval`
+    segundos se olvidan los archivos despachados que ya no están en la carpeta
+    (archivados o borrados), así la memoria no crece con los días del daemon.
+    """
+
+    def __init__(
+        self,
+        folders: Union[str, Iterable[str]],
+        on_new_file: Callable[[str], None],
+        poll_interval: float = 0.5,
+        settle_seconds: float = 0.2,
+        use_events: bool = True,
+        prune_interval: float = 300.0,
+    ):
+        self.folders = [os.path.normpath(f) for f in ([folders] if isinstance(folders, str) else folders)]
+        self.on_new_file = on_new_file
+        self.poll_interval = poll_interval
+        self.settle_seconds = settle_seconds
+        self.prune_interval = prune_interval
+        self.use_events = use_events and Observer is not None
+        self.mode = "eventos" if self.use_events else "sondeo"
+
+        self._seen = set()
+        self._pending: Dict[str, Tuple[int, float]] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._observer = None
+        self._thread: Optional[threading.Thread] = None
+        self._dir_mtimes: Dict[str, Optional[int]] = {}
+
+    # -------------------- Ciclo de vida --------------------
+    def start(self):
+        for folder in self.folders:
+            if not os.path.isdir(folder):
+                raise NotADirectoryError(f"El directorio de alertas no existe: {folder}")
+
+        # Lo que ya existe al arrancar no se considera nuevo
+        for folder in self.folders:
+            self._dir_mtimes[folder] = self._folder_mtime(folder)
+            with os.scandir(folder) as it:
+                self._seen.update(
+                    os.path.join(folder, e.name) for e in it if e.is_file() and is_alert_image(e.name)
+                )
+
+        if self.use_events:
+            self._observer = Observer()
+            handler = _EventHandler(self)
+            for folder in self.folders:
+                self._observer.schedule(handler, folder, recursive=False)
+            self._observer.start()
+
+        self._thread = threading.Thread(target=self._run, name="folder-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+        if self._thread is not None:
+            self._thread.join()
+
+    # -------------------- Entrada de eventos --------------------
+    def emit(self, path: str):
+        """Despacha `path` si es una imagen que todavía no se procesó."""
+        path = os.path.normpath(path)
+        if not is_alert_image(path):
+            return
+        with self._lock:
+            if path in self._seen:
+                return
+            self._seen.add(path)
+            self._pending.pop(path, None)
+        try:
+            self.on_new_file(path)
+        except Exception as e:
+            print(f"[ERR] Falló el procesamiento de {path}: {e}")
+
+    def track(self, path: str):
+        """Registra un archivo que puede estar escribiéndose todavía."""
+        path = os.path.normpath(path)
+        if not is_alert_image(path):
+            return
+        with self._lock:
+            if path in self._seen or path in self._pending:
+                return
+            self._pending[path] = (-1, time.monotonic())
+
+    # -------------------- Hilo de fondo --------------------
+    @staticmethod
+    def _folder_mtime(folder: str):
+        try:
+            return os.stat(folder).st_mtime_ns
+        except OSError:
+            return None
+
+    def _scan(self):
+        """Sondeo: sólo recorre las carpetas cuyo mtime cambió."""
+        for folder in self.folders:
+            mtime = self._folder_mtime(folder)
+            if mtime == self._dir_mtimes.get(folder):
+                continue
+            self._dir_mtimes[folder] = mtime
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        if entry.is_file() and os.path.join(folder, entry.name) not in self._seen:
+                            self.track(entry.path)
+            except OSError as e:
+                print(f"[WARN] No se pudo recorrer {folder}: {e}")
+
+    def _prune(self):
+        """Olvida los archivos ya despachados que no siguen en su carpeta."""
+        # Se recorre con el lock tomado: todo lo que `emit` agregó antes ya existe en disco
+        with self._lock:
+            present = set()
+            for folder in self.folders:
+                try:
+                    with os.scandir(folder) as it:
+                        present.update(os.path.join(folder, e.name) for e in it)
+                except OSError:
+                    return
+            self._seen &= present
+
+    def _settle(self):
+        """Despacha los archivos cuyo tamaño no cambió desde la última revisión."""
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for path, (size, since) in list(self._pending.items()):
+                try:
+                    current = os.path.getsize(path)
+                except OSError:
+                    del self._pending[path]
+                    continue
+                if current != size:
+                    self._pending[path] = (current, now)
+                elif current > 0 and now - since >= self.settle_seconds:
+                    ready.append(path)
+        for path in ready:
+            self.emit(path)
+
+    def _run(self):
+        interval = min(self.poll_interval, self.settle_seconds) if not self.use_events else self.settle_seconds
+        last_scan = 0.0
+        next_prune = time.monotonic() + self.prune_interval
+        while not self._stop.wait(interval / 2):
+            if not self.use_events and time.monotonic() - last_scan >= self.poll_interval:
+                last_scan = time.monotonic()
+                self._scan()
+            if time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + self.prune_interval
+                self._prune()
+            if self._pending:
+                self._settle()
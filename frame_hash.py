@@ -0,0 +1,78 @@
+"""Hash perceptual (dHash) de las imágenes para descartar cuadros casi idénticos.
+
+Las cámaras suelen guardar varias imágenes casi iguales de una escena quieta
+(ramas que se mueven, cambios de luz). El dHash reduce la imagen a 9x8 grises y
+guarda en 64 bits si cada píxel es más claro que su vecino; dos imágenes de la
+misma escena difieren en pocos bits (distancia de Hamming). El JPEG se decodifica
+ya reducido (`draft`), así el costo es una fracción de abrirlo a tamaño completo.
+El hash de cada imagen se guarda en el índice de alertas y se calcula una sola vez.
+"""
+from typing import Optional
+
+from PIL import Image
+
+try:
+    import numpy as np
+except ImportError:  # numpy es opcional: sin él se compara en Python puro
+    np = None
+
+from alert_index import AlertEntry, AlertIndex
+
+HASH_SIZE = 8
+
+
+def dhash(path: str, hash_size: int = HASH_SIZE) -> Optional[int]:
+    """dHash de `hash_size`² bits de la imagen, o None si no se puede leer."""
+    try:
+        with Image.open(path) as img:
+            # Decodificar el JPEG ya reducido (1/2 a 1/8) en lugar de a resolución completa
+            img.draft("L", (hash_size * 8, hash_size * 8))
+            small = img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    except Exception as e:
+        print(f"[WARN] No se pudo calcular el hash de {path}: {e}")
+        return None
+    if np is not None:
+        pixels = np.asarray(small, dtype=np.int16)
+        bits = np.packbits((pixels[:, 1:] > pixels[:, :-1]).ravel())
+        return int.from_bytes(bits.tobytes(), "big")
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col + 1] > pixels[offset + col])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def find_near_duplicate(
+    index: AlertIndex, entry: AlertEntry, max_distance: int, window: int, window_seconds: float
+) -> Optional[AlertEntry]:
+    """Compara `entry` con la última imagen enviada de la misma etiqueta (entre las
+    últimas `window` de los `window_seconds` anteriores) y la retorna si su hash
+    difiere en `max_distance` bits o menos.
+
+    Las imágenes descartadas como casi iguales no sirven de referencia: si no, una
+    escena que cambia de a poco encadenaría descartes sin fin.
+    `entry` debe venir con la etiqueta ya leída (`AlertIndex.describe`).
+    """
+    recent = index.between(entry.mtime - window_seconds, entry.mtime)[-window:]
+    if not recent:
+        return None
+    entry = index.fingerprint(entry, dhash)
+    if entry.phash is None:
+        return None
+    for other in reversed(recent):
+        if other.name == entry.name or other.duplicate:
+            continue
+        other = index.describe(other)
+        if other.label != entry.label:
+            continue
+        other = index.fingerprint(other, dhash)
+        if other.phash is not None and hamming(entry.phash, other.phash) <= max_distance:
+            return other
+        return None
+    return None
@@ -0,0 +1,170 @@
+"""Variantes reducidas de las imágenes de alerta con caché LRU en disco.
+
+Las fotos de las cámaras se guardan a resolución completa; para WhatsApp se
+genera una sola vez una copia redimensionada y recomprimida (por ejemplo 1280 px
+a calidad 75) que queda en `media_cache_dir`. La clave de la caché es
+(nombre, mtime, variante), así que si la imagen original cambia se genera una
+variante nueva. Cuando la carpeta supera su tamaño máximo se eliminan primero las
+variantes usadas hace más tiempo.
+"""
+import os
+import tempfile
+import threading
+from typing import NamedTuple, Optional
+
+from PIL import Image, ImageOps
+
+# Prefijo de las URLs de variantes en el servidor de archivos: /v/<variante>/<archivo>
+VARIANT_PREFIX = "v"
+
+
+class VariantSpec(NamedTuple):
+    max_px: int
+    quality: int
+
+    @property
+    def name(self) -> str:
+        return f"{self.max_px}q{self.quality}"
+
+
+def variant_from_settings(settings: dict) -> Optional[VariantSpec]:
+    """Lee `media_variant` de Settings.json; None si no está configurada."""
+    cfg = settings.get("media_variant")
+    if not cfg:
+        return None
+    return VariantSpec(int(cfg.get("max_px", 1280)), int(cfg.get("quality", 75)))
+
+
+def normalize_base_url(base_url: str) -> str:
+    base = base_url.rstrip("/")
+    if not base.startswith("http://") and not base.startswith("https://"):
+        base = "https://" + base
+    return base
+
+
+def media_url(base_url: str, filename: str, spec: Optional[VariantSpec] = None) -> str:
+    """URL pública de una imagen, o de su variante si se indica `spec`."""
+    base = normalize_base_url(base_url)
+    if spec is None:
+        return f"{base}/{filename}"
+    return f"{base}/{VARIANT_PREFIX}/{spec.name}/{filename}"
+
+
+def prepared_media_url(
+    base_url: str, source_path: str, spec: Optional[VariantSpec] = None, cache: Optional["VariantCache"] = None
+) -> str:
+    """URL a enviarle a Twilio para `source_path`.
+
+    Con variante, la genera antes de enviar para que la primera descarga ya la
+    encuentre en la caché; si no se puede generar se usa la URL del original.
+    """
+    filename = os.path.basename(source_path)
+    if spec is not None and cache is not None:
+        try:
+            cache.get(source_path, spec)
+        except Exception as e:
+            print(f"[WARN] No se pudo generar la variante de {source_path}; se enviará el original: {e}")
+            spec = None
+    else:
+        spec = None
+    return media_url(base_url, filename, spec)
+
+
+class VariantCache:
+    """Caché en disco de variantes, acotada en bytes y con desalojo LRU.
+
+    El uso de cada variante se registra actualizando su mtime, de modo que el
+    orden LRU se comparte entre procesos (el envío de alertas la genera y el
+    servidor de archivos la sirve).
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._size = self._scan_size()
+
+    def _scan_size(self) -> int:
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for e in it:
+                if e.is_file():
+                    total += e.stat().st_size
+        return total
+
+    def variant_path(self, source_path: str, spec: VariantSpec) -> str:
+        stem = os.path.splitext(os.path.basename(source_path))[0]
+        mtime_ns = os.stat(source_path).st_mtime_ns
+        return os.path.join(self.cache_dir, f"{stem}-{mtime_ns:x}-{spec.name}.jpg")
+
+    def get(self, source_path: str, spec: VariantSpec) -> str:
+        """Ruta de la variante de `source_path`, generándola si todavía no existe."""
+        path = self.variant_path(source_path, spec)
+        try:
+            os.utime(path)  # marca de uso para el orden LRU
+            return path
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(path, threading.Lock())
+        with key_lock:
+            if not os.path.exists(path):
+                size = self._render(source_path, path, spec)
+                with self._lock:
+                    self._size += size
+                    over_budget = self._size > self.max_bytes
+                if over_budget:
+                    self._evict(keep=path)
+        with self._lock:
+            self._key_locks.pop(path, None)
+        return path
+
+    def _render(self, source_path: str, path: str, spec: VariantSpec) -> int:
+        with Image.open(source_path) as img:
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((spec.max_px, spec.max_px), Image.LANCZOS)
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            # Escritura atómica: nadie debe servir una variante a medio escribir
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    img.save(f, "JPEG", quality=spec.quality, optimize=True, progressive=True)
+                os.replace(tmp, path)
+            except Exception:
+                os.unlink(tmp)
+                raise
+        return os.path.getsize(path)
+
+    def _evict(self, keep: str):
+        """Elimina las variantes menos usadas hasta volver al tamaño máximo."""
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for e in it:
+                if e.is_file():
+                    st = e.stat()
+                    total += st.st_size
+                    entries.append((st.st_mtime, st.st_size, e.path))
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._size = total
+
+
+def cache_from_settings(settings: dict, base_dir: str) -> VariantCache:
+    cache_dir = settings.get("media_cache_dir") or os.path.join(base_dir, "media_cache")
+    max_bytes = int(settings.get("media_cache_mb", 512) * 1024 * 1024)
+    return VariantCache(cache_dir, max_bytes)
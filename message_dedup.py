@@ -0,0 +1,126 @@
+"""Deduplicación de los mensajes entrantes del webhook por `MessageSid`.
+
+Twilio reintenta la entrega cuando la respuesta tarda, justo cuando el webhook está
+más cargado. El primer pedido de cada `MessageSid` lo reclama (INSERT atómico en
+SQLite, válido también entre varios procesos) y al terminar guarda su TwiML; un
+reintento recibe esa misma respuesta sin volver a tocar el estado ni encolar envíos.
+
+Si el proceso que reclamó un `MessageSid` se corta antes de guardar la respuesta,
+pasado `processing_timeout` el siguiente reintento lo reclama y lo procesa.
+
+Los `MessageSid` vistos se mantienen en memoria (acotados) delante de la base, y la
+base se depura por antigüedad (`ttl_seconds`) y por cantidad (`max_entries`), así
+sobrevive a reinicios sin crecer sin límite.
+"""
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen_messages (
+    sid TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    response TEXT
+);
+CREATE INDEX IF NOT EXISTS seen_messages_created ON seen_messages (created_at);
+"""
+
+# Respuesta mientras el primer pedido todavía se está procesando
+PENDING_RESPONSE = "<Response></Response>"
+
+
+class MessageDedup:
+    """Caché de respuestas por `MessageSid` con vencimiento y tamaño acotado."""
+
+    def __init__(
+        self,
+        db_path: str,
+        ttl_seconds: float = 86400,
+        max_entries: int = 50000,
+        purge_every: float = 60.0,
+        processing_timeout: float = 60.0,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.processing_timeout = min(processing_timeout, ttl_seconds)
+        self.max_entries = max_entries
+        self.purge_every = purge_every
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        # sid -> (created_at, respuesta o None si está en proceso), en orden de llegada
+        self._recent: "OrderedDict[str, tuple]" = OrderedDict()
+        self._next_purge = 0.0
+
+    def claim(self, sid: str) -> Optional[str]:
+        """Reclama `sid`. Retorna None si es la primera vez (hay que procesarlo), o la
+        respuesta a repetir si ya se vio (la de espera si aún está en proceso)."""
+        now = time.time()
+        with self._lock:
+            cached = self._recent.get(sid)
+            if cached is not None and self._holds(cached, now):
+                return cached[1] or PENDING_RESPONSE
+
+            cur = self._db.execute(
+                "INSERT OR IGNORE INTO seen_messages (sid, created_at) VALUES (?, ?)", (sid, now)
+            )
+            if cur.rowcount == 0:
+                row = self._db.execute(
+                    "SELECT created_at, response FROM seen_messages WHERE sid = ?", (sid,)
+                ).fetchone()
+                if row is not None and self._holds(row, now):
+                    self._remember(sid, row[0], row[1])
+                    return row[1] or PENDING_RESPONSE
+                # Vencido, o quien lo reclamó no respondió a tiempo: se procesa como nuevo.
+                # Se reclama sólo si la fila sigue igual, por si otro proceso se adelantó.
+                if row is None:
+                    cur = self._db.execute(
+                        "INSERT OR IGNORE INTO seen_messages (sid, created_at) VALUES (?, ?)", (sid, now)
+                    )
+                else:
+                    cur = self._db.execute(
+                        "UPDATE seen_messages SET created_at = ?, response = NULL WHERE sid = ? AND created_at = ?",
+                        (now, sid, row[0]),
+                    )
+                if cur.rowcount == 0:
+                    return PENDING_RESPONSE
+            self._remember(sid, now, None)
+            if now >= self._next_purge:
+                self._purge(now)
+            return None
+
+    def _holds(self, seen: tuple, now: float) -> bool:
+        """True si el `(created_at, respuesta)` todavía vale: vigente y respondido, o en proceso."""
+        created_at, response = seen
+        return now - created_at < (self.ttl_seconds if response is not None else self.processing_timeout)
+
+    def complete(self, sid: str, response: str):
+        """Guarda la respuesta del primer pedido para repetírsela a los reintentos."""
+        with self._lock:
+            cached = self._recent.get(sid)
+            self._remember(sid, cached[0] if cached else time.time(), response)
+            self._db.execute("UPDATE seen_messages SET response = ? WHERE sid = ?", (response, sid))
+
+    def release(self, sid: str):
+        """Libera un `sid` cuyo procesamiento falló, para que el reintento de Twilio lo procese."""
+        with self._lock:
+            self._recent.pop(sid, None)
+            self._db.execute("DELETE FROM seen_messages WHERE sid = ?", (sid,))
+
+    def _remember(self, sid: str, created_at: float, response: Optional[str]):
+        self._recent[sid] = (created_at, response)
+        self._recent.move_to_end(sid)
+        while len(self._recent) > self.max_entries:
+            self._recent.popitem(last=False)
+
+    def _purge(self, now: float):
+        self._next_purge = now + self.purge_every
+        self._db.execute("DELETE FROM seen_messages WHERE created_at < ?", (now - self.ttl_seconds,))
+        self._db.execute(
+            "DELETE FROM seen_messages WHERE created_at < ("
+            "SELECT created_at FROM seen_messages ORDER BY created_at DESC LIMIT 1 OFFSET ?)",
+            (self.max_entries - 1,),
+        )
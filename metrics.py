@@ -0,0 +1,194 @@
+"""Métricas en formato de texto de Prometheus, sin dependencias externas.
+
+Contadores e histogramas seguros entre hilos, pensados para quedar activos en el
+camino caliente: registrar un valor es tomar un lock y sumar en una lista. Las
+métricas de todo el proyecto se definen acá, así el webhook las publica en
+`/metrics` y `alerta_twilio.py` las escribe en un archivo para el textfile
+collector de node_exporter (o las envía a un Pushgateway).
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Segundos: de 100 µs a 1 min
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Demora de punta a punta (archivo → mensaje aceptado por Twilio)
+DELIVERY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 900, 3600)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Contador monótono con etiquetas opcionales."""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Histograma acumulativo con límites fijos y etiquetas opcionales."""
+
+    def __init__(
+        self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Por etiquetas: [cuentas por tramo (+ uno para +Inf), suma]
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels: str):
+        """Mide la duración del bloque `with`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels: str) -> int:
+        with self._lock:
+            series = self._series.get(labels)
+            return sum(series[0]) if series else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._series.items())
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str):
+        """Escribe las métricas de forma atómica (para el textfile collector de node_exporter)."""
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def push(self, gateway_url: str, job: str, instance: Optional[str] = None, timeout: float = 5.0):
+        """Reemplaza las métricas del grupo `job`/`instance` en un Pushgateway."""
+        import requests
+
+        url = f"{gateway_url.rstrip('/')}/metrics/job/{job}"
+        if instance:
+            url += f"/instance/{instance}"
+        response = requests.put(url, data=self.render().encode("utf-8"),
+                                headers={"Content-Type": CONTENT_TYPE}, timeout=timeout)
+        response.raise_for_status()
+
+
+REGISTRY = Registry()
+
+# -------------------- Métricas del proyecto --------------------
+FOLDER_SCAN_SECONDS = REGISTRY.register(Histogram(
+    "alertas_folder_scan_seconds", "Duración de los recorridos de la carpeta de alertas."
+))
+EXIF_PARSE_SECONDS = REGISTRY.register(Histogram(
+    "alertas_exif_parse_seconds", "Duración de la lectura de la etiqueta EXIF de una imagen (sin caché)."
+))
+STATE_IO_SECONDS = REGISTRY.register(Histogram(
+    "alertas_state_io_seconds", "Duración de las lecturas y escrituras del estado de usuarios.", ["op"]
+))
+TWILIO_API_SECONDS = REGISTRY.register(Histogram(
+    "alertas_twilio_api_seconds", "Latencia de las llamadas a la API de mensajes de Twilio.", ["outcome"]
+))
+DELIVERY_SECONDS = REGISTRY.register(Histogram(
+    "alertas_delivery_seconds",
+    "Demora desde el mtime de la imagen hasta que Twilio acepta el mensaje.",
+    ["kind"],
+    DELIVERY_BUCKETS,
+))
+MESSAGES_TOTAL = REGISTRY.register(Counter(
+    "alertas_messages_total",
+    "Mensajes por tipo de destinatario (template, session, reply) y resultado "
+    "(sent, skipped, paused, failed, retried).",
+    ["kind", "result"],
+))
+NEAR_DUPLICATES_TOTAL = REGISTRY.register(Counter(
+    "alertas_near_duplicates_total",
+    "Imágenes no enviadas por ser casi iguales (hash perceptual y misma etiqueta) a una reciente.",
+))
+WEBHOOK_REQUESTS_TOTAL = REGISTRY.register(Counter(
+    "alertas_webhook_requests_total",
+    "Mensajes entrantes del webhook (processed = procesados, duplicate = reintentos de Twilio respondidos de la caché).",
+    ["result"],
+))
+RETENTION_FILES_TOTAL = REGISTRY.register(Counter(
+    "alertas_retention_files_total",
+    "Imágenes procesadas por la retención (archived = movidas a AAAA/MM/DD, deleted = eliminadas).",
+    ["action"],
+))
@@ -0,0 +1,409 @@
+"""Cola persistente de mensajes salientes con reintentos.
+
+Todo envío a Twilio pasa primero por la tabla `outbox` (SQLite) y lo realiza un
+pool de hilos en segundo plano, así ni el envío de alertas ni el webhook esperan
+la latencia de Twilio. Un error transitorio (429, 5xx, corte de red) se reintenta
+con espera exponencial y jitter; tras `max_attempts` intentos, o ante un error
+definitivo, el mensaje pasa a `dead` y queda registrado.
+
+Cada mensaje lleva una clave de idempotencia: encolar dos veces la misma clave no
+genera un segundo envío. Las alertas registran su entrega en el estado del
+destinatario recién cuando Twilio las acepta (`alert_delivery_recorder`). Un mensaje que quedó en `sending` porque el proceso se
+cortó en medio de la llamada no se reintenta (Twilio pudo haberlo aceptado); se
+marca como `dead` para revisarlo.
+
+El límite de mensajes por segundo del remitente también vive en `outbox.db`
+(`SharedTokenBucket`): lo respetan entre todos los procesos que envían (el envío de
+alertas y cada worker del webhook), no cada uno por su cuenta.
+"""
+import json
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, NamedTuple, Optional
+
+import requests
+from twilio.base.exceptions import TwilioRestException
+
+from metrics import DELIVERY_SECONDS, MESSAGES_TOTAL, TWILIO_API_SECONDS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idem_key TEXT NOT NULL UNIQUE,
+    recipient TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    lease_until REAL,
+    last_error TEXT,
+    sid TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    kind TEXT NOT NULL DEFAULT 'message',
+    event_at REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS outbox_recipient ON outbox (recipient, status);
+CREATE TABLE IF NOT EXISTS rate_limits (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# Columnas agregadas después de la primera versión de la tabla
+COLUMNS_ADDED = (
+    ("kind", "TEXT NOT NULL DEFAULT 'message'"),
+    ("event_at", "REAL"),
+)
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+DEAD = "dead"
+
+
+class OutboxMessage(NamedTuple):
+    id: int
+    idem_key: str
+    recipient: str
+    params: dict
+    attempts: int
+    kind: str = "message"
+    event_at: Optional[float] = None
+
+
+# Mensajes de alerta: "alerta:<sitio>:<alerta>:<destinatario>" (el id de sitio no lleva ':')
+ALERT_KEY_PREFIX = "alerta:"
+
+# Campo del estado del destinatario que registra cada tipo de alerta entregada
+DELIVERY_FIELDS = {"template": "last_template_sent", "session": "last_event_sent"}
+
+
+def alert_key(site_id: str, alert_id: str, recipient: str) -> str:
+    return f"{ALERT_KEY_PREFIX}{site_id}:{alert_id}:{recipient}"
+
+
+def alert_site_id(idem_key: str) -> Optional[str]:
+    if not idem_key.startswith(ALERT_KEY_PREFIX):
+        return None
+    return idem_key[len(ALERT_KEY_PREFIX):].split(":", 1)[0]
+
+
+def alert_delivery_recorder(store_for: Callable[[str], Any]) -> Callable[[OutboxMessage], None]:
+    """Callback `on_sent` que guarda en el estado del destinatario la hora de entrega.
+
+    `store_for(site_id)` retorna el StateStore del sitio, o None si ya no existe. Así
+    una plantilla que termina descartada no inicia la espera entre plantillas.
+    """
+    def record(msg: OutboxMessage):
+        field = DELIVERY_FIELDS.get(msg.kind)
+        site_id = alert_site_id(msg.idem_key)
+        store = store_for(site_id) if field and site_id else None
+        if store is None:
+            return
+        sent_at = datetime.now(timezone.utc).isoformat()
+        store.update(msg.recipient, lambda user_state: user_state.__setitem__(field, sent_at))
+    return record
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Errores transitorios: límite de tasa, fallas del servidor o de conexión.
+
+    Un timeout de lectura no se reintenta: la solicitud pudo haber llegado a Twilio.
+    """
+    if isinstance(error, TwilioRestException):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, requests.exceptions.ConnectionError)
+
+
+class Outbox:
+    """Acceso a la tabla `outbox`, seguro entre hilos y procesos."""
+
+    def __init__(
+        self,
+        db_path: str,
+        max_attempts: int = 5,
+        base_delay: float = 2.0,
+        max_delay: float = 300.0,
+        lease_seconds: float = 120.0,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._transaction(self._migrate)
+
+    @staticmethod
+    def _migrate(db):
+        columns = {row[1] for row in db.execute("PRAGMA table_info(outbox)")}
+        for name, decl in COLUMNS_ADDED:
+            if name not in columns:
+                db.execute(f"ALTER TABLE outbox ADD COLUMN {name} {decl}")
+
+    def _transaction(self, fn):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._db)
+                self._db.execute("COMMIT")
+                return result
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, idem_key: str, params: dict, kind: str = "message", event_at: Optional[float] = None) -> bool:
+        """Encola los parámetros de `messages.create`. Retorna False si la clave ya existía.
+
+        `kind` clasifica el mensaje en las métricas (template, session, reply) y
+        `event_at` es el mtime de la imagen que lo originó, para medir la demora total.
+        """
+        now = time.time()
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT OR IGNORE INTO outbox "
+                "(idem_key, recipient, params, next_attempt_at, created_at, updated_at, kind, event_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (idem_key, params.get("to", ""), json.dumps(params, ensure_ascii=False), now, now, now,
+                 kind, event_at),
+            )
+            return cur.rowcount == 1
+
+    def claim(self) -> Optional[OutboxMessage]:
+        """Toma el próximo mensaje vencido y lo marca `sending` (atómico entre procesos)."""
+        now = time.time()
+
+        def apply(db):
+            row = db.execute(
+                "SELECT id, idem_key, recipient, params, attempts, kind, event_at FROM outbox "
+                "WHERE status = ? AND next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT 1",
+                (PENDING, now),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE outbox SET status = ?, attempts = attempts + 1, lease_until = ?, updated_at = ? WHERE id = ?",
+                (SENDING, now + self.lease_seconds, now, row[0]),
+            )
+            return OutboxMessage(row[0], row[1], row[2], json.loads(row[3]), row[4] + 1, row[5], row[6])
+
+        return self._transaction(apply)
+
+    def mark_sent(self, msg: OutboxMessage, sid: Optional[str]):
+        with self._lock:
+            self._db.execute(
+                "UPDATE outbox SET status = ?, sid = ?, lease_until = NULL, last_error = NULL, updated_at = ? WHERE id = ?",
+                (SENT, sid, time.time(), msg.id),
+            )
+
+    def mark_failed(self, msg: OutboxMessage, error: BaseException) -> str:
+        """Reprograma el mensaje con espera exponencial o lo pasa a `dead`. Retorna el nuevo estado."""
+        now = time.time()
+        if is_retryable(error) and msg.attempts < self.max_attempts:
+            delay = min(self.max_delay, self.base_delay * 2 ** (msg.attempts - 1))
+            delay *= random.uniform(0.5, 1.0)
+            status, next_at = PENDING, now + delay
+        else:
+            status, next_at = DEAD, now
+        with self._lock:
+            self._db.execute(
+                "UPDATE outbox SET status = ?, next_attempt_at = ?, lease_until = NULL, last_error = ?, updated_at = ? "
+                "WHERE id = ?",
+                (status, next_at, str(error)[:500], now, msg.id),
+            )
+        return status
+
+    def recover_stale(self) -> int:
+        """Marca `dead` los envíos interrumpidos (lease vencido) sin reintentarlos."""
+        now = time.time()
+        with self._lock:
+            cur = self._db.execute(
+                "UPDATE outbox SET status = ?, last_error = ?, updated_at = ? WHERE status = ? AND lease_until < ?",
+                (DEAD, "Envío interrumpido: resultado desconocido, no se reintenta", now, SENDING, now),
+            )
+            return cur.rowcount
+
+    def in_flight(self, site_id: str, recipient: str, kind: str) -> bool:
+        """True si hay una alerta de ese tipo del sitio para `recipient` todavía sin entregar."""
+        # Las alertas de otros sitios al mismo número no cuentan
+        prefix = f"{ALERT_KEY_PREFIX}{site_id}:"
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM outbox WHERE recipient = ? AND status IN (?, ?) AND kind = ? "
+                "AND substr(idem_key, 1, ?) = ? LIMIT 1",
+                (recipient, PENDING, SENDING, kind, len(prefix), prefix),
+            ).fetchone()
+        return row is not None
+
+    def take_token(self, key: str, rate: float, capacity: float) -> float:
+        """Toma un token del limitador `key` (atómico entre procesos).
+
+        Retorna 0 si lo tomó, o los segundos a esperar hasta que haya uno.
+        """
+        now = time.time()
+
+        def apply(db):
+            row = db.execute("SELECT tokens, updated_at FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            db.execute(
+                "INSERT INTO rate_limits (key, tokens, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                (key, tokens, now),
+            )
+            return wait
+
+        return self._transaction(apply)
+
+    def next_due_in(self) -> Optional[float]:
+        """Segundos hasta el próximo mensaje pendiente (0 si ya hay vencidos), o None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE status = ?", (PENDING,)
+            ).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+
+class SharedTokenBucket:
+    """Limitador de tasa tipo token bucket con el estado en `outbox.db`.
+
+    Repone `rate` tokens por segundo hasta `capacity`; `acquire()` bloquea hasta
+    que haya un token disponible. Todos los procesos que usan la misma base y la
+    misma `key` comparten el límite.
+    """
+
+    def __init__(self, outbox: Outbox, rate: float, capacity: Optional[float] = None, key: str = "twilio"):
+        if rate <= 0:
+            raise ValueError("rate debe ser mayor que 0")
+        self.outbox = outbox
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self.key = key
+
+    def acquire(self):
+        while True:
+            wait = self.outbox.take_token(self.key, self.rate, self.capacity)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+class OutboxWorker:
+    """Pool de hilos que vacía el outbox respetando concurrencia y mensajes/segundo."""
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        send: Callable[[dict], object],
+        concurrency: int = 8,
+        limiter: Optional[SharedTokenBucket] = None,
+        poll_interval: float = 1.0,
+        on_sent: Optional[Callable[[OutboxMessage], None]] = None,
+    ):
+        self.outbox = outbox
+        self.send = send
+        self.on_sent = on_sent
+        self.concurrency = max(1, int(concurrency))
+        self.limiter = limiter
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def process(self, msg: OutboxMessage):
+        if self.limiter is not None:
+            self.limiter.acquire()
+        start = time.perf_counter()
+        try:
+            result = self.send(msg.params)
+        except Exception as e:
+            TWILIO_API_SECONDS.observe(time.perf_counter() - start, "error")
+            status = self.outbox.mark_failed(msg, e)
+            if status == DEAD:
+                MESSAGES_TOTAL.inc(msg.kind, "failed")
+                print(f"[ERR] Envío a {msg.recipient} descartado tras {msg.attempts} intento(s): {e}")
+            else:
+                MESSAGES_TOTAL.inc(msg.kind, "retried")
+                print(f"[WARN] Falló envío a {msg.recipient} (intento {msg.attempts}); se reintentará: {e}")
+            return
+        TWILIO_API_SECONDS.observe(time.perf_counter() - start, "ok")
+        self.outbox.mark_sent(msg, getattr(result, "sid", None))
+        MESSAGES_TOTAL.inc(msg.kind, "sent")
+        if msg.event_at is not None:
+            DELIVERY_SECONDS.observe(max(0.0, time.time() - msg.event_at), msg.kind)
+        print(f"[OK] Mensaje enviado a {msg.recipient}")
+        if self.on_sent is not None:
+            try:
+                self.on_sent(msg)
+            except Exception as e:
+                print(f"[WARN] No se pudo registrar la entrega a {msg.recipient}: {e}")
+
+    def _process_due(self) -> bool:
+        msg = self.outbox.claim()
+        if msg is None:
+            return False
+        self.process(msg)
+        return True
+
+    # -------------------- Modo continuo (daemon / webhook) --------------------
+    def start(self):
+        stale = self.outbox.recover_stale()
+        if stale:
+            print(f"[WARN] {stale} envío(s) interrumpido(s) marcados como descartados")
+        for i in range(self.concurrency):
+            t = threading.Thread(target=self._run, name=f"outbox-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def notify(self):
+        """Despierta a los hilos tras encolar (los de otros procesos se enteran por sondeo)."""
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self._process_due():
+                    continue
+                wait = self.outbox.next_due_in()
+            except Exception as e:
+                print(f"[ERR] Error en el outbox: {e}")
+                wait = None
+            wait = self.poll_interval if wait is None else min(wait, self.poll_interval)
+            with self._wakeup:
+                self._wakeup.wait(wait)
+
+    def stop(self):
+        self._stop.set()
+        self.notify()
+        for t in self._threads:
+            t.join()
+
+    # -------------------- Modo de una sola ejecución --------------------
+    def drain(self):
+        """Envía todo lo vencido con el pool y retorna; los reintentos futuros quedan encolados."""
+        self.outbox.recover_stale()
+
+        def loop():
+            while self._process_due():
+                pass
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="outbox") as pool:
+            for f in [pool.submit(loop) for _ in range(self.concurrency)]:
+                f.result()
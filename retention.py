@@ -0,0 +1,344 @@
+"""Retención de la carpeta de alertas: archivo por fecha y presupuestos de espacio.
+
+Las imágenes con más de `archive_after_hours` se mueven de la carpeta plana a
+subcarpetas `AAAA/MM/DD` (fecha UTC-3 del mtime), así la carpeta que recorren el
+envío de alertas y "VER" se mantiene chica. Las archivadas se eliminan, de la más
+antigua a la más nueva, cuando superan `retention_max_age_days` o cuando la carpeta
+completa supera `retention_max_mb`.
+
+Cada imagen archivada queda registrada en `alert_index.db` (tabla `archive`), de
+modo que el servidor de archivos la sigue encontrando por la misma URL con la que
+se envió. El trabajo se hace por lotes chicos desde un hilo de fondo del daemon (o
+con `python retention.py`), cediendo entre lotes para no demorar los envíos.
+"""
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from alert_index import AlertIndex
+from metrics import RETENTION_FILES_TOTAL
+
+LOCAL_TZ = timezone(timedelta(hours=-3))  # UTC-3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archive (
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    relpath TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    label TEXT,
+    confidence TEXT,
+    PRIMARY KEY (folder, name)
+);
+CREATE INDEX IF NOT EXISTS archive_mtime ON archive (folder, mtime);
+"""
+
+
+class RetentionPolicy(NamedTuple):
+    archive_after_seconds: float
+    max_age_seconds: Optional[float]
+    max_bytes: Optional[int]
+    interval: float
+    batch: int
+
+
+def policy_from_settings(settings: dict) -> Optional[RetentionPolicy]:
+    """Lee la retención de Settings.json; None si no hay ninguna clave configurada."""
+    archive_hours = settings.get("archive_after_hours")
+    max_age_days = settings.get("retention_max_age_days")
+    max_mb = settings.get("retention_max_mb")
+    if archive_hours is None and max_age_days is None and max_mb is None:
+        return None
+    archive_after = float(archive_hours if archive_hours is not None else 24) * 3600
+    max_age = float(max_age_days) * 86400 if max_age_days is not None else None
+    if max_age is not None:
+        # Lo que ya venció no se archiva: se elimina directamente
+        archive_after = min(archive_after, max_age)
+    return RetentionPolicy(
+        archive_after_seconds=archive_after,
+        max_age_seconds=max_age,
+        max_bytes=int(float(max_mb) * 1024 * 1024) if max_mb is not None else None,
+        interval=float(settings.get("retention_interval", 300)),
+        batch=int(settings.get("retention_batch", 200)),
+    )
+
+
+def archive_relpath(name: str, mtime: float) -> str:
+    """Ruta relativa a la carpeta de alertas donde se archiva una imagen."""
+    day = datetime.fromtimestamp(mtime, tz=LOCAL_TZ)
+    return os.path.join(f"{day.year:04d}", f"{day.month:02d}", f"{day.day:02d}", name)
+
+
+class ArchiveCatalog:
+    """Registro de las imágenes archivadas de cada carpeta, seguro entre hilos."""
+
+    def __init__(self, db_path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        # Bytes archivados por carpeta; se calculan al primer uso y se mantienen al día
+        self._totals: Dict[str, int] = {}
+
+    def lookup(self, folder: str, name: str) -> Optional[str]:
+        """Ruta relativa de una imagen archivada, o None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT relpath FROM archive WHERE folder = ? AND name = ?", (folder, name)
+            ).fetchone()
+        return row[0] if row else None
+
+    def total_bytes(self, folder: str) -> int:
+        with self._lock:
+            return self._total(folder)
+
+    def _total(self, folder: str) -> int:
+        total = self._totals.get(folder)
+        if total is None:
+            row = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM archive WHERE folder = ?", (folder,)).fetchone()
+            total = self._totals[folder] = row[0]
+        return total
+
+    def add(self, folder: str, rows: List[Tuple[str, str, float, int, Optional[str], Optional[str]]]):
+        """Registra imágenes (name, relpath, mtime, size, label, confidence) en una transacción."""
+        if not rows:
+            return
+        with self._lock:
+            total = self._total(folder)
+            self._db.execute("BEGIN")
+            try:
+                for row in rows:
+                    old = self._db.execute(
+                        "SELECT size FROM archive WHERE folder = ? AND name = ?", (folder, row[0])
+                    ).fetchone()
+                    total -= old[0] if old else 0
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO archive (folder, name, relpath, mtime, size, label, confidence) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (folder, *row),
+                    )
+                    total += row[3]
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                self._totals.pop(folder, None)
+                raise
+            self._totals[folder] = total
+
+    def remove(self, folder: str, names: List[str]):
+        if not names:
+            return
+        with self._lock:
+            total = self._total(folder)
+            self._db.execute("BEGIN")
+            try:
+                for name in names:
+                    row = self._db.execute(
+                        "SELECT size FROM archive WHERE folder = ? AND name = ?", (folder, name)
+                    ).fetchone()
+                    if row:
+                        self._db.execute("DELETE FROM archive WHERE folder = ? AND name = ?", (folder, name))
+                        total -= row[0]
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                self._totals.pop(folder, None)
+                raise
+            self._totals[folder] = total
+
+    def oldest(self, folder: str, limit: int) -> List[Tuple[str, str, float, int]]:
+        """Las `limit` imágenes archivadas más antiguas: (name, relpath, mtime, size)."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT name, relpath, mtime, size FROM archive WHERE folder = ? ORDER BY mtime LIMIT ?",
+                (folder, limit),
+            ).fetchall()
+
+
+def _unlink(path: str) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return True
+    except OSError as e:
+        print(f"[WARN] No se pudo eliminar {path}: {e}")
+        return False
+
+
+def _prune_dirs(folder: str, dirs):
+    """Elimina las carpetas de fecha que quedaron vacías (día, mes y año)."""
+    root = os.path.normpath(folder)
+    for directory in sorted(dirs, reverse=True):
+        directory = os.path.normpath(directory)
+        while directory != root and directory.startswith(root):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+
+class RetentionWorker:
+    """Aplica la política a las carpetas de los índices dados, por lotes y en segundo plano."""
+
+    def __init__(self, policy: RetentionPolicy, catalog: ArchiveCatalog, indexes: List[AlertIndex], pause: float = 0.05):
+        self.policy = policy
+        self.catalog = catalog
+        self.indexes = indexes
+        self.pause = pause
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._over_budget = set()
+
+    # -------------------- Ciclo de vida --------------------
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_pending()
+            except Exception as e:
+                print(f"[ERR] Falló la retención de la carpeta de alertas: {e}")
+            self._stop.wait(self.policy.interval)
+
+    # -------------------- Trabajo --------------------
+    def run_pending(self, now: float = None) -> int:
+        """Procesa lotes hasta ponerse al día; retorna la cantidad de imágenes tratadas."""
+        total = 0
+        for index in self.indexes:
+            index.refresh()
+            while not self._stop.is_set():
+                current = now if now is not None else time.time()
+                archived = self._archive(index, current)
+                evicted = self._evict(index, current)
+                total += archived + evicted
+                if archived < self.policy.batch and evicted < self.policy.batch:
+                    break
+                # Ceder el disco al envío de alertas entre lotes
+                self._stop.wait(self.pause)
+            if self.policy.max_bytes is not None and not self._stop.is_set():
+                self._check_budget(index)
+        return total
+
+    def _archive(self, index: AlertIndex, now: float) -> int:
+        """Mueve a AAAA/MM/DD las imágenes más antiguas de la carpeta plana (un lote)."""
+        policy = self.policy
+        entries = index.oldest(now - policy.archive_after_seconds, policy.batch)
+        if not entries:
+            return 0
+        expired_before = now - policy.max_age_seconds if policy.max_age_seconds is not None else None
+
+        gone, rows = [], []
+        for entry in entries:
+            if expired_before is not None and entry.mtime < expired_before:
+                if _unlink(index.path(entry)):
+                    RETENTION_FILES_TOTAL.inc("deleted")
+                    gone.append(entry.name)
+                continue
+            # Lo archivado ya no se vuelve a etiquetar: leer la etiqueta ahora para
+            # que siga apareciendo en "VER <etiqueta>" y en la API de historial
+            entry = index.describe(entry)
+            rows.append((entry.name, archive_relpath(entry.name, entry.mtime), entry.mtime, entry.size,
+                         entry.label, entry.confidence))
+
+        # Se registra antes de mover: una imagen movida nunca queda sin su URL
+        self.catalog.add(index.folder, rows)
+        failed = []
+        for name, relpath, *_ in rows:
+            dest = os.path.join(index.folder, relpath)
+            try:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                os.replace(os.path.join(index.folder, name), dest)
+            except FileNotFoundError:
+                failed.append(name)
+                gone.append(name)
+                continue
+            except OSError as e:
+                print(f"[WARN] No se pudo archivar {name}: {e}")
+                failed.append(name)
+                continue
+            RETENTION_FILES_TOTAL.inc("archived")
+            gone.append(name)
+        self.catalog.remove(index.folder, failed)
+        index.discard(gone)
+        # Las que fallaron no cuentan: así un error persistente no repite el lote sin fin
+        return len(gone)
+
+    def _evict(self, index: AlertIndex, now: float) -> int:
+        """Elimina archivadas vencidas o, si se supera el presupuesto, las más antiguas (un lote)."""
+        policy = self.policy
+        if policy.max_age_seconds is None and policy.max_bytes is None:
+            return 0
+        folder = index.folder
+        expired_before = now - policy.max_age_seconds if policy.max_age_seconds is not None else None
+        over = 0
+        if policy.max_bytes is not None:
+            over = self.catalog.total_bytes(folder) + index.total_bytes() - policy.max_bytes
+
+        candidates = self.catalog.oldest(folder, policy.batch)
+        removed, dirs = [], set()
+        for name, relpath, mtime, size in candidates:
+            if not ((expired_before is not None and mtime < expired_before) or over > 0):
+                break
+            path = os.path.join(folder, relpath)
+            if _unlink(path):
+                RETENTION_FILES_TOTAL.inc("deleted")
+                removed.append(name)
+                dirs.add(os.path.dirname(path))
+                over -= size
+        self.catalog.remove(folder, removed)
+        _prune_dirs(folder, dirs)
+        return len(removed)
+
+    def _check_budget(self, index: AlertIndex):
+        """Avisa (una vez) si tras depurar el archivo la carpeta sigue superando el presupuesto.
+
+        Las imágenes sin archivar son las recientes: no se eliminan para cumplirlo.
+        """
+        folder = index.folder
+        if self.catalog.total_bytes(folder) + index.total_bytes() <= self.policy.max_bytes:
+            self._over_budget.discard(folder)
+        elif folder not in self._over_budget:
+            self._over_budget.add(folder)
+            print(f"[WARN] {folder} supera 'retention_max_mb' sólo con imágenes recientes (sin archivar).")
+
+
+def main(argv=None):
+    import config
+    from exif_reader import extract_label_confidence
+
+    base_dir = os.path.dirname(__file__)
+    cfg = config.load_config(twilio=False)
+    settings = cfg.settings
+
+    parser = argparse.ArgumentParser(description="Archiva y depura las imágenes de alerta una vez y termina.")
+    parser.add_argument("--site", action="append", metavar="ID", help="Sólo este sitio; puede repetirse.")
+    args = parser.parse_args(argv)
+
+    policy = policy_from_settings(settings)
+    if policy is None:
+        print("[INFO] No hay retención configurada ('archive_after_hours', 'retention_max_age_days' o 'retention_max_mb').")
+        return
+    sites = [s for s in cfg.sites if not args.site or s.id in args.site]
+    index_db = os.path.join(base_dir, "alert_index.db")
+    indexes = [AlertIndex(site.folder, index_db, extract_label_confidence) for site in sites if os.path.isdir(site.folder)]
+    start = time.perf_counter()
+    count = RetentionWorker(policy, ArchiveCatalog(index_db), indexes).run_pending()
+    print(f"[OK] Retención aplicada: {count} imágenes en {time.perf_counter() - start:.1f} s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Varios sitios (instancias) atendidos por un mismo proceso.
+
+Sin la clave `sites`, Settings.json describe un único sitio con las claves de
+siempre (`instance_id`, `alerts_folder`, `recipients`, ...) y se usan los mismos
+archivos que antes. Con `sites`, cada elemento define un sitio y puede redefinir
+cualquiera de las claves de `SITE_KEYS`; las que no defina se toman del nivel
+superior:
+
+    "sites": [
+        {"instance_id": "pilares", "instance_name": "Pilares", "alerts_folder": "D:/Alerts/Pilares",
+         "recipients": ["whatsapp:+549..."]},
+        {"instance_id": "centro", "alerts_folder": "D:/Alerts/Centro", "template_cooldown_hours": 2,
+         "recipients": ["whatsapp:+549..."]}
+    ]
+
+El estado de los usuarios se guarda por separado para cada sitio, en
+`sites/<instance_id>/user_state.db`. El cliente de Twilio, el outbox, el índice
+de imágenes y los procesos son compartidos; los recursos por sitio se crean
+recién cuando se usan (`PerSite`).
+"""
+import os
+import re
+import threading
+from datetime import timedelta
+from typing import Callable, Dict, Generic, Hashable, Iterable, List, NamedTuple, Optional, Tuple, TypeVar
+
+from media_variants import normalize_base_url
+
+# Claves que cada sitio puede redefinir
+SITE_KEYS = (
+    "instance_id",
+    "instance_name",
+    "alerts_folder",
+    "alerts_base_url",
+    "recipients",
+    "twilio_content_sid",
+    "twilio_from_whatsapp",
+    "template_cooldown_hours",
+    "session_duration_hours",
+    "coalesce_seconds",
+)
+
+# El id se usa en rutas de archivos y URLs
+SITE_ID_RE = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+class Site(NamedTuple):
+    id: str
+    name: str
+    folder: str
+    base_url: Optional[str]
+    recipients: Tuple[str, ...]
+    content_sid: Optional[str]
+    from_whatsapp: Optional[str]
+    template_cooldown: timedelta
+    session_duration: timedelta
+    coalesce_seconds: float
+    state_db: str
+    legacy_state_json: Optional[str]
+
+
+def _clean_recipients(recipients) -> Tuple[str, ...]:
+    return tuple(r.strip() for r in recipients or [] if isinstance(r, str) and r.strip())
+
+
+def _build_site(conf: dict, base_url: Optional[str], state_db: str, legacy_state_json: Optional[str]) -> Site:
+    return Site(
+        id=str(conf.get("instance_id", "ID por defecto")),
+        name=conf.get("instance_name", "Nombre por defecto"),
+        folder=conf.get("alerts_folder", "./alerts"),
+        base_url=normalize_base_url(base_url) if base_url else None,
+        recipients=_clean_recipients(conf.get("recipients")),
+        content_sid=conf.get("twilio_content_sid"),
+        from_whatsapp=conf.get("twilio_from_whatsapp"),
+        template_cooldown=timedelta(hours=conf.get("template_cooldown_hours", 1)),
+        session_duration=timedelta(hours=conf.get("session_duration_hours", 24)),
+        coalesce_seconds=float(conf.get("coalesce_seconds", 0)),
+        state_db=state_db,
+        legacy_state_json=legacy_state_json,
+    )
+
+
+def load_sites(settings: dict, base_dir: str) -> List[Site]:
+    """Sitios definidos en Settings.json (uno solo si no hay `sites`)."""
+    entries = settings.get("sites")
+    if not entries:
+        return [_build_site(
+            settings,
+            settings.get("alerts_base_url"),
+            os.path.join(base_dir, "user_state.db"),
+            os.path.join(base_dir, "user_state.json"),
+        )]
+
+    defaults = {k: settings[k] for k in SITE_KEYS if k in settings}
+    shared_base_url = (settings.get("alerts_base_url") or "").rstrip("/")
+    sites = []
+    seen = set()
+    for entry in entries:
+        site_id = str(entry.get("instance_id", ""))
+        if not SITE_ID_RE.match(site_id):
+            raise ValueError(f"'instance_id' inválido en 'sites': {site_id!r} (use letras, números, '_', '-' o '.')")
+        if site_id in seen:
+            raise ValueError(f"'instance_id' repetido en 'sites': {site_id}")
+        seen.add(site_id)
+        # El nombre no se hereda: sin 'instance_name' propio se muestra el id
+        conf = {**defaults, **entry, "instance_name": entry.get("instance_name", site_id)}
+        # Un único servidor de archivos: cada sitio bajo /<instance_id>/
+        base_url = entry.get("alerts_base_url") or (f"{shared_base_url}/{site_id}" if shared_base_url else None)
+        # La carpeta la crea quien abre la base (StateStore / Coalescer), no la configuración
+        data_dir = os.path.join(base_dir, "sites", site_id)
+        sites.append(_build_site(conf, base_url, os.path.join(data_dir, "user_state.db"), None))
+    return sites
+
+
+def is_multi_site(settings: dict) -> bool:
+    return bool(settings.get("sites"))
+
+
+def sites_by_recipient(sites: Iterable[Site]) -> Dict[str, List[Site]]:
+    """Sitios a los que pertenece cada destinatario (para enrutar el webhook)."""
+    routes: Dict[str, List[Site]] = {}
+    for site in sites:
+        for recipient in site.recipients:
+            routes.setdefault(recipient, []).append(site)
+    return routes
+
+
+T = TypeVar("T")
+
+
+class PerSite(Generic[T]):
+    """Recurso por sitio creado la primera vez que se pide (seguro entre hilos).
+
+    Así el costo de arranque no crece con la cantidad de sitios: sólo se abren
+    bases e índices de los sitios que efectivamente reciben tráfico.
+
+    Por defecto hay un recurso por `site.id`; `key` permite crear uno nuevo cuando
+    cambia algún dato del sitio del que depende (ej. tras recargar la configuración).
+    """
+
+    def __init__(self, factory: Callable[[Site], T], key: Callable[[Site], Hashable] = lambda site: site.id):
+        self._factory = factory
+        self._key = key
+        self._items: Dict[Hashable, T] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, site: Site) -> T:
+        key = self._key(site)
+        item = self._items.get(key)
+        if item is None:
+            with self._lock:
+                item = self._items.get(key)
+                if item is None:
+                    item = self._items[key] = self._factory(site)
+        return item
+
+    def values(self) -> List[T]:
+        with self._lock:
+            return list(self._items.values())
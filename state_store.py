@@ -0,0 +1,278 @@
+"""Estado persistente por usuario en SQLite (modo WAL).
+
+Reemplaza la reescritura completa de `user_state.json`: cada destinatario es una
+fila y cada actualización es una transacción sobre esa fila, de modo que el
+webhook y el envío de alertas pueden escribir a la vez sin pisarse (un PARAR no
+se pierde porque otra ejecución esté guardando su `last_template_sent`).
+"""
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional
+
+from metrics import STATE_IO_SECONDS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_state (
+    recipient TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Función que recibe el estado del usuario (dict) y lo modifica en el lugar
+Updater = Callable[[dict], None]
+
+
+def _dumps(user_state: dict) -> str:
+    return json.dumps(user_state, ensure_ascii=False, separators=(",", ":"))
+
+
+class StateStore:
+    """Acceso al estado por destinatario con actualizaciones atómicas por fila.
+
+    Usa una conexión por hilo, por lo que es seguro desde servidores con hilos.
+    Si existe `legacy_json` (el antiguo `user_state.json`) se importa
+    automáticamente la primera vez que se abre la base.
+    """
+
+    def __init__(self, db_path: str, legacy_json: Optional[str] = None):
+        self.db_path = db_path
+        # En modo de varios sitios la base va en sites/<instance_id>/
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._local = threading.local()
+        db = self._conn()
+        db.executescript(SCHEMA)
+        if legacy_json:
+            self._import_legacy(legacy_json)
+
+    def _connect(self, **kwargs) -> sqlite3.Connection:
+        db = sqlite3.connect(self.db_path, timeout=10, isolation_level=None, **kwargs)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _conn(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = self._connect()
+        return db
+
+    def _import_legacy(self, path: str):
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if db.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone() is None:
+                legacy = {}
+                if os.path.exists(path):
+                    try:
+                        with open(path, "r", encoding="utf-8") as f:
+                            legacy = json.load(f)
+                    except Exception as e:
+                        print(f"[WARN] No se pudo importar {path}: {e}")
+                now = time.time()
+                db.executemany(
+                    "INSERT OR IGNORE INTO user_state (recipient, data, updated_at) VALUES (?, ?, ?)",
+                    [(r, _dumps(s), now) for r, s in legacy.items() if isinstance(s, dict)],
+                )
+                db.execute("INSERT INTO meta (key, value) VALUES ('legacy_imported', ?)", (path,))
+                if legacy:
+                    print(f"[INFO] Estado importado desde {path} ({len(legacy)} usuarios)")
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    # -------------------- Lectura --------------------
+    def get(self, recipient: str) -> dict:
+        with STATE_IO_SECONDS.time("read"):
+            row = self._conn().execute("SELECT data FROM user_state WHERE recipient = ?", (recipient,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def get_many(self, recipients: Iterable[str]) -> Dict[str, dict]:
+        """Estado de varios destinatarios en una sola consulta (los ausentes como `{}`)."""
+        recipients = list(recipients)
+        result = {r: {} for r in recipients}
+        if not recipients:
+            return result
+        marks = ",".join("?" * len(recipients))
+        with STATE_IO_SECONDS.time("read"):
+            rows = self._conn().execute(
+                f"SELECT recipient, data FROM user_state WHERE recipient IN ({marks})", recipients
+            ).fetchall()
+        for recipient, data in rows:
+            result[recipient] = json.loads(data)
+        return result
+
+    def all(self) -> Dict[str, dict]:
+        rows = self._conn().execute("SELECT recipient, data FROM user_state").fetchall()
+        return {recipient: json.loads(data) for recipient, data in rows}
+
+    # -------------------- Escritura --------------------
+    def _apply(self, db: sqlite3.Connection, recipient: str, updater: Updater) -> dict:
+        row = db.execute("SELECT data FROM user_state WHERE recipient = ?", (recipient,)).fetchone()
+        user_state = json.loads(row[0]) if row else {}
+        before = _dumps(user_state)
+        updater(user_state)
+        after = _dumps(user_state)
+        if after != before:
+            db.execute(
+                "INSERT OR REPLACE INTO user_state (recipient, data, updated_at) VALUES (?, ?, ?)",
+                (recipient, after, time.time()),
+            )
+        return user_state
+
+    def update(self, recipient: str, updater: Updater, durable: bool = False) -> dict:
+        """Lee, modifica y guarda el estado de un destinatario en una transacción.
+
+        Retorna el estado resultante. `durable` exige que el cambio quede escrito
+        antes de retornar (aquí siempre es así; ver CachedStateStore).
+        """
+        return self.update_many({recipient: updater}, durable)[recipient]
+
+    def update_many(self, updaters: Dict[str, Updater], durable: bool = False) -> Dict[str, dict]:
+        """Aplica varias actualizaciones por destinatario en una única transacción."""
+        db = self._conn()
+        with STATE_IO_SECONDS.time("write"):
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                result = {r: self._apply(db, r, u) for r, u in updaters.items()}
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return result
+
+
+class CachedStateStore(StateStore):
+    """StateStore con caché en memoria y escritura diferida, pensado para el webhook.
+
+    Las lecturas se sirven desde memoria y los cambios se aplican de inmediato en la
+    caché; las filas modificadas se escriben en lote cada `flush_interval` segundos
+    y al terminar el proceso; con `durable=True` (lo que se le confirma al usuario,
+    como PARAR o ALERTAS) se escriben antes de retornar. Antes de cada lectura se consulta `PRAGMA
+    data_version`, que cambia cuando otro proceso (el envío de alertas) confirma
+    una transacción: en ese caso la caché se descarta y se relee de la base, con
+    los cambios pendientes reaplicados encima, para no servir datos viejos.
+    """
+
+    def __init__(self, db_path: str, legacy_json: Optional[str] = None, flush_interval: float = 0.5):
+        super().__init__(db_path, legacy_json)
+        self.flush_interval = flush_interval
+        # Conexión propia: sus commits no alteran su data_version, los de otros sí
+        self._db = self._connect(check_same_thread=False)
+        self._lock = threading.RLock()
+        self._cache: Dict[str, dict] = {}
+        self._pending: Dict[str, List[Updater]] = {}
+        self._version = None
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="state-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _check_external(self):
+        version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._version:
+            self._version = version
+            self._cache.clear()
+
+    def _cached(self, recipient: str) -> dict:
+        self._check_external()
+        user_state = self._cache.get(recipient)
+        if user_state is None:
+            with STATE_IO_SECONDS.time("read"):
+                row = self._db.execute("SELECT data FROM user_state WHERE recipient = ?", (recipient,)).fetchone()
+            user_state = json.loads(row[0]) if row else {}
+            for updater in self._pending.get(recipient, ()):
+                updater(user_state)
+            self._cache[recipient] = user_state
+        return user_state
+
+    # -------------------- Lectura --------------------
+    def get(self, recipient: str) -> dict:
+        with self._lock:
+            return dict(self._cached(recipient))
+
+    def get_many(self, recipients: Iterable[str]) -> Dict[str, dict]:
+        with self._lock:
+            return {r: dict(self._cached(r)) for r in recipients}
+
+    def all(self) -> Dict[str, dict]:
+        self.flush()
+        return super().all()
+
+    # -------------------- Escritura --------------------
+    def update_many(self, updaters: Dict[str, Updater], durable: bool = False) -> Dict[str, dict]:
+        """Aplica los cambios en memoria y los encola para la próxima escritura en lote."""
+        result = {}
+        with self._lock:
+            for recipient, updater in updaters.items():
+                user_state = self._cached(recipient)
+                before = _dumps(user_state)
+                updater(user_state)
+                if _dumps(user_state) != before:
+                    self._pending.setdefault(recipient, []).append(updater)
+                result[recipient] = dict(user_state)
+            if durable:
+                self.flush()
+        return result
+
+    def flush(self):
+        """Escribe en una transacción todas las filas con cambios pendientes."""
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            start = time.perf_counter()
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for recipient, updaters in pending.items():
+                    self._cache[recipient] = self._apply(self._db, recipient, _chain(updaters))
+                self._db.execute("COMMIT")
+                STATE_IO_SECONDS.observe(time.perf_counter() - start, "write")
+            except Exception as e:
+                self._db.execute("ROLLBACK")
+                for recipient, updaters in pending.items():
+                    self._pending[recipient] = updaters + self._pending.get(recipient, [])
+                print(f"[WARN] No se pudo guardar el estado: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Detiene la escritura periódica y vuelca los cambios pendientes."""
+        self._stop.set()
+        self.flush()
+
+
+def _chain(updaters: List[Updater]) -> Updater:
+    def updater(user_state: dict):
+        for u in updaters:
+            u(user_state)
+    return updater
+
+
+def clear_expired_pause(now_utc: datetime) -> Updater:
+    """Actualizador que elimina la pausa sólo si sigue vencida al momento de escribir."""
+    def updater(user_state: dict):
+        paused_until_str = user_state.get("paused_until")
+        if not paused_until_str:
+            return
+        try:
+            if datetime.fromisoformat(paused_until_str) <= now_utc:
+                user_state.pop("paused", None)
+                user_state.pop("paused_until", None)
+        except Exception:
+            pass
+
+    return updater
@@ -0,0 +1,82 @@
+"""Fábrica del cliente de Twilio compartida por todos los scripts.
+
+El cliente usa una única `requests.Session` con un pool de conexiones keep-alive
+del tamaño de la concurrencia de envío, de modo que los mensajes reutilizan la
+conexión TLS en lugar de abrir una nueva cada vez. Define timeouts de conexión y
+de lectura y reintenta a nivel de transporte sólo lo que es seguro repetir: los
+fallos de conexión (la solicitud no llegó a salir) y las respuestas 5xx/429 de
+métodos idempotentes. Los POST de mensajes fallidos los reintenta el outbox.
+
+`twilio_api_base_url` (o la variable de entorno TWILIO_API_BASE_URL) redirige
+las llamadas a otra URL, por ejemplo el stub local de `benchmarks/`.
+"""
+import os
+from typing import Optional
+from urllib.parse import urlsplit, urlunsplit
+
+from requests.adapters import HTTPAdapter
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+from urllib3.util.retry import Retry
+
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
+
+
+class PooledHttpClient(TwilioHttpClient):
+    """TwilioHttpClient con pool de conexiones, timeouts y reintentos configurables."""
+
+    def __init__(
+        self,
+        pool_size: int = 8,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 15.0,
+        max_retries: int = 2,
+        base_url: Optional[str] = None,
+        pool_connections: bool = True,
+    ):
+        super().__init__(pool_connections=pool_connections)
+        # requests acepta (conexión, lectura); HttpClient sólo valida números
+        self.timeout = (connect_timeout, read_timeout)
+        self.base_url = urlsplit(base_url.rstrip("/")) if base_url else None
+
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=IDEMPOTENT_METHODS,
+            backoff_factor=0.3,
+            raise_on_status=False,
+            respect_retry_after_header=True,
+        )
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, int(pool_size)), max_retries=retry)
+        if self.session is not None:
+            self.session.mount("https://", self.adapter)
+            self.session.mount("http://", self.adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        if self.base_url is not None:
+            parts = urlsplit(url)
+            url = urlunsplit((self.base_url.scheme, self.base_url.netloc, self.base_url.path + parts.path,
+                              parts.query, parts.fragment))
+        return super().request(method, url, *args, **kwargs)
+
+
+def build_http_client(settings: dict) -> PooledHttpClient:
+    return PooledHttpClient(
+        pool_size=settings.get("twilio_pool_size", settings.get("send_concurrency", 8)),
+        connect_timeout=settings.get("twilio_connect_timeout", 5),
+        read_timeout=settings.get("twilio_read_timeout", 15),
+        max_retries=settings.get("twilio_max_retries", 2),
+        base_url=settings.get("twilio_api_base_url") or os.environ.get("TWILIO_API_BASE_URL"),
+    )
+
+
+def build_client(settings: dict) -> Client:
+    """Cliente de Twilio con el transporte configurado en Settings.json."""
+    return Client(
+        settings["twilio_account_sid"],
+        settings["twilio_auth_token"],
+        http_client=build_http_client(settings),
+    )
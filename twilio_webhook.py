@@ -1,26 +1,37 @@
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort, jsonify
 from datetime import datetime, timedelta, timezone
+import argparse
 import os
 import json
-from twilio.rest import Client
-from PIL import Image, ExifTags
+import signal
+import sys
 import threading
-from typing import Tuple
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+import config
+from alert_catalog import AlertCatalog, CatalogEntry
+from alert_index import AlertIndex
+from exif_reader import extract_label_confidence
+from fanout import CoalescingExecutor
+from media_variants import cache_from_settings, media_url, prepared_media_url, variant_from_settings
+from message_dedup import MessageDedup
+from metrics import CONTENT_TYPE, MESSAGES_TOTAL, REGISTRY, WEBHOOK_REQUESTS_TOTAL
+from outbox import Outbox, OutboxWorker, SharedTokenBucket, alert_delivery_recorder
+from sites import PerSite, Site
+from state_store import CachedStateStore, clear_expired_pause
+from twilio_client import build_client
 
 # -------------------- Config --------------------
 BASE_DIR = os.path.dirname(__file__)
-STATE_FILE = os.path.join(BASE_DIR, "user_state.json")
 
-# Cargar configuraciones
-settings_path = os.path.join(BASE_DIR, "Settings.json")
-if not os.path.exists(settings_path):
-    raise FileNotFoundError(f"No se encontró Settings.json en {BASE_DIR}")
-
-with open(settings_path, "r", encoding="utf-8") as f:
-    settings = json.load(f)
-
-SESSION_DURATION_HOURS = settings.get("session_duration_hours", 24)
-SESSION_DURATION = timedelta(hours=SESSION_DURATION_HOURS)
+# Settings.json validado, con sitios, remitentes permitidos y etiquetas ya calculados
+# (ver config.py). Cada pedido toma la instantánea vigente con `CONFIG.current()`, así
+# los cambios de destinatarios, sitios y textos se aplican sin reiniciar. `settings`
+# es la versión al arrancar, para lo que se arma una sola vez (cliente, pools, puertos).
+CONFIG = config.source()
+settings = CONFIG.current().settings
 
 app = Flask(__name__)
 LOCAL_TZ = timezone(timedelta(hours=-3))  # UTC-3
@@ -28,148 +39,273 @@ LOCAL_TZ = timezone(timedelta(hours=-3))  # UTC-3
 # -------------------- Cliente Twilio --------------------
 ACCOUNT_SID = settings["twilio_account_sid"]
 AUTH_TOKEN = settings["twilio_auth_token"]
-FROM_WHATSAPP = settings["twilio_from_whatsapp"]
-ALERTS_FOLDER = settings.get("alerts_folder", "./alerts")
-ALERTS_BASE_URL = settings.get("alerts_base_url")
 
-client = Client(ACCOUNT_SID, AUTH_TOKEN)
+# Cliente con pool de conexiones keep-alive, timeouts y reintentos (ver twilio_client.py)
+client = build_client(settings)
+
+
+def _send_params(params: dict) -> object:
+    return client.messages.create(**params)
+
+
+# Cola persistente de envíos compartida con alerta_twilio.py: las respuestas se
+# encolan y las envía este pool en segundo plano, con reintentos.
+OUTBOX = Outbox(
+    os.path.join(BASE_DIR, "outbox.db"),
+    max_attempts=settings.get("outbox_max_attempts", 5),
+)
+OUTBOX_WORKER = OutboxWorker(
+    OUTBOX,
+    _send_params,
+    concurrency=settings.get("send_concurrency", 8),
+    limiter=SharedTokenBucket(OUTBOX, settings.get("twilio_messages_per_second", 10)),
+    # Este pool también entrega alertas encoladas por alerta_twilio.py
+    on_sent=alert_delivery_recorder(
+        lambda site_id: STATE_STORES(CONFIG.current().sites_by_id[site_id])
+        if site_id in CONFIG.current().sites_by_id else None
+    ),
+)
+OUTBOX_WORKER.start()
+
+
+def enqueue_message(params: dict, idem_key: Optional[str] = None) -> bool:
+    """Encola un envío; sin clave de idempotencia se genera una única."""
+    queued = OUTBOX.enqueue(idem_key or f"webhook:{uuid.uuid4().hex}", params, kind="reply")
+    if queued:
+        OUTBOX_WORKER.notify()
+    else:
+        MESSAGES_TOTAL.inc("reply", "skipped")
+        print(f"[SKIP] Mensaje para {params.get('to')} ya encolado ({idem_key}); no se duplica.")
+    return queued
 
 # -------------------- Utilidades de imagen --------------------
-TRANSLATIONS = {
-    "person": "Persona",
-    "vehicle": "Vehículo",
-    "fire": "Fuego",
-    "smoke": "Humo",
-    "unknown": "Desconocido",
-    "nothing found": "No se detectaron objetos",
-    "no objects detected": "No se detectaron objetos",
-}
-
-
-def translate_label(label: str) -> str:
-    return TRANSLATIONS.get(label.lower(), label)
-
-
-def extract_label_confidence(image_path: str):
-    """Extrae la etiqueta y confianza del EXIF ImageDescription."""
-    try:
-        with Image.open(image_path) as img:
-            exif_data = img.getexif()
-            if not exif_data:
-                return "No se detectaron objetos", ""
-            description = None
-            for tag_id, val in exif_data.items():
-                if ExifTags.TAGS.get(tag_id) == "ImageDescription":
-                    description = val.decode("utf-8") if isinstance(val, bytes) else str(val)
-                    break
-            if not description:
-                return "No se detectaron objetos", ""
-            if ":" in description:
-                label, confidence = description.split(":", 1)
-                return label.strip(), confidence.strip()
-            return description.strip(), "0%"
-    except Exception as e:
-        return f"Error: {e}", ""
-
-
-def send_last_alert(to_number: str):
-    """Envía al usuario la alerta más reciente con imagen."""
-    if not os.path.isdir(ALERTS_FOLDER):
-        print(f"[WARN] Carpeta de alertas no encontrada: {ALERTS_FOLDER}")
+# Variante reducida de la imagen para WhatsApp (opcional, ver 'media_variant')
+MEDIA_VARIANT = variant_from_settings(settings)
+VARIANT_CACHE = cache_from_settings(settings, BASE_DIR) if MEDIA_VARIANT else None
+
+# Índice compartido con alerta_twilio.py: "VER" no recorre la carpeta completa.
+# Una base para todos los sitios (cada carpeta es una partición); se abre al primer uso
+# y de nuevo si la carpeta del sitio cambia en Settings.json.
+INDEX_DB = os.path.join(BASE_DIR, "alert_index.db")
+ALERT_INDEXES = PerSite(
+    lambda site: AlertIndex(site.folder, INDEX_DB, extract_label_confidence),
+    key=lambda site: (site.id, site.folder),
+)
+
+
+# Si la misma imagen ya se le envió a un usuario hace menos de esto, "VER" no la repite.
+# La clave de idempotencia del outbox incluye el tramo de VER_REPEAT_SECONDS, así la
+# deduplicación vale también entre varios procesos del webhook (gunicorn).
+VER_REPEAT_SECONDS = 30
+
+
+def send_last_alert(site: Site, to_number: str, from_number: Optional[str] = None):
+    """Envía al usuario la alerta más reciente con imagen del sitio."""
+    if not os.path.isdir(site.folder):
+        print(f"[WARN] Carpeta de alertas no encontrada: {site.folder}")
         return
 
-    jpg_files = [e for e in os.scandir(ALERTS_FOLDER) if e.is_file() and e.name.lower().endswith(".jpg")]
-    if not jpg_files:
-        print("[WARN] No hay imágenes .jpg en la carpeta de alertas; no se enviará imagen.")
+    alert_index = ALERT_INDEXES(site)
+    alert_index.refresh()
+    newest_entry = alert_index.newest()
+    if newest_entry is None:
+        print(f"[WARN] No hay imágenes .jpg en la carpeta de alertas de {site.id}; no se enviará imagen.")
         return
 
+    # Varios "VER" seguidos: no reenviar la misma imagen
+    idem_key = (
+        f"ver:{site.id}:{to_number}:{newest_entry.name}@{newest_entry.mtime}:"
+        f"{int(time.time() // VER_REPEAT_SECONDS)}"
+    )
+
     # Seleccionamos la imagen más reciente
-    jpg_files.sort(key=lambda x: x.stat().st_mtime, reverse=True)
-    newest_entry = jpg_files[0]
-    image_path = os.path.join(ALERTS_FOLDER, newest_entry.name)
+    newest_entry = alert_index.describe(newest_entry)
+    enqueue_alert_image(
+        site, to_number, alert_index.path(newest_entry), newest_entry.mtime, newest_entry.label, idem_key, from_number
+    )
+
 
-    label, _ = extract_label_confidence(image_path)
-    label = translate_label(label)
+def enqueue_alert_image(
+    site: Site,
+    to_number: str,
+    image_path: str,
+    mtime: float,
+    raw_label: str,
+    idem_key: str,
+    from_number: Optional[str] = None,
+):
+    """Encola el mensaje de una alerta con su imagen."""
+    label = config.translate_label(raw_label)
 
-    event_ts = datetime.fromtimestamp(newest_entry.stat().st_mtime, tz=timezone.utc)
+    event_ts = datetime.fromtimestamp(mtime, tz=timezone.utc)
     event_ts_local = event_ts.astimezone(LOCAL_TZ)
 
     body = (
-        f"🔔 Alerta de movimiento en {settings.get('instance_name', 'Instancia')}\n"
+        f"🔔 Alerta de movimiento en {site.name}\n"
         f"🗓 Fecha y Hora: {event_ts_local.strftime('%Y-%m-%d %H:%M')} UTC-3\n"
         f"🔍 Objetos detectados: {label}"
     )
 
     media_param = {}
-    if ALERTS_BASE_URL:
-        filename = os.path.basename(image_path)
-        base = ALERTS_BASE_URL.rstrip('/')
-        if not base.startswith("http://") and not base.startswith("https://"):
-            base = "https://" + base
-        media_param = {"media_url": [f"{base}/{filename}"]}
-
-    try:
-        print(f"[DEBUG] Enviando alerta inmediata a {to_number}")
-        client.messages.create(
-            from_=FROM_WHATSAPP,
-            body=body,
-            to=to_number,
-            **media_param,
-        )
-        print(f"[OK] Alerta enviada a {to_number}")
-    except Exception as e:
-        print(f"[ERR] No se pudo enviar la alerta a {to_number}: {e}")
+    if site.base_url:
+        media_param = {"media_url": [prepared_media_url(site.base_url, image_path, MEDIA_VARIANT, VARIANT_CACHE)]}
 
-
-def send_last_alert_async(to_number: str):
-    """Envía la última alerta en un hilo separado para no bloquear la respuesta HTTP."""
-
-    threading.Thread(target=send_last_alert, args=(to_number,), daemon=True).start()
-
-
-def load_state() -> dict:
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            pass
-    return {}
-
-
-def save_state(state: dict):
-    try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(state, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"[WARN] No se pudo guardar el estado: {e}")
-
-
-def build_menu_message() -> str:
+    print(f"[DEBUG] Encolando alerta inmediata para {to_number}")
+    from_whatsapp = from_number or site.from_whatsapp or CONFIG.current().from_whatsapp
+    enqueue_message(dict(from_=from_whatsapp, body=body, to=to_number, **media_param), idem_key)
+
+
+def send_last_alerts(sites: List[Site], to_number: str, from_number: Optional[str] = None):
+    """Envía la última alerta de cada uno de los sitios del usuario."""
+    for site in sites:
+        send_last_alert(site, to_number, from_number)
+
+
+# -------------------- Historial ("VER N", "VER <etiqueta>") --------------------
+# Catálogo sobre alert_index.db (carpeta plana y archivo de la retención) con índices
+# por fecha y por etiqueta
+CATALOG = AlertCatalog(INDEX_DB)
+
+
+def ver_max_images() -> int:
+    return int(CONFIG.current().get("ver_max_images", 5))
+
+
+def parse_ver_command(command: str) -> Optional[Tuple[int, Optional[str]]]:
+    """Interpreta "VER", "VER 5", "VER PERSONA" o "VER 3 PERSONA" -> (cantidad, etiqueta).
+
+    Retorna None si el comando no es un VER.
+    """
+    cfg = CONFIG.current()
+    parts = command.split(None, 1)
+    if not parts or parts[0] != "VER":
+        return None
+    rest = parts[1].strip() if len(parts) > 1 else ""
+    count = 1
+    head, _, tail = rest.partition(" ")
+    if head.isdigit():
+        count = max(1, min(int(head), ver_max_images()))
+        rest = tail.strip()
+    return count, cfg.resolve_label(rest) if rest else None
+
+
+def catalog_entries(site: Site, count: int, label: Optional[str]) -> List[CatalogEntry]:
+    """Las últimas `count` alertas del sitio (de una etiqueta, si se indica), más recientes primero."""
+    # Las etiquetas las guarda el envío de alertas al ingresar cada imagen
+    ALERT_INDEXES(site).refresh()
+    return CATALOG.last(site.folder, count, label)
+
+
+def send_history(sites: List[Site], to_number: str, count: int, label: Optional[str], from_number: Optional[str] = None):
+    """Envía las últimas alertas de cada sitio del usuario, de la más antigua a la más nueva."""
+    bucket = int(time.time() // VER_REPEAT_SECONDS)
+    for site in sites:
+        if not os.path.isdir(site.folder):
+            print(f"[WARN] Carpeta de alertas no encontrada: {site.folder}")
+            continue
+        entries = catalog_entries(site, count, label)
+        if not entries:
+            what = f"de {config.translate_label(label)} " if label else ""
+            send_text_message(to_number, f"No hay alertas {what}registradas en {site.name}.", None,
+                              from_number or site.from_whatsapp)
+            continue
+        for entry in reversed(entries):
+            image_path = os.path.join(site.folder, entry.relpath)
+            raw_label = entry.label or extract_label_confidence(image_path)[0]
+            # Prefijo propio: una imagen que acaba de llegar por "VER" también sale en el historial
+            idem_key = f"hist:{site.id}:{to_number}:{entry.name}@{entry.mtime}:{bucket}"
+            enqueue_alert_image(site, to_number, image_path, entry.mtime, raw_label, idem_key, from_number)
+
+
+# Pool acotado para las acciones salientes del webhook: la respuesta TwiML no espera
+# a nada. Por usuario y acción queda a lo sumo una tarea pendiente (gana la última).
+ACTIONS = CoalescingExecutor(settings.get("webhook_workers", 4), "webhook")
+
+
+def send_last_alert_async(to_number: str, sites: List[Site], from_number: Optional[str] = None):
+    """Envía la última alerta desde el pool para no bloquear la respuesta HTTP."""
+    if not ACTIONS.submit((to_number, "VER"), send_last_alerts, sites, to_number, from_number):
+        print(f"[INFO] Ya había un envío de la última alerta pendiente para {to_number}; se unifican.")
+
+
+def send_history_async(
+    to_number: str, sites: List[Site], count: int, label: Optional[str], from_number: Optional[str] = None
+):
+    """Envía el historial desde el pool (comparte la clave con "VER": gana el último pedido)."""
+    if not ACTIONS.submit((to_number, "VER"), send_history, sites, to_number, count, label, from_number):
+        print(f"[INFO] Ya había un envío de alertas pendiente para {to_number}; se unifican.")
+
+
+# Estado por usuario compartido con alerta_twilio.py (una fila por destinatario y una
+# base por sitio). Se mantiene en memoria y se escribe en lote; detecta los cambios del
+# envío de alertas. Cada base se abre recién cuando un usuario del sitio escribe.
+STATE_STORES = PerSite(lambda site: CachedStateStore(
+    site.state_db,
+    legacy_json=site.legacy_state_json,
+    flush_interval=settings.get("state_flush_interval", 0.5),
+))
+
+
+def sites_for(from_number: str, to_number: Optional[str] = None) -> List[Site]:
+    """Sitios sobre los que opera un remitente.
+
+    Si el usuario escribió a un número propio de alguno de sus sitios, sólo esos.
+    Sin destinatarios configurados, cualquiera opera sobre todos los sitios.
+    """
+    cfg = CONFIG.current()
+    sites = list(cfg.recipient_sites.get(from_number) or ([] if cfg.allowed_senders else cfg.sites))
+    if to_number:
+        own = [site for site in sites if site.from_whatsapp == to_number]
+        if own and len(own) < len(sites):
+            return own
+    return sites
+
+
+def session_hours(sites: List[Site]) -> str:
+    """Duración de la sesión para mostrar (ej. "24" o "12/24" si los sitios difieren)."""
+    hours = sorted({site.session_duration.total_seconds() / 3600 for site in sites})
+    return "/".join(f"{h:g}" for h in hours)
+
+
+def build_menu_message(sites: List[Site]) -> str:
     """Construye el mensaje de menú con los comandos disponibles."""
     return (
         "🤖 Menú de comandos disponibles:\n"
         "- ALERTAS: activa o reanuda las alertas por las próximas "
-        f"{SESSION_DURATION_HOURS} horas.\n"
+        f"{session_hours(sites)} horas.\n"
         "- PARAR: pausa las alertas por 6 horas. Se reanudarán automáticamente.\n"
         "- VER: solicita la imagen y datos de la última alerta registrada.\n"
+        f"- VER N: las últimas N alertas (hasta {ver_max_images()}).\n"
+        "- VER <objeto>: la última alerta de ese tipo (ej. VER PERSONA o VER 3 VEHICULO).\n"
         "- MENU o AYUDA: muestra este menú.\n\n"
         "Las horas se muestran en UTC-3."
     )
 
 
-def send_text_message(to_number: str, text: str) -> None:
-    """Envía un mensaje de WhatsApp de texto mediante la API de Twilio."""
-    try:
-        print(f"[SEND] -> {to_number}: {text[:120]}" + ("…" if len(text) > 120 else ""))
-        client.messages.create(
-            from_=FROM_WHATSAPP,
-            body=text,
-            to=to_number,
-        )
-        print(f"[OK] Mensaje enviado a {to_number}")
-    except Exception as e:
-        print(f"[ERR] Falló envío a {to_number}: {e}")
+def send_text_message(
+    to_number: str, text: str, idem_key: Optional[str] = None, from_number: Optional[str] = None
+) -> None:
+    """Encola un mensaje de WhatsApp de texto; lo envía el pool del outbox."""
+    print(f"[SEND] -> {to_number}: {text[:120]}" + ("…" if len(text) > 120 else ""))
+    enqueue_message(dict(from_=from_number or CONFIG.current().from_whatsapp, body=text, to=to_number), idem_key)
+
+
+def send_text_message_async(
+    to_number: str, action: str, text: str, idem_key: Optional[str] = None, from_number: Optional[str] = None
+) -> None:
+    """Encola el mensaje desde el pool; respuestas repetidas de la misma acción se unifican."""
+    ACTIONS.submit((to_number, action), send_text_message, to_number, text, idem_key, from_number)
+
+
+# Respuestas ya dadas por MessageSid (persistidas en webhook_dedup.db, con vencimiento)
+DEDUP = MessageDedup(
+    os.path.join(BASE_DIR, "webhook_dedup.db"),
+    ttl_seconds=settings.get("webhook_dedup_ttl_hours", 24) * 3600,
+    max_entries=settings.get("webhook_dedup_max_entries", 50000),
+)
+
+EMPTY_TWIML = "<Response></Response>"
+TWIML_HEADERS = {"Content-Type": "text/xml; charset=utf-8"}
 
 
 @app.route("/webhook", methods=["POST"])
@@ -187,86 +323,204 @@ def webhook():
     if not from_number:
         abort(400)
 
-    # ------- Filtro de remitentes permitidos -------
-    # Normalizar remitentes permitidos (ignorar vacíos)
-    allowed_senders = {s.strip() for s in settings.get("recipients", []) if isinstance(s, str) and s.strip()}
-    print(f"[AUTH] From={from_number} Allowed={sorted(allowed_senders)}")
-    if allowed_senders and from_number not in allowed_senders:
+    # ------- Filtro de remitentes permitidos (destinatarios de algún sitio) -------
+    # Las respuestas salen del número al que escribió el usuario
+    to_whatsapp = request.values.get("To") or None
+    sites = sites_for(from_number, to_whatsapp)
+    print(f"[AUTH] From={from_number} Sitios={[site.id for site in sites]}")
+    if not sites:
         # Descartamos silenciosamente (respondemos 200 para que Twilio no reintente)
         print(f"[INFO] Mensaje descartado de {from_number}: no está en 'recipients'.")
-        return ("<Response></Response>", 200, {"Content-Type": "text/xml; charset=utf-8"})
+        return (EMPTY_TWIML, 200, TWIML_HEADERS)
+
+    # Cada mensaje entrante genera a lo sumo una respuesta: su MessageSid sirve de
+    # clave de idempotencia, así un reintento de Twilio no duplica el envío.
+    message_sid = request.values.get("MessageSid")
+    reply_key = f"webhook:{message_sid}" if message_sid else None
 
     # Texto del mensaje entrante normalizado
     body_text = (request.values.get("Body") or "").strip()
     command = body_text.upper()
 
-    # Estado actual del usuario
-    state = load_state()
-    user_state = state.get(from_number, {})
-
-    # Auto-despausar si la pausa expiró
+    # Un reintento de Twilio (mismo MessageSid) recibe la respuesta ya dada, sin
+    # volver a tocar el estado ni encolar envíos
+    if message_sid:
+        cached = DEDUP.claim(message_sid)
+        if cached is not None:
+            WEBHOOK_REQUESTS_TOTAL.inc("duplicate")
+            print(f"[SKIP] Reintento de {message_sid}; se repite la respuesta sin reprocesar.")
+            return (cached, 200, TWIML_HEADERS)
+    try:
+        twiml = handle_command(from_number, sites, command, reply_key, to_whatsapp)
+    except Exception:
+        if message_sid:
+            DEDUP.release(message_sid)
+        raise
+    if message_sid:
+        DEDUP.complete(message_sid, twiml)
+    WEBHOOK_REQUESTS_TOTAL.inc("processed")
+    return (twiml, 200, TWIML_HEADERS)
+
+
+def handle_command(
+    from_number: str, sites: List[Site], command: str, reply_key: Optional[str], to_whatsapp: Optional[str]
+) -> str:
+    """Aplica el comando del usuario a sus sitios y retorna el TwiML de respuesta."""
+    # Estado actual del usuario; auto-despausar si la pausa expiró
     now_utc = datetime.now(timezone.utc)
-    paused_until_str = user_state.get("paused_until")
-    if paused_until_str:
-        try:
-            if datetime.fromisoformat(paused_until_str) <= now_utc:
-                user_state.pop("paused", None)
-                user_state.pop("paused_until", None)
-                state[from_number] = user_state
-                save_state(state)
-        except Exception:
-            pass
+    for site in sites:
+        STATE_STORES(site).update(from_number, clear_expired_pause(now_utc))
 
     # Si no envió texto o envió un comando de menú/ayuda, responder con menú
     if not command or command in {"MENU", "AYUDA", "HELP"}:
         print(f"[FLOW] Comando de menú/ayuda recibido: '{command}' -> enviando menú")
-        send_text_message(from_number, build_menu_message())
-        return ("<Response></Response>", 200, {"Content-Type": "text/xml; charset=utf-8"})
+        send_text_message_async(from_number, "MENU", build_menu_message(sites), reply_key, to_whatsapp)
+        return EMPTY_TWIML
 
-    # Comando para solicitar la última alerta
-    if command == "VER":
+    # Comando para solicitar la última alerta, las últimas N o las de una etiqueta
+    ver = parse_ver_command(command)
+    if ver == (1, None):
         print(f"[FLOW] {from_number} solicitó la última alerta (VER)")
-        send_last_alert_async(from_number)
+        send_last_alert_async(from_number, sites, to_whatsapp)
         # No enviamos confirmación para no duplicar mensajes; la alerta es la respuesta.
-        return ("<Response></Response>", 200, {"Content-Type": "text/xml; charset=utf-8"})
+        return EMPTY_TWIML
+    if ver is not None:
+        count, label = ver
+        print(f"[FLOW] {from_number} solicitó el historial ({command}): {count} alerta(s), etiqueta {label}")
+        send_history_async(from_number, sites, count, label, to_whatsapp)
+        return EMPTY_TWIML
 
     # Comandos de control de alertas
     if command == "PARAR":
-        user_state["paused"] = True
         resume_at_utc = now_utc + timedelta(hours=6)
-        user_state["paused_until"] = resume_at_utc.isoformat()
-        state[from_number] = user_state
-        save_state(state)
+
+        def pause(user_state: dict):
+            user_state["paused"] = True
+            user_state["paused_until"] = resume_at_utc.isoformat()
+
+        for site in sites:
+            STATE_STORES(site).update(from_number, pause, durable=True)
         resume_local = resume_at_utc.astimezone(LOCAL_TZ)
         print(f"[INFO] {from_number} pausó las alertas (PARAR) hasta {resume_at_utc.isoformat()}")
-        send_text_message(
+        send_text_message_async(
             from_number,
+            "PARAR",
             f"Alertas pausadas por 6 horas. Se reanudarán automáticamente a las {resume_local.strftime('%Y-%m-%d %H:%M')} UTC-3. Envía ALERTAS para reanudarlas antes.",
+            reply_key,
+            to_whatsapp,
         )
-        return ("<Response></Response>", 200, {"Content-Type": "text/xml; charset=utf-8"})
+        return EMPTY_TWIML
 
     if command in {"ALERTAS", "MOSTRAR ALERTAS (24 HS)"}:
         # Activar/reanudar sesión
-        user_state.pop("paused", None)
-        user_state.pop("paused_until", None)
-        user_state["session_until"] = (now_utc + SESSION_DURATION).isoformat()
-        state[from_number] = user_state
-        save_state(state)
+        for site in sites:
+            def resume(user_state: dict, session_duration=site.session_duration):
+                user_state.pop("paused", None)
+                user_state.pop("paused_until", None)
+                user_state["session_until"] = (now_utc + session_duration).isoformat()
+
+            STATE_STORES(site).update(from_number, resume, durable=True)
         print(f"[INFO] {from_number} activó/reanudó alertas (comando: {command})")
 
         # Si el comando viene del botón de la plantilla, enviar la última alerta
         if command == "MOSTRAR ALERTAS (24 HS)":
-            send_last_alert_async(from_number)
+            send_last_alert_async(from_number, sites, to_whatsapp)
         else:
             # Para el comando manual "ALERTAS", solo enviar confirmación
-            send_text_message(from_number, f"Alertas reanudadas por las próximas {SESSION_DURATION_HOURS}h.")
+            send_text_message_async(
+                from_number,
+                "ALERTAS",
+                f"Alertas reanudadas por las próximas {session_hours(sites)}h.",
+                reply_key,
+                to_whatsapp,
+            )
 
-        return ("<Response></Response>", 200, {"Content-Type": "text/xml; charset=utf-8"})
+        return EMPTY_TWIML
 
     # Si no es comando reconocido, enviar menú y no activar sesión ni alerta
     print(f"[FLOW] Comando no reconocido: '{command}' -> enviando menú")
-    send_text_message(from_number, build_menu_message())
-    return ("<Response></Response>", 200, {"Content-Type": "text/xml; charset=utf-8"})
+    send_text_message_async(from_number, "MENU", build_menu_message(sites), reply_key, to_whatsapp)
+    return EMPTY_TWIML
+
+
+# -------------------- API de historial --------------------
+# Consultas por rango de fechas, etiqueta y confianza para uso local (scripts, paneles).
+# Sólo responde a localhost y a las IP de 'history_api_allowed_ips'.
+HISTORY_API_MAX_LIMIT = 1000
+
+
+def _parse_time(value: Optional[str], default: float) -> float:
+    """Epoch o fecha ISO 8601 (sin zona se toma UTC-3)."""
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=LOCAL_TZ)
+    return parsed.timestamp()
+
+
+def _api_error(message: str, status: int = 400):
+    return jsonify({"error": message}), status
+
+
+@app.route("/api/alerts", methods=["GET"])
+def history_api():
+    """Alertas en un rango: ?site=&from=&to=&label=&min_confidence=&limit= (fechas epoch o ISO)."""
+    cfg = CONFIG.current()
+    if request.remote_addr not in cfg.history_api_allowed:
+        abort(403)
+    site_id = request.args.get("site")
+    if site_id is None and len(cfg.sites) > 1:
+        return _api_error("Falta 'site' (hay varios sitios configurados).")
+    site = cfg.sites[0] if site_id is None else cfg.sites_by_id.get(site_id)
+    if site is None:
+        return _api_error(f"Sitio desconocido: {site_id}", 404)
+
+    now = time.time()
+    try:
+        end = _parse_time(request.args.get("to"), now)
+        start = _parse_time(request.args.get("from"), end - 86400)
+        min_confidence = request.args.get("min_confidence", type=float)
+        limit = int(request.args.get("limit", 100))
+    except ValueError as e:
+        return _api_error(f"Parámetro inválido: {e}")
+    if limit < 1:
+        return _api_error("'limit' debe ser 1 o más.")
+    limit = min(limit, HISTORY_API_MAX_LIMIT)
+    label = request.args.get("label")
+    label = cfg.resolve_label(label) if label else None
+
+    ALERT_INDEXES(site).refresh()
+    entries = CATALOG.between(site.folder, start, end, label, min_confidence, limit)
+    return jsonify({
+        "site": site.id,
+        "from": start,
+        "to": end,
+        "count": len(entries),
+        "alerts": [
+            {
+                "name": e.name,
+                "mtime": e.mtime,
+                "time": datetime.fromtimestamp(e.mtime, tz=LOCAL_TZ).isoformat(),
+                "label": e.label,
+                "label_es": config.translate_label(e.label) if e.label else None,
+                "confidence": e.confidence,
+                "url": media_url(site.base_url, e.name) if site.base_url else None,
+            }
+            for e in entries
+        ],
+    })
+
+
+# -------------------- Métricas --------------------
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Métricas de este proceso en formato de texto de Prometheus."""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
 
 
 # -------------------- Hook global de logging --------------------
@@ -282,6 +536,61 @@ def log_any_request():
         print(f"[WARN] No se pudo registrar la petición genérica: {e}")
 
 
-if __name__ == "__main__":
+# -------------------- Grabación de pedidos (para pruebas de carga) --------------------
+# Si se define 'webhook_record_file', cada POST recibido se agrega como una línea JSON
+# con su formulario; benchmarks/load_webhook.py los reproduce.
+RECORD_FILE = settings.get("webhook_record_file")
+_record_lock = threading.Lock()
+_record_handle = None
+
+
+@app.before_request
+def record_request():
+    global _record_handle
+    if not RECORD_FILE or request.method != "POST":
+        return
+    try:
+        line = json.dumps({"path": request.path, "form": request.form.to_dict()}, ensure_ascii=False)
+        with _record_lock:
+            if _record_handle is None:
+                _record_handle = open(RECORD_FILE, "a", encoding="utf-8")
+            _record_handle.write(line + "\n")
+            _record_handle.flush()
+    except Exception as e:
+        print(f"[WARN] No se pudo grabar la petición: {e}")
+
+
+# -------------------- Servidor --------------------
+def serve(port: int, threads: int, connection_limit: int):
+    """Sirve la app con waitress (WSGI de producción, multihilo).
+
+    Si waitress no está instalado se usa el servidor de desarrollo de Flask.
+    """
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        print("[WARN] waitress no está instalado (pip install waitress); se usa el servidor de desarrollo de Flask.")
+        app.run(host="0.0.0.0", port=port, threaded=True)
+        return
+    print(f"[INFO] Webhook en el puerto {port} (waitress, {threads} hilos, hasta {connection_limit} conexiones)")
+    waitress_serve(app, host="0.0.0.0", port=port, threads=threads, connection_limit=connection_limit)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Webhook de WhatsApp para las alertas.")
+    parser.add_argument("--dev", action="store_true", help="Usar el servidor de desarrollo de Flask.")
+    args = parser.parse_args(argv)
+
+    # systemd, contenedores y supervisores detienen con SIGTERM: salir con SystemExit
+    # para que atexit vuelque el estado pendiente de escritura
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     port = int(os.environ.get("PORT", settings.get("webhook_port", 5000)))
-    app.run(host="0.0.0.0", port=port) 
+    if args.dev:
+        app.run(host="0.0.0.0", port=port)
+    else:
+        serve(port, settings.get("webhook_threads", 16), settings.get("webhook_connection_limit", 1000))
+
+
+if __name__ == "__main__":
+    main()